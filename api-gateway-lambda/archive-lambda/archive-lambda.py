@@ -3,13 +3,19 @@ import json
 import boto3
 import time
 
+from metrics import Metrics
+
 def lambda_handler(event, context):
     print("Received Event =>", event)
     print("Received Context =>", context)
-    
-    submit_batch_job(event)
+    # The jobs of the run report their metrics with the id of this request
+    metrics = Metrics('archive-lambda', context.aws_request_id)
+    try:
+        submit_batch_job(event, metrics)
+    finally:
+        metrics.emit()
 
-def submit_batch_job(event):
+def submit_batch_job(event, metrics):
     job_queue = os.environ['JOB_QUEUE']
     job_definition = os.environ['JOB_DEFINITION']
     #FILE_SIZE_LIMIT = int(os.environ['ARCHIVE_SIZE']) 
@@ -29,20 +35,96 @@ def submit_batch_job(event):
         env.append({'name': 'STORAGE_CLASS', 'value': event['storage_class']})
     if event['archive_size']:
         env.append({'name': 'ARCHIVE_SIZE', 'value': str(event['archive_size'])})
+    if event.get('compression_codec'):
+        env.append({'name': 'COMPRESSION_CODEC', 'value': event['compression_codec']})
+    if event.get('compression_level') is not None:
+        env.append({'name': 'COMPRESSION_LEVEL', 'value': str(event['compression_level'])})
+    if event.get('group_by_subfolder'):
+        env.append({'name': 'GROUP_BY_SUBFOLDER', 'value': 'true'})
+    if event.get('dry_run'):
+        env.append({'name': 'DRY_RUN', 'value': 'true'})
+    if event.get('dedup'):
+        env.append({'name': 'DEDUP', 'value': 'true'})
+    if event.get('detect_incompressible') is False:
+        env.append({'name': 'DETECT_INCOMPRESSIBLE', 'value': 'false'})
+    if event.get('min_age_days') is not None:
+        env.append({'name': 'MIN_AGE_DAYS', 'value': str(event['min_age_days'])})
+    if event.get('incremental'):
+        env.append({'name': 'INCREMENTAL', 'value': 'true'})
+    if event.get('inventory_manifest'):
+        env.append({'name': 'INVENTORY_MANIFEST', 'value': event['inventory_manifest']})
     
     
+    # Every attempt of a run shares its id, so a retried or resubmitted job resumes the run from
+    # its journal. Pass the run_id of an interrupted run to resume it. A new id ends with the
+    # request id, requests sent in the same second still start runs of their own.
+    run_id = event.get('run_id') or f"{time.strftime('%Y%m%d%H%M%S', time.gmtime())}-{metrics.correlation_id}"
+    env.append({'name': 'RUN_ID', 'value': run_id})
+    env.append({'name': 'CORRELATION_ID', 'value': metrics.correlation_id})
+    retry_strategy = {'attempts': int(event.get('attempts') or 3)}
+    
     batch_client = boto3.client('batch')
-    batch_client.submit_job(
-        jobName=str(int(time.time())),
+    metrics.count_requests(batch_client, {'SubmitJob': 'submit'})
+    shards = int(event.get('shards') or 1)
+    if shards > 1 and not event.get('dry_run'):
+        submit_sharded_jobs(batch_client, job_queue, job_definition, env, shards, run_id, retry_strategy)
+    else:
+        batch_client.submit_job(
+            jobName=run_id,
+            jobQueue=job_queue,
+            jobDefinition=job_definition,
+            retryStrategy=retry_strategy,
+            containerOverrides={
+                'command': ['python3', 'archivemaster.py'],
+                'environment': env
+            }
+        )
+    
+    return {
+        'statusCode': 200,
+        'body': json.dumps('Archival process completed successfully!')
+    }
+
+
+def submit_sharded_jobs(batch_client, job_queue, job_definition, env, shards, run_id, retry_strategy):
+    # One planning job lists and plans the prefix, an array job of `shards` children archives
+    # the plan in parallel, and an aggregate job collects the results once every child is done.
+    # Children exit 0 once their result is stored, failed archives included, since the aggregate
+    # job only starts when every child succeeds; it decides whether the run failed.
+    if shards > 10000:
+        raise ValueError(f"At most 10000 shards are supported, got {shards}")
+    env = env + [{'name': 'SHARD_COUNT', 'value': str(shards)}]
+    plan_job = batch_client.submit_job(
+        jobName=f"{run_id}-plan",
         jobQueue=job_queue,
         jobDefinition=job_definition,
+        retryStrategy=retry_strategy,
+        containerOverrides={
+            'command': ['python3', 'archivemaster.py'],
+            'environment': env + [{'name': 'PLAN_ONLY', 'value': 'true'}]
+        }
+    )
+    archive_job = batch_client.submit_job(
+        jobName=f"{run_id}-archive",
+        jobQueue=job_queue,
+        jobDefinition=job_definition,
+        arrayProperties={'size': shards},
+        retryStrategy=retry_strategy,
+        dependsOn=[{'jobId': plan_job['jobId']}],
         containerOverrides={
             'command': ['python3', 'archivemaster.py'],
             'environment': env
         }
     )
-    
-    return {
-        'statusCode': 200,
-        'body': json.dumps('Archival process completed successfully!')
-    }
\ No newline at end of file
+    aggregate_job = batch_client.submit_job(
+        jobName=f"{run_id}-aggregate",
+        jobQueue=job_queue,
+        jobDefinition=job_definition,
+        dependsOn=[{'jobId': archive_job['jobId']}],
+        containerOverrides={
+            'command': ['python3', 'aggregate.py'],
+            'environment': env
+        }
+    )
+    print(f"Submitted run {run_id}: plan job {plan_job['jobId']}, archive job {archive_job['jobId']} "
+          f"with {shards} shards, aggregate job {aggregate_job['jobId']}")
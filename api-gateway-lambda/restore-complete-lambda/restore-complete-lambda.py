@@ -0,0 +1,143 @@
+import os
+import boto3
+import time
+import json
+from urllib.parse import unquote_plus
+
+from backoff import attempts
+from metrics import Metrics
+from restore_keys import key_chunks
+
+BATCH_WRITE_LIMIT = 25     # DynamoDB limit on items per BatchWriteItem call
+# Metrics of the invocation being handled
+metrics = None
+
+
+def lambda_handler(event, context):
+    global metrics
+    metrics = Metrics('restore-complete-lambda', context.aws_request_id)
+    try:
+        return handle_restore_completed(event, context)
+    finally:
+        metrics.emit()
+
+
+def handle_restore_completed(event, context):
+    # Invoked when a Glacier restore of an archive finishes, either by the EventBridge rule for
+    # "Object Restore Completed" or by an S3 event notification for ObjectRestore:Completed
+    print("Received Event =>", event)
+    print("Received Context =>", context)
+    PROJECT_NAME = os.environ['PROJECT_NAME']
+    RESTORE_TRACKER_TABLE = PROJECT_NAME + '_restore_tracker'
+
+    for src_bkt, tarFileName in restored_archives(event):
+        print(f" Restore of {tarFileName} in {src_bkt} completed")
+        requests = get_restore_requests(tarFileName, RESTORE_TRACKER_TABLE)
+        if not requests:
+            print(f" No files waiting on {tarFileName}")
+            continue
+
+        # Every file waiting on the archive is extracted by one job per restore bucket
+        by_restore_bucket = {}
+        members = {}
+        # The restore API requests the files came from, the jobs report their metrics with them
+        correlation_ids = {}
+        for request in requests:
+            restore_bkt = request.get('restore_bucket', {}).get('S')
+            by_restore_bucket.setdefault(restore_bkt, []).append(request['key']['S'])
+            if 'member' in request:
+                members[request['key']['S']] = request['member']['S']
+            if 'correlation_id' in request:
+                correlation_ids.setdefault(restore_bkt, set()).add(request['correlation_id']['S'])
+        for restore_bkt, requested_filenames in by_restore_bucket.items():
+            if restore_bkt is None:
+                # Recorded before restore buckets were tracked, these wait for the API to be called again
+                print(f" No restore bucket recorded for {requested_filenames}, leaving them for a retry")
+                requests = [r for r in requests if 'restore_bucket' in r]
+                continue
+            print(f" Submitting restore of {requested_filenames} from {tarFileName} into {restore_bkt}")
+            correlation_id = ','.join(sorted(correlation_ids.get(restore_bkt, []))) or metrics.correlation_id
+            submit_batch_job(src_bkt, tarFileName, requested_filenames, os.environ['TOPIC_ARN'], PROJECT_NAME, restore_bkt, members,
+                             correlation_id)
+
+        # The submitted job owns the files now, a repeated event must not extract them again
+        clear_restore_requests(requests, RESTORE_TRACKER_TABLE)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps('Restore completion processed successfully!')
+    }
+
+def restored_archives(event):
+    # (bucket, key) of every completed restore in the event
+    if event.get('detail-type') == 'Object Restore Completed':
+        yield event['detail']['bucket']['name'], event['detail']['object']['key']
+    for record in event.get('Records', []):
+        if record.get('eventName', '').startswith('ObjectRestore:Completed'):
+            # Keys in S3 event notifications are URL encoded
+            yield record['s3']['bucket']['name'], unquote_plus(record['s3']['object']['key'])
+
+def get_restore_requests(tarFileName, table_name):
+    dynamodb_client = boto3.client('dynamodb')
+    metrics.count_requests(dynamodb_client, {'Query': 'lookup'})
+    requests = []
+    args = {
+        'TableName': table_name,
+        'KeyConditionExpression': 'archive_key = :archive_key',
+        'ExpressionAttributeValues': {':archive_key': {'S': tarFileName}},
+        'ConsistentRead': True
+    }
+    while True:
+        response = dynamodb_client.query(**args)
+        requests.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            metrics.phase('lookup').add(items=len(requests))
+            return requests
+        args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def clear_restore_requests(requests, table_name):
+    dynamodb_client = boto3.client('dynamodb')
+    metrics.count_requests(dynamodb_client, {'BatchWriteItem': 'clear'})
+    for i in range(0, len(requests), BATCH_WRITE_LIMIT):
+        deletes = [{'DeleteRequest': {'Key': {'archive_key': r['archive_key'], 'key': r['key']}}}
+                   for r in requests[i:i + BATCH_WRITE_LIMIT]]
+        for attempt in attempts(8):
+            response = dynamodb_client.batch_write_item(RequestItems={table_name: deletes})
+            deletes = response.get('UnprocessedItems', {}).get(table_name, [])
+            if not deletes:
+                break
+        if deletes:
+            # Left in the table, a repeated event for the archive extracts these files again
+            print(f"Could not clear {len(deletes)} restore requests after retries: "
+                  f"{[d['DeleteRequest']['Key']['key']['S'] for d in deletes]}")
+
+def submit_batch_job(s3_bucket, tarFileName, requested_filenames, topic_arn, project_name, restore_bkt, members,
+                     correlation_id):
+    print('Job Submitted for restoring the files!!')
+    job_queue = os.environ['JOB_QUEUE']
+    job_definition = os.environ['JOB_DEFINITION']
+
+    batch_client = boto3.client('batch')
+    metrics.count_requests(batch_client, {'SubmitJob': 'submit'})
+    for keys in key_chunks(requested_filenames, members):
+        batch_client.submit_job(
+            jobName=str(int(time.time())),
+            jobQueue=job_queue,
+            jobDefinition=job_definition,
+            # The tracker rows are cleared once the job is submitted, retries cover a lost container
+            retryStrategy={'attempts': 3},
+            containerOverrides={
+                'command': ['python3', 'restore.py'],
+                'environment': [
+                    {'name': 'PROJECT_NAME', 'value': project_name},
+                    {'name': 'SRC_BUCKET_NAME', 'value': s3_bucket},
+                    {'name': 'RESTORE_BUCKET_NAME', 'value': restore_bkt},
+                    {'name': 'AWS_REGION', 'value': os.environ['AWS_REGION']},
+                    {'name': 'ARCHIVE_KEY', 'value': tarFileName},
+                    {'name': 'KEYS', 'value': json.dumps(keys)},
+                    {'name': 'MEMBERS', 'value': json.dumps({k: members[k] for k in keys if k in members})},
+                    {'name': 'TOPIC_ARN', 'value': topic_arn},
+                    {'name': 'CORRELATION_ID', 'value': correlation_id}
+                ]
+            }
+        )
@@ -2,148 +2,331 @@ import os
 import boto3
 import time
 import json
+import re
+import datetime
+from email.utils import parsedate_to_datetime
+from botocore.exceptions import ClientError
+
+from backoff import attempts
+from metrics import Metrics
+from manifest_index import ManifestIndex, manifest_index_table, parse_time
+from restore_cache import RestoreCache, cache_table, restore_days
+from restore_keys import key_chunks
+
+BATCH_GET_LIMIT = 100      # DynamoDB limit on keys per BatchGetItem call
+BATCH_WRITE_LIMIT = 25     # DynamoDB limit on items per BatchWriteItem call
+# Files named per archive in the notification, which SNS limits to 256 KB
+MESSAGE_FILES = 20
+# Files served from the restore cache stay cached this long after their last use
+RESTORE_CACHE_TTL_HOURS = float(os.environ.get('RESTORE_CACHE_TTL_HOURS', '168'))
+# Bounds of the days an archive is kept restored, more the more often it is requested
+RESTORE_MIN_DAYS = int(os.environ.get('RESTORE_MIN_DAYS', '1'))
+RESTORE_MAX_DAYS = int(os.environ.get('RESTORE_MAX_DAYS', '7'))
+# Most files a pattern may restore in one request
+RESTORE_PATTERN_LIMIT = int(os.environ.get('RESTORE_PATTERN_LIMIT', '10000'))
+# Metrics of the invocation being handled, the restorer jobs it starts report with its request id
+metrics = None
 
 
 def lambda_handler(event, context):
+    global metrics
+    metrics = Metrics('restore-lambda', context.aws_request_id)
+    try:
+        return handle_restore_request(event, context)
+    finally:
+        metrics.emit()
+
+
+def handle_restore_request(event, context):
     print("Received Event =>", event)
     print("Received Context =>", context)
     PROJECT_NAME= event['project_name']
     AWS_ACCOUNT_PROVIDED= event['account']
     AWS_REGION_PROVIDED= event['region']
-    REQUESTED_FILENAME_LIST = event['filename']
+    REQUESTED_FILENAME_LIST = event.get('filename', '')
+    # Optional: a key prefix or glob pattern, and a range of last modified times of the files
+    PATTERN = event.get('pattern', '')
+    MODIFIED_AFTER = event.get('modified_after')
+    MODIFIED_BEFORE = event.get('modified_before')
     RETRIEVAL_TIER = event['retrieval_tier']
     TOPIC_ARN = event['sns_topic_arn']
     ARCHIVAL_DYNAMODB_MASTER_TABLE= event['project_name'] + '_archive_master'
 
     SRC_BKT= event['dest_bucket_name']
     RESTORE_BKT = event['restore_bucket_name']
-    
+
     print(f" Source bucket provided : {SRC_BKT}")
     print(f" Restore bucket provided : {RESTORE_BKT}")
 
-    # Split by comma in case multiple file search
-    REQUESTED_FILENAME_SEARCH = [f.strip() for f in REQUESTED_FILENAME_LIST.split(',')]
+    # Split by comma in case multiple file search, a file asked for twice is restored once
+    REQUESTED_FILENAME_SEARCH = list(dict.fromkeys(f.strip() for f in REQUESTED_FILENAME_LIST.split(',') if f.strip()))
+    if PATTERN or MODIFIED_AFTER or MODIFIED_BEFORE:
+        try:
+            matched = resolve_pattern(PROJECT_NAME, SRC_BKT, PATTERN, MODIFIED_AFTER, MODIFIED_BEFORE)
+        except ValueError as e:
+            print(e)
+            return {
+                'statusCode': 400,
+                'body': json.dumps(str(e))
+            }
+        REQUESTED_FILENAME_SEARCH = list(dict.fromkeys(REQUESTED_FILENAME_SEARCH + matched))
+    print(f" Requested file names for search : {REQUESTED_FILENAME_SEARCH}")
 
-    for SEARCH_FILE_NAME in REQUESTED_FILENAME_SEARCH:
-        print(f" Requested file name for search : {SEARCH_FILE_NAME}")
-        resp = get_archive_details(SEARCH_FILE_NAME,ARCHIVAL_DYNAMODB_MASTER_TABLE)
-        print(resp['Item'])
+    # Look every file up at once and group them by the archive holding them, so each archive is
+    # checked, restored and extracted once for all of its requested files
+    archives, members, unresolved = get_archive_details(REQUESTED_FILENAME_SEARCH, ARCHIVAL_DYNAMODB_MASTER_TABLE)
+    found = {f for files in archives.values() for f in files}
+    not_found = [f for f in REQUESTED_FILENAME_SEARCH if f not in found and f not in unresolved]
+    for TAR_FILE_NAME, files in archives.items():
+        print(f" Requested files: {files} stored in tarFileName : {TAR_FILE_NAME}, Start the restore process")
 
-        TAR_FILE_NAME= resp['Item']['TarFileName']
-        # Check if tarFileName is a dictionary
-        if isinstance(TAR_FILE_NAME, dict):
-        # Extract the filename from the dictionary
-            TAR_FILE_NAME = list(TAR_FILE_NAME.values())[0]
+    cache_dynamodb = boto3.client('dynamodb')
+    cache_s3 = boto3.client('s3')
+    metrics.count_requests(cache_dynamodb, {'BatchGetItem': 'cache', 'UpdateItem': 'cache'})
+    metrics.count_requests(cache_s3, {'CopyObject': 'cache', 'UploadPartCopy': 'cache'})
+    cache = RestoreCache(cache_dynamodb, cache_s3, cache_table(PROJECT_NAME), SRC_BKT, ttl_hours=RESTORE_CACHE_TTL_HOURS)
 
-        print(f" Requested file: {SEARCH_FILE_NAME} stored in tarFileName : {TAR_FILE_NAME}, Start the restore process")
-        
-        initiate_restore(AWS_ACCOUNT_PROVIDED,AWS_REGION_PROVIDED,SRC_BKT,TAR_FILE_NAME, SEARCH_FILE_NAME,RETRIEVAL_TIER,PROJECT_NAME,RESTORE_BKT,TOPIC_ARN)
+    statuses = []
+    for TAR_FILE_NAME, files in archives.items():
+        days = restore_days_for(cache, TAR_FILE_NAME)
+        # Files restored lately are copied from the restore cache right away, only the others
+        # wait for the archive
+        served = serve_from_cache(cache, TAR_FILE_NAME, files, members, RESTORE_BKT)
+        remaining = [f for f in files if f not in served]
+        status = f"{len(served)} files copied from the restore cache" if served else ""
+        if remaining:
+            status += ("; " if status else "") + initiate_restore(AWS_ACCOUNT_PROVIDED,AWS_REGION_PROVIDED,SRC_BKT,TAR_FILE_NAME, remaining,RETRIEVAL_TIER,PROJECT_NAME,RESTORE_BKT,members,days)
+        statuses.append(f"{TAR_FILE_NAME} ({len(files)} files: {file_list(files)}): {status}")
+    if not_found:
+        print(f" Files not found in {ARCHIVAL_DYNAMODB_MASTER_TABLE}: {not_found}")
+        statuses.append(f"Not found in any archive: {file_list(not_found)}")
+    if unresolved:
+        statuses.append(f"Could not be looked up, request them again: {file_list(unresolved)}")
+
+    # One notification for the whole request
+    sns = boto3.client('sns')
+    metrics.count_requests(sns, {'Publish': 'notify'})
+    message = f"Restore request for {len(REQUESTED_FILENAME_SEARCH)} files from {len(archives)} archives:\n" + '\n'.join(statuses)
+    sns.publish(TopicArn=TOPIC_ARN, Message=message)
+    print("SNS message published.")
 
     return {
         'statusCode': 200,
         'body': json.dumps('Restore Request process successfully!')
     }
 
-def get_archive_details(requested_filename,table_name):
+def file_list(files):
+    listed = ', '.join(files[:MESSAGE_FILES])
+    return listed + (f" and {len(files) - MESSAGE_FILES} more" if len(files) > MESSAGE_FILES else "")
+
+def resolve_pattern(PROJECT_NAME, src_bkt, pattern, modified_after, modified_before):
+    # Archived keys matching the pattern and time range, from the manifest index. Only the
+    # archives holding them are restored.
+    after = parse_time(modified_after) if modified_after else None
+    before = parse_time(modified_before) if modified_before else None
     dynamodb_client = boto3.client('dynamodb')
-    response = dynamodb_client.get_item(
-        TableName=table_name,
-        Key={'key': {'S': requested_filename}}
-    )
-    return response
+    s3_client = boto3.client('s3')
+    metrics.count_requests(dynamodb_client, {'Query': 'resolve'})
+    metrics.count_requests(s3_client, {'GetObject': 'resolve'})
+    index = ManifestIndex(dynamodb_client, s3_client, manifest_index_table(PROJECT_NAME), src_bkt)
+    matched = index.match(pattern, after, before, limit=RESTORE_PATTERN_LIMIT)
+    if len(matched) > RESTORE_PATTERN_LIMIT:
+        raise ValueError(f"Pattern '{pattern}' matches more than {RESTORE_PATTERN_LIMIT} files, narrow it down")
+    print(f" Pattern '{pattern}' modified from {after} to {before} matches {len(matched)} files")
+    metrics.phase('resolve').add(items=len(matched))
+    return matched
 
-def initiate_restore(AWS_ACCOUNT_PROVIDED,AWS_REGION_PROVIDED,src_bkt,tarFileName, requested_filename,retrieval_tier,PROJECT_NAME,restore_bkt,TOPIC_ARN):
+def get_archive_details(requested_filenames,table_name):
+    # Returns {tarFileName: [requested files in it]} for the files found in the manifest,
+    # {file: member} for files that were stored as a copy of another archive member, and the
+    # files that could not be looked up
+    dynamodb_client = boto3.client('dynamodb')
+    metrics.count_requests(dynamodb_client, {'BatchGetItem': 'lookup'})
+    archives = {}
+    members = {}
+    unresolved = []
+    for i in range(0, len(requested_filenames), BATCH_GET_LIMIT):
+        keys = [{'key': {'S': f}} for f in requested_filenames[i:i + BATCH_GET_LIMIT]]
+        for attempt in attempts(8):
+            response = dynamodb_client.batch_get_item(
+                RequestItems={table_name: {'Keys': keys, 'ProjectionExpression': '#k, TarFileName, MemberName',
+                                           'ExpressionAttributeNames': {'#k': 'key'}}}
+            )
+            for item in response['Responses'].get(table_name, []):
+                archives.setdefault(item['TarFileName']['S'], []).append(item['key']['S'])
+                if 'MemberName' in item:
+                    members[item['key']['S']] = item['MemberName']['S']
+            keys = response.get('UnprocessedKeys', {}).get(table_name, {}).get('Keys', [])
+            if not keys:
+                break
+        if keys:
+            unresolved.extend(key['key']['S'] for key in keys)
+    if unresolved:
+        print(f"Could not look up {len(unresolved)} files after retries: {unresolved}")
+    # Keep the files of every archive in request order
+    order = {f: n for n, f in enumerate(requested_filenames)}
+    metrics.phase('lookup').add(items=sum(len(files) for files in archives.values()), errors=len(unresolved))
+    return {tar: sorted(files, key=order.get) for tar, files in archives.items()}, members, sorted(unresolved, key=order.get)
+
+def serve_from_cache(cache, tarFileName, requested_filenames, members, restore_bkt):
+    # Returns the files copied from the restore cache into the restore bucket
+    by_member = {}
+    for requested_filename in requested_filenames:
+        by_member.setdefault(members.get(requested_filename, requested_filename), []).append(requested_filename)
+    try:
+        served = cache.serve(tarFileName, by_member, restore_bkt)
+    except ClientError as e:
+        print(f"Restore cache not available: {e}")
+        return []
+    if served:
+        print(f" Copied {served} from the restore cache")
+    metrics.phase('cache').add(items=len(served))
+    return served
+
+def restore_days_for(cache, tarFileName):
+    # Archives requested often stay restored longer, so their next request finds them restored
+    try:
+        requests = cache.record_request(tarFileName)
+    except ClientError as e:
+        print(f"Could not record the request for {tarFileName}: {e}")
+        return RESTORE_MIN_DAYS
+    return restore_days(requests, time.time(), RESTORE_MIN_DAYS, RESTORE_MAX_DAYS)
+
+def extend_restore(s3_restore, src_bkt, tarFileName, restore_status, days):
+    # Restoring an archive that is already restored only moves its expiry. Done when the
+    # archive is requested often enough to be kept longer than it is now.
+    match = re.search(r'expiry-date="([^"]+)"', restore_status)
+    if days <= RESTORE_MIN_DAYS or not match:
+        return
+    wanted = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=days)
+    if parsedate_to_datetime(match.group(1)) >= wanted:
+        return
+    try:
+        s3_restore.restore_object(Bucket=src_bkt, Key=tarFileName, RestoreRequest={'Days': days})
+        print(f"Keeping {tarFileName} restored for {days} days")
+    except ClientError as e:
+        print(f"Could not extend the restore of {tarFileName}: {e}")
+
+def initiate_restore(AWS_ACCOUNT_PROVIDED,AWS_REGION_PROVIDED,src_bkt,tarFileName, requested_filenames,retrieval_tier,PROJECT_NAME,restore_bkt,members,days):
+    # Returns the status of the archive for the request notification
     print('Within initiate restore!!')
     print(f" src bucket : {src_bkt}")
     print(f" tarFileName : {tarFileName}")
-    print(f" requested_filename : {requested_filename}")
+    print(f" requested_filenames : {requested_filenames}")
     print(f" retrieval_tier : {retrieval_tier}")
     print(f" Restore bucket : {restore_bkt}")
     try:
         s3 = boto3.resource('s3')
         obj = s3.Object(src_bkt, tarFileName)
+        metrics.count_requests(obj.meta.client, {'HeadObject': 'restore-request', 'RestoreObject': 'restore-request'})
         head = obj.meta.client.head_object(Bucket=src_bkt, Key=tarFileName)
         print("Head Details =>", head)
         retrieval_tier = retrieval_tier if retrieval_tier in ['Expedited', 'Standard', 'Bulk'] else 'Standard'
-        
+
         if head.get('StorageClass') == 'DEEP_ARCHIVE' and retrieval_tier == 'Expedited':
             retrieval_tier = 'Standard'
-        
+
         print("Retrieval Tier =>", retrieval_tier)
-    
+        print("Restore Days =>", days)
+
         if 'Restore' not in head or head['Restore'] == 'false':
             print('Object to be restored!! Initiating restoration')
             try:
                 s3_restore = boto3.client('s3', config=boto3.session.Config(connect_timeout=60, read_timeout=60))
+                metrics.count_requests(s3_restore, {'RestoreObject': 'restore-request'})
                 print(f"bucket name {src_bkt}")
                 print(f"bucket Key {tarFileName}")
                 response = s3_restore.restore_object(
                     Bucket=src_bkt,
                     Key=tarFileName,
-                    RestoreRequest={'Days': 1, 'GlacierJobParameters': {'Tier': retrieval_tier}}
+                    RestoreRequest={'Days': days, 'GlacierJobParameters': {'Tier': retrieval_tier}}
                 )
                 print("Response for restore:", response)
-                record_restoration(src_bkt, tarFileName, requested_filename,PROJECT_NAME)
-                # SNS Trigger
-                sns = boto3.client('sns')
-                message = f"S3 object {requested_filename} has been requested to restored from Glacier.Please Retry after 12hr"
-                sns.publish(TopicArn=TOPIC_ARN, Message=message)
-                print("SNS message published.")
+                metrics.phase('restore-request').add(items=1)
+                unrecorded = record_restoration(src_bkt, tarFileName, requested_filenames,PROJECT_NAME,restore_bkt,members)
+                return "requested to be restored from Glacier. The files are extracted automatically once the restore completes, in up to 12hr" + unrecorded_status(unrecorded)
 
             except Exception as e:
                 print(f"Error restoring object: {e}")
-        elif head['Restore'] == 'true':
+                return f"restore could not be started: {e}"
+        elif 'ongoing-request="true"' in head['Restore']:
             print('Object restoration is in progress; hence recording for future process')
-            sns = boto3.client('sns')
-            message = f"S3 object {requested_filename} has been requested to restored from Glacier.Please Retry after Sometime"
-            sns.publish(TopicArn=TOPIC_ARN, Message=message)
-            print("SNS message published.")
-            record_restoration(src_bkt, tarFileName, requested_filename,PROJECT_NAME)
+            unrecorded = record_restoration(src_bkt, tarFileName, requested_filenames,PROJECT_NAME,restore_bkt,members)
+            return "restore from Glacier in progress. The files are extracted automatically once it completes" + unrecorded_status(unrecorded)
         else:
             print('Request for already restored archive')
-            submit_batch_job(AWS_ACCOUNT_PROVIDED,AWS_REGION_PROVIDED,src_bkt, tarFileName, requested_filename, os.environ['TOPIC_ARN'],PROJECT_NAME,restore_bkt)
+            extend_restore(obj.meta.client, src_bkt, tarFileName, head['Restore'], days)
+            submit_batch_job(AWS_ACCOUNT_PROVIDED,AWS_REGION_PROVIDED,src_bkt, tarFileName, requested_filenames, os.environ['TOPIC_ARN'],PROJECT_NAME,restore_bkt,members)
+            return "already restored, extraction job submitted"
     except Exception as e:
         print(e)
+        return f"error: {e}"
 
-def record_restoration(src_bkt, tarFileName, requested_filename,PROJECT_NAME):
+def record_restoration(src_bkt, tarFileName, requested_filenames,PROJECT_NAME,restore_bkt,members):
+    # restore-complete-lambda picks these rows up and extracts the files as soon as the restore
+    # of the archive completes. Returns the files whose rows could not be written.
     dynamodb_client = boto3.client('dynamodb')
-    dynamodb_client.batch_write_item(
-        RequestItems={
-            PROJECT_NAME + '_restore_tracker': [
-                {
-                    'PutRequest': {
-                        'Item': {
-                            'key': {'S': requested_filename},
-                            'archive_key': {'S': tarFileName},
-                            's3_bucket': {'S': src_bkt}
-                        }
-                    }
-                }
-            ]
-        }
-    )
-
-def submit_batch_job(AWS_ACCOUNT_PROVIDED,AWS_REGION_PROVIDED,s3_bucket, tarFileName,requested_filename, topic_arn,project_name,restore_bkt):
-    print('Job Submitted for restoring the file!!')
+    metrics.count_requests(dynamodb_client, {'BatchWriteItem': 'record'})
+    table_name = PROJECT_NAME + '_restore_tracker'
+    unrecorded = []
+    for i in range(0, len(requested_filenames), BATCH_WRITE_LIMIT):
+        requests = []
+        for requested_filename in requested_filenames[i:i + BATCH_WRITE_LIMIT]:
+            item = {
+                'key': {'S': requested_filename},
+                'archive_key': {'S': tarFileName},
+                's3_bucket': {'S': src_bkt},
+                'restore_bucket': {'S': restore_bkt},
+                # Passed on to the restorer job once the archive is restored
+                'correlation_id': {'S': metrics.correlation_id}
+            }
+            if requested_filename in members:
+                # Stored as a copy of another member of the archive
+                item['member'] = {'S': members[requested_filename]}
+            requests.append({'PutRequest': {'Item': item}})
+        for attempt in attempts(8):
+            response = dynamodb_client.batch_write_item(RequestItems={table_name: requests})
+            requests = response.get('UnprocessedItems', {}).get(table_name, [])
+            if not requests:
+                break
+        unrecorded.extend(request['PutRequest']['Item']['key']['S'] for request in requests)
+    if unrecorded:
+        print(f"Could not record {len(unrecorded)} files of {tarFileName} after retries, they won't be extracted: {unrecorded}")
+    metrics.phase('record').add(items=len(requested_filenames) - len(unrecorded), errors=len(unrecorded))
+    return unrecorded
+
+def unrecorded_status(unrecorded):
+    if not unrecorded:
+        return ""
+    return f". {len(unrecorded)} files could not be recorded and won't be extracted, request them again: {file_list(unrecorded)}"
+
+def submit_batch_job(AWS_ACCOUNT_PROVIDED,AWS_REGION_PROVIDED,s3_bucket, tarFileName,requested_filenames, topic_arn,project_name,restore_bkt,members):
+    # One restorer job extracts every requested member of the archive in a single pass
+    print('Job Submitted for restoring the files!!')
     job_queue = os.environ['JOB_QUEUE']
     job_definition = os.environ['JOB_DEFINITION']
 
     batch_client = boto3.client('batch')
-    batch_client.submit_job(
-        jobName=str(int(time.time())),
-        jobQueue=job_queue,
-        jobDefinition=job_definition,
-        containerOverrides={
-            'command': ['python3', 'restore.py'],
-            'environment': [
-                {'name': 'PROJECT_NAME', 'value': project_name},
-                {'name': 'SRC_BUCKET_NAME', 'value': s3_bucket},
-                {'name': 'RESTORE_BUCKET_NAME', 'value': restore_bkt},
-                {'name': 'AWS_ACCOUNT', 'value': AWS_ACCOUNT_PROVIDED},
-                {'name': 'AWS_REGION', 'value': AWS_REGION_PROVIDED},
-                {'name': 'ARCHIVE_KEY', 'value': tarFileName},
-                {'name': 'KEY', 'value': requested_filename},
-                {'name': 'TOPIC_ARN', 'value': topic_arn}
-            ]
-        }
-    )
\ No newline at end of file
+    metrics.count_requests(batch_client, {'SubmitJob': 'submit'})
+    for keys in key_chunks(requested_filenames, members):
+        batch_client.submit_job(
+            jobName=str(int(time.time())),
+            jobQueue=job_queue,
+            jobDefinition=job_definition,
+            containerOverrides={
+                'command': ['python3', 'restore.py'],
+                'environment': [
+                    {'name': 'PROJECT_NAME', 'value': project_name},
+                    {'name': 'SRC_BUCKET_NAME', 'value': s3_bucket},
+                    {'name': 'RESTORE_BUCKET_NAME', 'value': restore_bkt},
+                    {'name': 'AWS_ACCOUNT', 'value': AWS_ACCOUNT_PROVIDED},
+                    {'name': 'AWS_REGION', 'value': AWS_REGION_PROVIDED},
+                    {'name': 'ARCHIVE_KEY', 'value': tarFileName},
+                    {'name': 'KEYS', 'value': json.dumps(keys)},
+                    # Files stored as a copy of another member are extracted from that member
+                    {'name': 'MEMBERS', 'value': json.dumps({k: members[k] for k in keys if k in members})},
+                    {'name': 'TOPIC_ARN', 'value': topic_arn},
+                    {'name': 'CORRELATION_ID', 'value': metrics.correlation_id}
+                ]
+            }
+        )
@@ -0,0 +1,77 @@
+import os
+import boto3
+from botocore.exceptions import ClientError
+
+from planner import read_plan
+from run_results import advance_watermark, plan_key, read_result, shard_result_key, summary_key, write_result
+
+# Final job of a sharded run: collects the results the archiving shards stored next to the plan
+PROJECT_NAME = os.environ['PROJECT_NAME']
+DEST_BUCKET = os.environ['DEST_BUCKET_NAME']
+RUN_ID = os.environ['RUN_ID']
+SHARD_COUNT = int(os.environ['SHARD_COUNT'])
+INCREMENTAL = os.environ.get('INCREMENTAL', 'false').lower() == 'true'
+
+print(f"Aggregating run {RUN_ID} of {PROJECT_NAME} over {SHARD_COUNT} shards")
+
+s3 = boto3.client('s3')
+
+try:
+    plan = read_plan(s3, DEST_BUCKET, plan_key(PROJECT_NAME, RUN_ID))
+    results = [read_result(s3, DEST_BUCKET, shard_result_key(PROJECT_NAME, RUN_ID, shard))
+               for shard in range(SHARD_COUNT)]
+except ClientError as e:
+    print(f"Error reading the results of run {RUN_ID}: {e}")
+    exit(1)
+
+missing_shards = [shard for shard, result in enumerate(results) if result is None]
+results = [result for result in results if result is not None]
+for result in results:
+    print(f"Shard {result['shard']}: {len(result['created'])} archives created, {len(result['failed'])} failed, "
+          f"{result['files']} files, {result['bytes'] / (1024 * 1024):.2f} MB, {result['deleted']} sources deleted")
+
+# Archives no shard reported on belong to a shard that did not finish
+reported = {number for result in results for number in result['archives']}
+unreported = [number for number in range(1, len(plan) + 1) if number not in reported]
+summary = {
+    'run_id': RUN_ID,
+    'shards': SHARD_COUNT,
+    'planned_archives': len(plan),
+    'planned_files': sum(len(archive['objects']) for archive in plan),
+    'created': sorted(name for result in results for name in result['created']),
+    'failed': sorted(name for result in results for name in result['failed']),
+    'undeleted': sorted(name for result in results for name in result['undeleted']),
+    'missing_shards': missing_shards,
+    'unreported_archives': unreported,
+    'files': sum(result['files'] for result in results),
+    'bytes': sum(result['bytes'] for result in results),
+    'deleted': sum(result['deleted'] for result in results),
+    'delete_failed': sum(result['delete_failed'] for result in results),
+    'manifest_rows': sum(result['manifest_rows'] for result in results)
+}
+
+try:
+    write_result(s3, DEST_BUCKET, summary_key(PROJECT_NAME, RUN_ID), summary)
+except ClientError as e:
+    print(f"Error storing the summary of run {RUN_ID}: {e}")
+
+print(f"Run {RUN_ID}: created {len(summary['created'])} of {summary['planned_archives']} archives, "
+      f"{summary['files']} of {summary['planned_files']} files, {summary['bytes'] / (1024 * 1024):.2f} MB")
+print(f"Deleted {summary['deleted']} source files, {summary['delete_failed']} failed")
+if missing_shards:
+    print(f"Shards without a result: {', '.join(str(shard) for shard in missing_shards)}")
+if summary['undeleted']:
+    print(f"Archives with source files left to delete: {', '.join(summary['undeleted'])}")
+if summary['failed'] or summary['undeleted'] or missing_shards:
+    print(f"Failed archives: {', '.join(summary['failed'])}")
+    exit(1)
+if INCREMENTAL:
+    # Every shard succeeded, the next incremental run of the prefix starts after this one
+    try:
+        watermark = advance_watermark(s3, DEST_BUCKET, PROJECT_NAME, RUN_ID)
+    except ClientError as e:
+        print(f"Error moving the watermark of run {RUN_ID}: {e}")
+        exit(1)
+    if watermark is not None:
+        print(f"Watermark of {watermark['prefix']}: {watermark['start_after']} (run {watermark['run_id']})")
+print(f"Run {RUN_ID} Completed")
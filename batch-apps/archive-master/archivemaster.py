@@ -1,10 +1,34 @@
 import os
+import io
+import atexit
 import tarfile
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
-import gzip
-import shutil
 import datetime
+import multiprocessing
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from decimal import Decimal
+
+from archive_index import ArchiveIndexBuilder, HashingReader, load_index, write_index
+from catalog import ObjectCatalog
+from compressibility import STORED, classify, peek
+from dedup import ContentIndex
+from compression import ParallelCompressor, archive_extension, check_codec, compression_workers
+from journal import ArchiveJournal, MANIFEST_COMMITTED, PLANNED, SOURCES_DELETED, UPLOADED
+from manifest_index import ManifestIndex, manifest_index_table
+from manifest_writer import ManifestWriter
+from metrics import FileLog, Metrics
+from object_source import list_objects_sharded, read_inventory
+from pipeline import ByteBudget, Prefetcher, StageStats, TimedReader, report_stages
+from planner import plan_archives, print_plan, read_plan, shard_archives, write_plan
+from run_results import (advance_watermark, duplicates_key, pending_watermark_key, plan_key, read_result,
+                         shard_result_key, skipped_key, watermark_key, write_result)
+from s3_multipart import MultipartUploadWriter, part_size_for
+from s3_transfer import AdaptiveLimiter, AdaptiveS3Client, spread_by_prefix, transfer_config
+from source_cleanup import SourceDeleter
 
 PROJECT_NAME=os.environ['PROJECT_NAME']
 SOURCE_BUCKET = os.environ['SRC_BUCKET_NAME'] 
@@ -14,6 +38,53 @@ now = datetime.datetime.now()
 FILE_SIZE_LIMIT = int(os.environ['ARCHIVE_SIZE']) 
 FILE_COUNT_LIMIT = int(os.environ['FILE_COUNT'])
 DYNAMODB_TABLE_NAME = os.environ['PROJECT_NAME'] + '_archive_master'
+JOURNAL_TABLE_NAME = os.environ['PROJECT_NAME'] + '_archive_journal'
+MANIFEST_INDEX_TABLE_NAME = manifest_index_table(os.environ['PROJECT_NAME'])
+# Memory used for read-ahead and in-flight multipart parts while streaming archives
+STREAM_MEMORY_MB = int(os.environ.get('STREAM_MEMORY_MB', '512'))
+PART_SIZE_MB = int(os.environ.get('PART_SIZE_MB', '16'))
+INLINE_READ_LIMIT = 8 * 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+COMPRESSION_CODEC = os.environ.get('COMPRESSION_CODEC', 'gzip')
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', '6'))
+COMPRESSION_WORKERS = int(os.environ.get('COMPRESSION_WORKERS', compression_workers()))
+# Store files that are compressed already (media, archives, columnar data) or that don't shrink
+# in a trial on their first bytes, instead of spending compression CPU on them
+DETECT_INCOMPRESSIBLE = os.environ.get('DETECT_INCOMPRESSIBLE', 'true').lower() == 'true'
+MANIFEST_WRITERS = int(os.environ.get('MANIFEST_WRITERS', '4'))
+DELETE_THREADS = int(os.environ.get('DELETE_THREADS', '8'))
+LIST_THREADS = int(os.environ.get('LIST_THREADS', '16'))
+# Memory for the object catalog; beyond it the catalog moves to a SQLite file in CATALOG_DIR
+CATALOG_MEMORY_MB = int(os.environ.get('CATALOG_MEMORY_MB', '256'))
+CATALOG_DIR = os.environ.get('CATALOG_DIR') or None
+# Bounds of the adaptive limit on S3 requests in flight while archiving
+S3_INITIAL_CONCURRENCY = int(os.environ.get('S3_INITIAL_CONCURRENCY', '16'))
+S3_MAX_CONCURRENCY = int(os.environ.get('S3_MAX_CONCURRENCY', '128'))
+# s3://bucket/key of an S3 Inventory manifest.json to read the objects from instead of listing
+INVENTORY_MANIFEST = os.environ.get('INVENTORY_MANIFEST')
+# Keep every archive to the objects of a single subfolder
+GROUP_BY_SUBFOLDER = os.environ.get('GROUP_BY_SUBFOLDER', 'false').lower() == 'true'
+# Store every distinct content once: copies of content already archived (by this run or an
+# earlier one) are recorded in the manifest as pointers to the archive member holding it
+DEDUP = os.environ.get('DEDUP', 'false').lower() == 'true'
+# Leave objects modified in the last MIN_AGE_DAYS days in place
+MIN_AGE_DAYS = float(os.environ['MIN_AGE_DAYS']) if os.environ.get('MIN_AGE_DAYS') else None
+# List only the keys after the prefix's watermark, and move the watermark once the run succeeds
+INCREMENTAL = os.environ.get('INCREMENTAL', 'false').lower() == 'true'
+# Only print the archive plan, nothing is uploaded or deleted
+DRY_RUN = os.environ.get('DRY_RUN', 'false').lower() == 'true'
+# Every run stores its plan and tracks the progress of each archive in the journal table, so a
+# job restarted with the same RUN_ID resumes where the previous attempt stopped. Sharded runs:
+# a planning job (PLAN_ONLY) lists and plans the prefix and stores the plan, then every child
+# of an AWS Batch array job archives its share of that plan. All jobs of the run share RUN_ID,
+# which also goes into the archive names.
+RUN_ID = os.environ.get('RUN_ID') or f"{now:%Y%m%d%H%M%S}-{uuid.uuid4()}"
+# What the plan of the run is made for, a stored plan of another source is not resumed
+PLAN_SOURCE = {'bucket': SOURCE_BUCKET, 'prefix': SOURCE_PREFIX}
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '1'))
+PLAN_ONLY = os.environ.get('PLAN_ONLY', 'false').lower() == 'true'
+# Set by AWS Batch on every child of an array job
+SHARD_INDEX = os.environ.get('AWS_BATCH_JOB_ARRAY_INDEX')
 
 print(f"Selected Project Name: {PROJECT_NAME}")
 print(f"Source Bucket: {SOURCE_BUCKET}")
@@ -21,269 +92,652 @@ print(f"Destination Bucket: {DEST_BUCKET}")
 print(f"Requested File Size Limit: {FILE_SIZE_LIMIT}")
 print(f"Requested File Count Limit: {FILE_COUNT_LIMIT}")
 print(f"MetaData Will be stored in: {DYNAMODB_TABLE_NAME}")
+print(f"Streaming Memory Budget: {STREAM_MEMORY_MB} MB")
+print(f"Compression: {COMPRESSION_CODEC} level {COMPRESSION_LEVEL} on {COMPRESSION_WORKERS} workers"
+      + (", incompressible files stored" if DETECT_INCOMPRESSIBLE else ""))
+if MIN_AGE_DAYS is not None:
+    print(f"Age policy: only objects last modified more than {MIN_AGE_DAYS:g} days ago are archived")
+if INCREMENTAL:
+    print(f"Incremental run: only keys after the watermark of {SOURCE_PREFIX} are listed")
+if DEDUP:
+    print("Deduplication: copies of content that is already archived are not stored again")
+if SHARD_INDEX is not None or PLAN_ONLY:
+    print(f"Sharded run {RUN_ID}: {'planning' if PLAN_ONLY else f'shard {SHARD_INDEX}'} of {SHARD_COUNT} shards")
+
+try:
+    check_codec(COMPRESSION_CODEC, COMPRESSION_LEVEL)
+except ValueError as e:
+    print(f"Invalid compression settings: {e}")
+    exit(1)
+
+# Fork the compression workers now, while this process is still single threaded
+compression_pool = ProcessPoolExecutor(max_workers=COMPRESSION_WORKERS, mp_context=multiprocessing.get_context('fork'))
+compression_pool.submit(int).result()
+
+# Create S3 client, with a connection for every listing thread
+s3 = boto3.client('s3', config=Config(max_pool_connections=LIST_THREADS + 4))
+journal = ArchiveJournal(boto3.client('dynamodb'), JOURNAL_TABLE_NAME, RUN_ID)
+# Listing metadata of every object of the job, whether listed or read from a stored plan
+catalog = ObjectCatalog(memory_limit=CATALOG_MEMORY_MB * 1024 * 1024, spill_dir=CATALOG_DIR)
+atexit.register(catalog.close)
+processed_files = 0
+archived_bytes = 0
+# Time, bytes and requests of every phase, emitted as CloudWatch Embedded Metric Format however
+# the job ends. Lines about single files are sampled, LOG_LEVEL=DEBUG prints all of them.
+metrics = Metrics('archive', RunId=RUN_ID, Shard=SHARD_INDEX)
+metrics.count_requests(s3, {'ListObjectsV2': 'list'})
+file_log = FileLog()
+
+
+def emit_metrics():
+    metrics.emit(archived_bytes, processed_files)
+
+
+atexit.register(emit_metrics)
+
+
+def load_stored_plan():
+    # The plan an earlier attempt of this run stored, None for a new run
+    try:
+        return read_plan(s3, DEST_BUCKET, plan_key(PROJECT_NAME, RUN_ID), catalog, source=PLAN_SOURCE)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
 
-# Create S3 client
-s3 = boto3.client('s3')
 
-# List objects in the source prefix
-print("Start Collecting files from S3")
-# List all objects in the bucket in batches
-all_objects = []
-continuation_token = None
-batch_count = 0
+def archive_name_for(archive_number):
+    # The run id and the position in the plan make the name unique across all shards of a run,
+    # and the same on every attempt of the run
+    return f"{PROJECT_NAME}_{RUN_ID}_part{archive_number}{archive_extension(COMPRESSION_CODEC)}"
+
 
 try:
-    while True:
-        # If we have a continuation token, include it in the request
-        if continuation_token:
-            response = s3.list_objects_v2(
-                Bucket=SOURCE_BUCKET,
-                Prefix=SOURCE_PREFIX,
-                MaxKeys=1000,  # AWS limit is 1000 per request
-                ContinuationToken=continuation_token
-            )
-        else:
-            response = s3.list_objects_v2(
-                Bucket=SOURCE_BUCKET,
-                Prefix=SOURCE_PREFIX,
-                MaxKeys=1000  # AWS limit is 1000 per request
-            )
-        
-        # Get the objects from this batch
-        batch_objects = response.get('Contents', [])
-        batch_count += 1
-        
-        # Filter out directory-like objects (ending with / and 0 bytes)
-        filtered_batch = [obj for obj in batch_objects if not (obj['Key'].endswith('/') and obj['Size'] == 0)]
-        
-        if filtered_batch:
-            all_objects.extend(filtered_batch)
-            print(f"Batch {batch_count}: Retrieved {len(filtered_batch)} files")
-        
-        # Check if there are more objects to retrieve
-        if response.get('IsTruncated'):
-            continuation_token = response.get('NextContinuationToken')
+    plan = None if DRY_RUN else load_stored_plan()
+except (ClientError, ValueError) as e:
+    print(f"Error reading the plan of run {RUN_ID}: {e}")
+    exit(1)
+if plan is not None:
+    print(f"Resuming run {RUN_ID} from its stored plan of {len(plan)} archives")
+    total_objects = sum(len(archive['objects']) for archive in plan)
+elif SHARD_INDEX is not None:
+    print(f"Run {RUN_ID} has no stored plan, its planning job has to finish first")
+    exit(1)
+else:
+    # List objects in the source prefix
+    print("Start Collecting files from S3")
+    # Objects go into the catalog with their subfolder as they stream in from the listing
+    # threads or the inventory report, it is the only copy of the listing the job keeps
+    total_objects = 0
+    # Objects still too recent for the age policy, and the first of them in key order
+    recent_objects = 0
+    first_recent_key = None
+    age_cutoff = None
+    if MIN_AGE_DAYS is not None:
+        age_cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=MIN_AGE_DAYS)
+    start_after = None
+    listing_started = time.monotonic()
+
+    try:
+        if INCREMENTAL:
+            watermark = read_result(s3, DEST_BUCKET, watermark_key(PROJECT_NAME, SOURCE_PREFIX))
+            start_after = watermark['start_after'] if watermark else None
+            print(f"Listing {SOURCE_PREFIX} after {start_after}, archived by run {watermark['run_id']}" if start_after
+                  else f"No watermark for {SOURCE_PREFIX} yet, listing all of it")
+        if INVENTORY_MANIFEST:
+            print(f"Reading the object list from inventory {INVENTORY_MANIFEST}")
+            source_objects = read_inventory(s3, INVENTORY_MANIFEST, SOURCE_BUCKET, SOURCE_PREFIX, threads=LIST_THREADS,
+                                            start_after=start_after)
         else:
-            break
-    
-    # Organize objects by subfolder
-    objects_by_subfolder = {}
-    for obj in all_objects:
-        key = obj['Key']
-        # Skip the prefix itself if it's returned
-        if key == SOURCE_PREFIX:
-            continue
-            
-        # Skip directory-like objects (ending with / and 0 bytes)
-        if key.endswith('/') and obj['Size'] == 0:
-            continue
+            source_objects = list_objects_sharded(s3, SOURCE_BUCKET, SOURCE_PREFIX, threads=LIST_THREADS,
+                                                  start_after=start_after)
+
+        # Organize objects by subfolder
+        for obj in source_objects:
+            key = obj['Key']
+            # Skip the prefix itself if it's returned
+            if key == SOURCE_PREFIX:
+                continue
+                
+            # Skip directory-like objects (ending with / and 0 bytes)
+            if key.endswith('/') and obj['Size'] == 0:
+                continue
+            if age_cutoff is not None and obj['LastModified'] > age_cutoff:
+                recent_objects += 1
+                if first_recent_key is None or key < first_recent_key:
+                    first_recent_key = key
+                continue
+            total_objects += 1
+                
+            # Remove the main prefix to get relative path
+            relative_path = key[len(SOURCE_PREFIX):]
             
-        # Remove the main prefix to get relative path
-        relative_path = key[len(SOURCE_PREFIX):]
+            # Get the subfolder (first part of the path)
+            parts = relative_path.split('/')
+            if len(parts) > 1:
+                catalog.add(obj, parts[0])
+            else:
+                # Files directly in the main prefix (no subfolder)
+                catalog.add(obj, 'root')
+        metrics.phase('list').add(time.monotonic() - listing_started, items=total_objects + recent_objects)
+        
+        # Print objects by subfolder
+        print(f"\nObjects by subfolder in {SOURCE_PREFIX}:")
+        for subfolder, count in catalog.subfolders().items():
+            print(f"\n{subfolder}/ ({count} objects):")
+            for obj in catalog.get_many(catalog.rows(subfolder, limit=10)):  # Limit display to 10 objects per subfolder
+                print(f"  - {obj['Key']} ({obj['Size']} bytes)")
+            if count > 10:
+                print(f"  ... and {count - 10} more objects")
+                
+        print(f"\nTotal files found: {total_objects}")
+        if age_cutoff is not None:
+            print(f"Left {recent_objects} files modified after {age_cutoff:%Y-%m-%d %H:%M} UTC in place")
+        print(f"Object catalog: {len(catalog)} objects, " + (f"spilled to {catalog.spill_path}" if catalog.spilled
+              else f"{catalog.memory_bytes() / (1024 * 1024):.2f} MB in memory"))
         
-        # Get the subfolder (first part of the path)
-        parts = relative_path.split('/')
-        if len(parts) > 1:
-            subfolder = parts[0]
-            if subfolder not in objects_by_subfolder:
-                objects_by_subfolder[subfolder] = []
-            objects_by_subfolder[subfolder].append(obj)
+    except (ClientError, ValueError) as e:
+        print(f"Error listing objects: {e}")
+        exit(1)
+
+    print(f"Found {total_objects} files in {SOURCE_BUCKET}/{SOURCE_PREFIX}")
+
+    if INCREMENTAL:
+        # The watermark moves to the last listed key before the first object that is still too
+        # recent, which the next run lists again. Keys are compared as S3 sorts them (UTF-8
+        # bytes), which matches Python's ordering of the decoded strings.
+        next_start_after = start_after
+        for obj in catalog.objects(range(len(catalog))):
+            key = obj['Key']
+            if (first_recent_key is None or key < first_recent_key) and (next_start_after is None or key > next_start_after):
+                next_start_after = key
+
+    # Plan every archive from the listing metadata before anything is downloaded
+    plan = plan_archives(catalog, FILE_SIZE_LIMIT * 1024 * 1024, FILE_COUNT_LIMIT,
+                         group_by_subfolder=GROUP_BY_SUBFOLDER)
+    print_plan(plan, FILE_SIZE_LIMIT * 1024 * 1024, FILE_COUNT_LIMIT, limit=None if DRY_RUN else 10)
+    if DRY_RUN:
+        print("Dry run requested, no archive created")
+        compression_pool.shutdown()
+        exit(0)
+    # The journal rows are written before the plan: a stored plan means the run is resumable
+    try:
+        if INCREMENTAL:
+            write_result(s3, DEST_BUCKET, pending_watermark_key(PROJECT_NAME, RUN_ID), {
+                'prefix': SOURCE_PREFIX,
+                'start_after': next_start_after,
+                'run_id': RUN_ID,
+                'planned': datetime.datetime.now(datetime.timezone.utc).isoformat()
+            })
+        journal.record_planned([(archive_name_for(number), number, len(archive['objects']), archive['size'])
+                                for number, archive in enumerate(plan, start=1)])
+        write_plan(s3, DEST_BUCKET, plan_key(PROJECT_NAME, RUN_ID), plan, spill_dir=CATALOG_DIR, source=PLAN_SOURCE)
+    except (ClientError, RuntimeError) as e:
+        print(f"Error storing the plan of run {RUN_ID}: {e}")
+        exit(1)
+    print(f"Stored the plan of run {RUN_ID} in {DEST_BUCKET}/{plan_key(PROJECT_NAME, RUN_ID)}")
+
+if PLAN_ONLY:
+    print(f"Run {RUN_ID} is planned for {SHARD_COUNT} shards")
+    compression_pool.shutdown()
+    exit(0)
+if SHARD_INDEX is None:
+    archives = list(enumerate(plan, start=1))
+else:
+    # A child of the array job: archive this shard's share of the plan stored by the planning job
+    archives = shard_archives(plan, SHARD_COUNT, int(SHARD_INDEX))
+    total_objects = sum(len(archive['objects']) for _, archive in archives)
+    print(f"Shard {SHARD_INDEX} archives {len(archives)} of the {len(plan)} archives planned for run {RUN_ID}: "
+          f"{total_objects} files, "
+          f"{sum(archive['size'] for _, archive in archives) / (1024 * 1024):.2f} MB")
+
+# Size the pipeline from the memory budget: half of it for source objects read ahead of the
+# packer, the other half for multipart parts waiting to be uploaded. The archive being packed
+# and the one being finished upload at the same time, so each gets half of the upload share.
+def upload_sizing(archive_size):
+    # Part size and parts in flight for an archive. A single object larger than ARCHIVE_SIZE
+    # gets an archive of its own, its parts grow so that it stays under the S3 part limit.
+    part_size = part_size_for(max(archive_size, FILE_SIZE_LIMIT * 1024 * 1024), PART_SIZE_MB * 1024 * 1024)
+    return part_size, max(1, (STREAM_MEMORY_MB * 1024 * 1024 // 4) // part_size - 1)
+
+
+part_size, upload_inflight = upload_sizing(0)
+read_ahead_budget = ByteBudget(STREAM_MEMORY_MB * 1024 * 1024 // 2)
+print(f"Streaming with memory budget {STREAM_MEMORY_MB} MB: part size {part_size // (1024 * 1024)} MB, "
+      f"{upload_inflight} parts in flight per archive, S3 concurrency {S3_INITIAL_CONCURRENCY} "
+      f"adapting up to {S3_MAX_CONCURRENCY}")
+
+# Downloads, part uploads and deletes share one limit on requests in flight, which grows while
+# S3 keeps up and halves on SlowDown. The read-ahead window can use all of it, memory is held
+# by the byte budget. Streamed bodies still being read keep their connection after the
+# request returns, the pool has room for those as well.
+transfer_limiter = AdaptiveLimiter(initial=S3_INITIAL_CONCURRENCY, maximum=S3_MAX_CONCURRENCY)
+read_ahead_window = S3_MAX_CONCURRENCY
+s3_stream = AdaptiveS3Client(
+    boto3.session.Session().client('s3', config=transfer_config(
+        S3_MAX_CONCURRENCY, extra_connections=read_ahead_budget.limit // INLINE_READ_LIMIT + 8)),
+    transfer_limiter
+)
+
+# Reported at the end of the run, with how long the packer was held up by each stage
+download_stats = StageStats('download')
+compress_stats = StageStats('compress')
+upload_stats = StageStats('upload')
+finalize_stats = StageStats('finalize (complete upload, manifest, delete)')
+
+
+def open_source_object(obj):
+    # Small objects are read fully so the download overlaps with packing of earlier ones,
+    # larger ones are handed over as the open response stream. Objects deleted since they were
+    # listed (or since the inventory report was produced) come back without a body. Streamed
+    # bodies are read by the packer, their download time counts towards packing.
+    with metrics.phase('download').timed(items=1):
+        try:
+            response = s3_stream.get_object(Bucket=SOURCE_BUCKET, Key=obj['Key'])
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return obj, 0, None
+            raise
+        body = response['Body']
+        if response.get('ServerSideEncryption', '').startswith('aws:kms'):
+            # Its ETag says nothing about the content, dedup hashes it instead
+            obj = dict(obj, ServerSideEncryption=response['ServerSideEncryption'])
+        if response['ContentLength'] <= INLINE_READ_LIMIT:
+            body = io.BytesIO(body.read())
+        return obj, response['ContentLength'], body
+
+
+def read_ahead_cost(obj):
+    # Streamed bodies hold a connection rather than memory, but still count as one inline read
+    return min(obj['Size'], INLINE_READ_LIMIT)
+
+
+def pack_archive(archive_number, archive_name, batch, archive_size):
+    # Stream the prefetched objects of the archive into a tar that is compressed block by block
+    # on the compression pool and uploaded while it is being written. Returns what
+    # finalize_archive needs once every block has been handed to the uploader; the upload is
+    # aborted if packing fails.
+    global stored_files, stored_bytes, compress_seconds, compressed_raw_bytes
+    pack_started = time.monotonic()
+    current_size = 0
+    archived = []
+    duplicates = {}
+    content_rows = []
+    policies = {}
+    if content_index is not None:
+        content_index.preload(batch)
+    index_builder = ArchiveIndexBuilder(archive_name, COMPRESSION_CODEC)
+    archive_part_size, archive_inflight = upload_sizing(archive_size)
+    uploader = MultipartUploadWriter(s3_stream, DEST_BUCKET, archive_name, archive_part_size,
+                                     max_inflight=archive_inflight, StorageClass='DEEP_ARCHIVE')
+    try:
+        # Lets a restarted run abort the upload if this job dies before completing it
+        journal.note(archive_name, upload_id=uploader.upload_id)
+        compressor = ParallelCompressor(uploader, compression_pool, COMPRESSION_CODEC, COMPRESSION_LEVEL)
+        with tarfile.open(fileobj=compressor, mode='w|', copybufsize=COPY_BUFFER_SIZE) as tar:
+            for obj, size, body, reserved in prefetcher.take(archive_number):
+                try:
+                    if body is None:
+                        file_log(f"Skipping {obj['Key']}, it no longer exists")
+                        continue
+                    if content_index is not None:
+                        target, sha256 = content_index.find(obj, body)
+                        if target is not None:
+                            file_log(f"{obj['Key']} has the same content as {target[1]} in {target[0]}, not stored again")
+                            duplicates[obj['Key']] = target
+                            content_index.duplicate(size)
+                            body.close()
+                            continue
+                    if not isinstance(body, io.BytesIO):
+                        body = TimedReader(body, download_stats)
+                    # Members and manifest rows carry the full key, so files with the same name in
+                    # different subfolders stay apart and can be found by prefix
+                    file = obj['Key']
+                    attrs = {}
+                    if DETECT_INCOMPRESSIBLE:
+                        head, body = peek(body)
+                        policy, ratio, reason = classify(file, head)
+                        attrs['compression'] = policy
+                        if ratio is not None:
+                            attrs['ratio'] = round(ratio, 3)
+                        if policy == STORED:
+                            file_log(f"Storing {file} uncompressed: {reason}")
+                            stored_files += 1
+                        policies[file] = attrs
+                        # The member, from its header on, gets blocks of its own when stored
+                        compressor.store_from(tar.offset, policy == STORED)
+                    tarinfo = tarfile.TarInfo(name=file)
+                    tarinfo.size = size
+                    tarinfo.mtime = obj['LastModified'].timestamp()
+                    member_start = tar.offset
+                    reader = HashingReader(body)
+                    tar.addfile(tarinfo, fileobj=reader)
+                    index_builder.add(file, member_start, tar.offset, size, reader.hexdigest(), **attrs)
+                    if content_index is not None:
+                        content_rows.extend(content_index.add(obj, reader.hexdigest(), archive_name, file))
+                finally:
+                    read_ahead_budget.release(reserved)
+                current_size += size
+                archived.append(obj)
+                file_log(f"Archive {archive_name}: {len(archived)} files, {current_size} bytes")
+        compressor.close()
+    except Exception:
+        uploader.abort()
+        if content_index is not None:
+            content_index.forget(archive_name)
+        raise
+    metrics.phase('pack').add(time.monotonic() - pack_started, current_size, len(archived))
+    compress_stats.add(compressor.raw_bytes)
+    compress_stats.waited(compressor.wait_seconds)
+    upload_stats.waited(uploader.wait_seconds)
+    stored_bytes += compressor.stored_bytes
+    compress_seconds += compressor.compress_seconds
+    compressed_raw_bytes += compressor.compressed_raw_bytes
+    if not archived:
+        # Every file was missing or a copy of archived content, there is nothing to store
+        uploader.abort()
+        print(f"Archive {archive_name}: not stored, none of its {len(batch)} files is new content")
+        return None, compressor, index_builder, archived, duplicates, content_rows, policies
+    print(f"Archive {archive_name}: Added {len(archived)} files, size: {current_size/1024:.2f} KB, "
+          f"compressed: {uploader.bytes_written/1024:.2f} KB"
+          + (f", {compressor.stored_bytes/1024:.2f} KB stored uncompressed" if compressor.stored_bytes else "")
+          + (f", {len(duplicates)} copies of archived content left out" if duplicates else ""))
+    return uploader, compressor, index_builder, archived, duplicates, content_rows, policies
+
+
+def stored_policies(index):
+    # Compression policies of an archive packed by an earlier attempt, from its index
+    members = index['members'] if index else []
+    return {member['name']: {attr: member[attr] for attr in ('compression', 'ratio') if attr in member}
+            for member in members if 'compression' in member}
+
+
+def stored_content_rows(archive_name, archived, index):
+    # Content rows of an archive packed by an earlier attempt, with the SHA-256 of its members
+    # taken from its index
+    hashes = {member['name']: member['sha256'] for member in index['members']} if index else {}
+    rows = []
+    for obj in archived:
+        rows.extend(content_index.add(obj, hashes.get(obj['Key']), archive_name, obj['Key']))
+    return rows
+
+
+def manifest_row(file, archive_name, policies):
+    row = {'key': file, 'TarFileName': archive_name}
+    attrs = policies.get(file, {})
+    if 'compression' in attrs:
+        row['Compression'] = attrs['compression']
+    if 'ratio' in attrs:
+        # DynamoDB numbers go through Decimal
+        row['CompressionRatio'] = Decimal(str(attrs['ratio']))
+    return row
+
+
+def finalize_archive(archive_name, batch, state, progress, packed=None):
+    # Runs on the finalizer thread while the next archive is packed. Completes and checks the
+    # upload of a packed archive, then commits its manifest and deletes its sources, recording
+    # every step in the journal. Archives resumed past the upload start at their next step.
+    global archived_bytes, processed_files
+    try:
+        if packed is not None:
+            uploader, compressor, index_builder, archived, duplicates, content_rows, policies = packed
+            if uploader is not None:
+                uploader.close()
+                uploader.verify()
+                upload_stats.add(uploader.bytes_written)
+                metrics.phase('upload').add(nbytes=uploader.bytes_written, items=1)
+                try:
+                    write_index(s3_stream, DEST_BUCKET, archive_name, index_builder.build(compressor))
+                except ClientError as e:
+                    # Restores of this archive fall back to reading it in full
+                    print(f"Error uploading index of {archive_name}: {e}")
+                print(f"Uploaded {archive_name} to {DEST_BUCKET}")
+            # Too many to fit in a journal row, copies and skipped objects are kept next to the
+            # plan of the run and the journal only counts them
+            if duplicates:
+                write_result(s3_stream, DEST_BUCKET, duplicates_key(PROJECT_NAME, RUN_ID, archive_name), duplicates)
+            archived_keys = {obj['Key'] for obj in archived}
+            skipped = [obj['Key'] for obj in batch if obj['Key'] not in archived_keys and obj['Key'] not in duplicates]
+            if skipped:
+                write_result(s3_stream, DEST_BUCKET, skipped_key(PROJECT_NAME, RUN_ID, archive_name), skipped)
+            journal.advance(archive_name, UPLOADED, files=len(archived) + len(duplicates),
+                            duplicates=len(duplicates), skipped=len(skipped))
         else:
-            # Files directly in the main prefix (no subfolder)
-            if 'root' not in objects_by_subfolder:
-                objects_by_subfolder['root'] = []
-            objects_by_subfolder['root'].append(obj)
-    
-    # Print objects by subfolder
-    print(f"\nObjects by subfolder in {SOURCE_PREFIX}:")
-    for subfolder, subfolder_objects in objects_by_subfolder.items():
-        print(f"\n{subfolder}/ ({len(subfolder_objects)} objects):")
-        for obj in subfolder_objects[:10]:  # Limit display to 10 objects per subfolder
-            print(f"  - {obj['Key']} ({obj['Size']} bytes)")
-        if len(subfolder_objects) > 10:
-            print(f"  ... and {len(subfolder_objects) - 10} more objects")
-            
-    objects = all_objects[:FILE_COUNT_LIMIT]  # Limit to the requested file count
-    print(f"\nTotal files found: {len(all_objects)}")
-    print(f"Files to process (limited by FILE_COUNT_LIMIT): {len(objects)}")
-    
-except ClientError as e:
-    print(f"Error listing objects: {e}")
-    exit(1)
+            # Objects missing when the archive was packed were recorded as skipped, copies of
+            # archived content with the member holding it
+            skipped = set()
+            if int(progress.get('skipped', 0)):
+                skipped = set(read_result(s3_stream, DEST_BUCKET, skipped_key(PROJECT_NAME, RUN_ID, archive_name)))
+            duplicates = {}
+            if int(progress.get('duplicates', 0)):
+                duplicates = {key: tuple(target) for key, target in read_result(
+                    s3_stream, DEST_BUCKET, duplicates_key(PROJECT_NAME, RUN_ID, archive_name)).items()}
+            archived = [obj for obj in batch if obj['Key'] not in skipped and obj['Key'] not in duplicates]
+            index = load_index(s3_stream, DEST_BUCKET, archive_name) if archived else None
+            policies = stored_policies(index)
+            content_rows = stored_content_rows(archive_name, archived, index) if content_index is not None else []
+    except (ClientError, OSError, ValueError, RuntimeError) as e:
+        # The multipart upload has been aborted, or the archive is not recorded as uploaded, so
+        # the sources of this archive are kept
+        print(f"Error uploading {archive_name} to {DEST_BUCKET}: {e}")
+        failed_archives.append(archive_name)
+        if content_index is not None:
+            content_index.forget(archive_name)
+        return
+    # Copies of content packed into an archive of this run that failed stay in the source
+    # bucket, the next run archives them
+    orphaned = [key for key, (target, _) in duplicates.items() if target in failed_archives]
+    for key in orphaned:
+        print(f"Keeping {key}, the archive holding its content failed")
+        del duplicates[key]
+    if archived:
+        created_archives.append(archive_name)
+    archived_bytes += sum(obj['Size'] for obj in archived)
+    finalize_stats.add(sum(obj['Size'] for obj in archived))
+    manifest_rows = [manifest_row(obj['Key'], archive_name, policies) for obj in archived]
+    # A copy points at the member holding its content, restores follow MemberName
+    manifest_rows.extend({'key': key, 'TarFileName': target, 'MemberName': member}
+                         for key, (target, member) in duplicates.items())
+    processed_files += len(manifest_rows)
+    # The file rows again with the size and age of their source, for the manifest index
+    sources = {obj['Key']: obj for obj in batch}
+    index_rows = [dict(row, Size=sources[row['key']]['Size'], LastModified=sources[row['key']]['LastModified'])
+                  for row in manifest_rows]
+    manifest_rows.extend(content_rows)
+    source_keys = [obj['Key'] for obj in archived] + list(duplicates)
 
-print(f"Found {len(all_objects)} files in {SOURCE_BUCKET}/{SOURCE_PREFIX}")
-# Create a temporary directory to download the files
-temp_dir = 'app/s3-download'
-os.makedirs(temp_dir, exist_ok=True)
-# Import multiprocessing for parallel downloads
-import multiprocessing
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
-
-# Function to download a single file
-def download_s3_file(obj, bucket, temp_directory, s3_client):
-    key = obj['Key']
-    if key == SOURCE_PREFIX:
-        return None
-    
-    local_path = os.path.join(temp_directory, os.path.basename(key))
-    local_dir = os.path.dirname(local_path)
-    os.makedirs(local_dir, exist_ok=True)
-    
     try:
-        s3_client.download_file(bucket, key, local_path)
-        return local_path
-    except ClientError as e:
-        print(f"Error downloading {key}: {e}")
-        return None
-
-# Set up parallel download with ThreadPoolExecutor
-print(f"Starting parallel download of {len(all_objects)} files...")
-download_count = 0
-batch_size = 100  # Process files in batches to show progress
-
-# Create a session for thread safety
-session = boto3.session.Session()
-s3_thread_safe = session.client('s3')
-
-# Use partial to create a function with preset arguments
-download_func = partial(download_s3_file, 
-                        bucket=SOURCE_BUCKET, 
-                        temp_directory=temp_dir, 
-                        s3_client=s3_thread_safe)
-
-# Calculate optimal number of workers based on CPU cores
-max_workers = min(32, multiprocessing.cpu_count() * 4)  # Limit to reasonable number
-print(f"Using {max_workers} parallel workers for downloads")
-
-# Process files in batches to show progress
-for i in range(0, len(all_objects), batch_size):
-    batch = all_objects[i:i+batch_size]
-    
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        results = list(executor.map(download_func, batch))
-    
-    # Count successful downloads
-    successful = [r for r in results if r is not None]
-    download_count += len(successful)
-    
-    # Show progress
-    progress = (i + len(batch)) / len(all_objects) * 100
-    print(f"Downloaded {download_count} files ({progress:.1f}% complete)")
-
-print(f"Download completed: {download_count} files downloaded to {temp_dir}")
-
-
-# Create DynamoDB client
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(DYNAMODB_TABLE_NAME)
-files = os.listdir(temp_dir)
+        if state != MANIFEST_COMMITTED:
+            # Store the filename and tar file name in DynamoDB, and keep the sources of the archive
+            # unless every one of its rows made it
+            if not manifest.commit(archive_name, manifest_rows).wait():
+                print(f"Manifest of {archive_name} is incomplete, keeping its source files")
+                failed_archives.append(archive_name)
+                return
+            # Pattern restores find the archive through the index, its sources are kept until it is stored
+            started = time.monotonic()
+            manifest_index.add(archive_name, index_rows, run_id=RUN_ID)
+            metrics.phase('manifest').add(time.monotonic() - started)
+            journal.advance(archive_name, MANIFEST_COMMITTED)
+
+        # Delete the original files from S3 only once the archive is verified and recorded
+        started = time.monotonic()
+        delete_errors = deleter.delete(source_keys)
+        metrics.phase('delete').add(time.monotonic() - started, items=len(source_keys) - len(delete_errors))
+        print(f"Deleted {len(source_keys) - len(delete_errors)} source files of {archive_name} from source bucket")
+        for key, error in list(delete_errors.items())[:10]:
+            print(f"Error deleting {key} from source bucket: {error}")
+        if delete_errors:
+            # The journal stays at manifest_committed, a resumed run deletes what is left
+            undeleted_archives.append(archive_name)
+        else:
+            journal.advance(archive_name, SOURCES_DELETED)
+    except (ClientError, RuntimeError) as e:
+        # A restarted run repeats the steps that were not recorded
+        print(f"Error recording the progress of {archive_name}: {e}")
+        failed_archives.append(archive_name)
+
 
+def hand_over(*finalize_args):
+    # One archive is finished at a time; the packer waits here when finishing falls behind, which
+    # keeps at most two archives (and their upload buffers) in flight
+    global finalizing
+    if finalizing is not None:
+        started = time.monotonic()
+        finalizing.result()
+        finalize_stats.waited(time.monotonic() - started)
+    finalizing = finalizer.submit(finalize_archive, *finalize_args) if finalize_args else None
+
+
+# Manifest rows are written in batches on background threads, once their archive is uploaded
+manifest_client = boto3.client('dynamodb')
+metrics.count_requests(manifest_client, {'BatchWriteItem': 'manifest'})
+metrics.count_requests(s3_stream.client, {
+    'GetObject': 'download', 'CreateMultipartUpload': 'upload', 'UploadPart': 'upload',
+    'CompleteMultipartUpload': 'upload', 'HeadObject': 'upload', 'PutObject': 'upload', 'DeleteObjects': 'delete'
+})
+manifest = ManifestWriter(manifest_client, DYNAMODB_TABLE_NAME, threads=MANIFEST_WRITERS)
+manifest_index = ManifestIndex(manifest_client, s3_stream, MANIFEST_INDEX_TABLE_NAME, DEST_BUCKET)
+deleter = SourceDeleter(s3_stream, SOURCE_BUCKET, threads=DELETE_THREADS)
+content_index = ContentIndex(boto3.client('dynamodb'), DYNAMODB_TABLE_NAME) if DEDUP else None
 
 print(f"###########Zip in progress#####################")
-# Create multiple tar files from the downloaded files
-files_to_process = files.copy()
-archive_count = 0
-processed_files = []
+earlier_files = 0
+earlier_bytes = 0
 created_archives = []
+failed_archives = []
+# Archives stored and recorded whose source files could not all be deleted
+undeleted_archives = []
+stored_files = 0
+stored_bytes = 0
+compress_seconds = 0.0
+compressed_raw_bytes = 0
 
-while files_to_process:
-    # Generate a unique name for each archive
-    archive_count += 1
-    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-    archive_name = f"{PROJECT_NAME}_{timestamp}_part{archive_count}.tar.gz"
-    tar_path = os.path.join(temp_dir, archive_name)
-    created_archives.append(archive_name)
-    
-    print(f"Creating archive {archive_count}: {archive_name}")
-    
-    current_size = 0
-    current_file_count = 0
-    archive_files = []
-    
-    # Create a mapping of local filenames to their original S3 keys
-    file_to_s3key = {}
-    for obj in all_objects:
-        key = obj['Key']
-        basename = os.path.basename(key)
-        file_to_s3key[basename] = key
-    
-    with tarfile.open(tar_path, 'w:gz') as tar:
-        for file in files_to_process[:]:  # Use a slice copy to safely modify during iteration
-            file_path = os.path.join(temp_dir, file)
-            file_size = os.path.getsize(file_path)
-            
-            # Check if adding this file would exceed our limits
-            if (current_size + file_size >= FILE_SIZE_LIMIT * 1024 * 1024) or (current_file_count >= FILE_COUNT_LIMIT):
-                if current_file_count > 0:  # Only break if we've added at least one file
-                    break
-            
-            # Add file to archive
-            tar.add(file_path, arcname=file)  # Use arcname to store just the filename, not the full path
-            current_size += file_size
-            current_file_count += 1
-            print(f"current_file_count  {current_file_count}:")
-            print(f"current_size  {current_size}:")
-                   
-            archive_files.append(file)
-            
-            # Store the filename and tar file name in DynamoDB
-            try:
-                table.put_item(
-                    Item={
-                        'key': file,
-                        'TarFileName': archive_name
-                    }
-                )
-            except ClientError as e:
-                print(f"Error storing {file} in DynamoDB: {e}")
-    
-    # Remove processed files from the list
-    for file in archive_files:
-        files_to_process.remove(file)
-        processed_files.append(file)
-        
-        # Delete the original file from S3 after archiving
-        if file in file_to_s3key:
+try:
+    journal_rows = journal.load()
+except ClientError as e:
+    print(f"Error reading the journal of run {RUN_ID}: {e}")
+    exit(1)
+
+
+def archive_state(archive_number):
+    return journal_rows.get(archive_name_for(archive_number), {}).get('state', PLANNED)
+
+
+# The stages overlap: objects of the next archives download while one archive is packed and
+# compressed, and the archive before it completes its upload, manifest and deletes on the
+# finalizer thread. Read-ahead crosses archive boundaries and is bounded by the byte budget.
+pipeline_started = time.monotonic()
+# Objects of an archive are fetched round robin across their key prefixes
+prefetcher = Prefetcher(((number, obj) for number, archive in archives if archive_state(number) == PLANNED
+                         for obj in spread_by_prefix(archive['objects'])),
+                        open_source_object, read_ahead_budget, read_ahead_cost, read_ahead_window, download_stats)
+finalizer = ThreadPoolExecutor(max_workers=1)
+finalizing = None
+
+for archive_number, archive in archives:
+    batch = archive['objects']
+    archive_name = archive_name_for(archive_number)
+    progress = journal_rows.get(archive_name, {})
+    state = progress.get('state', PLANNED)
+    if state == SOURCES_DELETED:
+        print(f"Archive {archive_number}: {archive_name} was completed by an earlier attempt")
+        created_archives.append(archive_name)
+        earlier_files += int(progress.get('files', len(batch)))
+        earlier_bytes += int(progress.get('size', archive['size']))
+        continue
+    print(f"Creating archive {archive_number}: {archive_name}" if state == PLANNED
+          else f"Resuming archive {archive_number}: {archive_name} after {state}")
+
+    packed = None
+    if state == PLANNED:
+        if progress.get('upload_id'):
+            # Left behind by an attempt that died while uploading; the sources are untouched
+            # until an archive is recorded as uploaded, so it is simply uploaded again
             try:
-                s3.delete_object(
-                    Bucket=SOURCE_BUCKET,
-                    Key=file_to_s3key[file]
-                )
-                print(f"Deleted {file_to_s3key[file]} from source bucket")
+                s3_stream.abort_multipart_upload(Bucket=DEST_BUCKET, Key=archive_name, UploadId=progress['upload_id'])
             except ClientError as e:
-                print(f"Error deleting {file_to_s3key[file]} from source bucket: {e}")
-    
-    print(f"Archive {archive_count}: Added {current_file_count} files, size: {current_size/1024:.2f} KB")
-    
-    #Upload the tar file to the destination S3 bucket
-    try:
-        s3.put_object(
-            Bucket=DEST_BUCKET, 
-            Key=archive_name, 
-            Body=open(tar_path, 'rb'), 
-            StorageClass='DEEP_ARCHIVE'
-        )
-        print(f"Uploaded {archive_name} to {DEST_BUCKET}")
-    except ClientError as e:
-        print(f"Error uploading {archive_name} to {DEST_BUCKET}: {e}")
-    
-    # Optional: Remove the local archive after upload to save space
-    os.remove(tar_path)
-    print(f"Removed local archive: {tar_path}")
-    
-    # Break if we've processed all files
-    if not files_to_process:
-        break
+                print(f"Upload {progress['upload_id']} of {archive_name} is already gone: {e}")
+        try:
+            packed = pack_archive(archive_number, archive_name, batch, archive['size'])
+        except (ClientError, OSError, ValueError, RuntimeError) as e:
+            print(f"Error uploading {archive_name} to {DEST_BUCKET}: {e}")
+            # Drop the objects still read ahead for it, the next archive carries on
+            prefetcher.skip(archive_number)
+            failed_archives.append(archive_name)
+            continue
+    hand_over(archive_name, batch, state, progress, packed)
 
+hand_over()
+finalizer.shutdown()
+prefetcher.close()
+manifest.close()
+metrics.phase('download').add(nbytes=download_stats.bytes)
+metrics.phase('manifest').add(manifest.busy_seconds, items=manifest.items_written, retries=manifest.retries,
+                              errors=manifest.items_failed)
+report_stages([download_stats, compress_stats, upload_stats, finalize_stats], time.monotonic() - pipeline_started)
+print(f"Peak read-ahead: {read_ahead_budget.peak / (1024 * 1024):.2f} MB of {read_ahead_budget.limit / (1024 * 1024):.0f} MB")
+print(f"Transfers: {transfer_limiter.report()}")
 print(f"File Manifest Stored in DynamoDB")
-print(f"Created {archive_count} archives: {', '.join(created_archives)}")
-print(f"Processed {len(processed_files)} files out of {len(files)} total files")
+print(f"Deleted {deleter.deleted} source files in {deleter.requests} DeleteObjects requests, {deleter.failed} failed")
+print(f"Created {len(created_archives)} archives: {', '.join(created_archives)}")
+print(f"Processed {processed_files} files out of {total_objects} total files")
+if earlier_files:
+    print(f"{earlier_files} files were archived by earlier attempts of run {RUN_ID}")
+if DETECT_INCOMPRESSIBLE:
+    # CPU the stored data would have taken at the rate the compressed data actually took
+    saved_seconds = stored_bytes * compress_seconds / compressed_raw_bytes if compressed_raw_bytes else 0.0
+    print(f"Incompressible data: {stored_files} files, {stored_bytes / (1024 * 1024):.2f} MB stored uncompressed, "
+          f"about {saved_seconds:.1f} CPU seconds of compression saved "
+          f"({compress_seconds:.1f} CPU seconds spent on {compressed_raw_bytes / (1024 * 1024):.2f} MB)")
+if content_index is not None:
+    print(f"Deduplication: {content_index.duplicates} copies of archived content, "
+          f"{content_index.duplicate_bytes / (1024 * 1024):.2f} MB not stored again")
+if SHARD_INDEX is not None:
+    # Picked up by the aggregate job once every shard of the run is done
+    shard_result = {
+        'run_id': RUN_ID,
+        'shard': int(SHARD_INDEX),
+        'archives': [number for number, _ in archives],
+        'created': created_archives,
+        'failed': failed_archives,
+        'undeleted': undeleted_archives,
+        # Archives finished by earlier attempts of the shard count as well
+        'files': processed_files + earlier_files,
+        'bytes': archived_bytes + earlier_bytes,
+        'deleted': deleter.deleted + earlier_files,
+        'delete_failed': deleter.failed,
+        'manifest_rows': manifest.items_written,
+        'duplicates': content_index.duplicates if content_index is not None else 0,
+        'duplicate_bytes': content_index.duplicate_bytes if content_index is not None else 0,
+        'stored_uncompressed_bytes': stored_bytes
+    }
+    try:
+        write_result(s3, DEST_BUCKET, shard_result_key(PROJECT_NAME, RUN_ID, SHARD_INDEX), shard_result)
+    except ClientError as e:
+        print(f"Error storing the result of shard {SHARD_INDEX}: {e}")
+        exit(1)
+if undeleted_archives:
+    print(f"Source files of {len(undeleted_archives)} archives are not all deleted, resume run {RUN_ID} to delete "
+          f"them: {', '.join(undeleted_archives)}")
+if failed_archives:
+    print(f"Failed to create {len(failed_archives)} archives: {', '.join(failed_archives)}")
+if failed_archives or undeleted_archives:
+    if SHARD_INDEX is not None:
+        # AWS Batch cancels the aggregate job when a child of the array job fails, so a shard
+        # leaves its failures to the aggregate job, which fails the run on them
+        print(f"Shard {SHARD_INDEX} of run {RUN_ID} finished with failures, they are in its result")
+        compression_pool.shutdown()
+        exit(0)
+    exit(1)
+if INCREMENTAL and SHARD_INDEX is None:
+    # Sharded runs move the watermark in their aggregate job, once every shard succeeded
+    try:
+        watermark = advance_watermark(s3, DEST_BUCKET, PROJECT_NAME, RUN_ID)
+    except ClientError as e:
+        print(f"Error moving the watermark of {SOURCE_PREFIX}: {e}")
+        exit(1)
+    if watermark is not None:
+        print(f"Watermark of {SOURCE_PREFIX}: {watermark['start_after']} (run {watermark['run_id']})")
+compression_pool.shutdown()
 print(f"File Zip and Upload Completed")
-
-# Clean up - remove the entire temporary directory
-try:
-    shutil.rmtree(temp_dir)
-    print(f"Removed temporary directory: {temp_dir}")
-except Exception as e:
-    print(f"Error removing temporary directory: {e}")
\ No newline at end of file
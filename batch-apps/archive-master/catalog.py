@@ -0,0 +1,283 @@
+import datetime
+import os
+import sqlite3
+import tempfile
+import threading
+from array import array
+
+FETCH_CHUNK = 500   # rows per SELECT ... WHERE row IN (...), below SQLite's variable limit
+INSERT_CHUNK = 10000
+CHECK_INTERVAL = 10000   # rows between memory checks
+# Indexes of a spilled catalog, (name, columns)
+SIZE_INDEX = ('objects_size', 'size DESC, row')
+SUBFOLDER_INDEX = ('objects_subfolder', 'subfolder, size DESC, row')
+
+
+class _StringColumn:
+    """Strings stored back to back as UTF-8 in one bytearray, with an offset per row."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('Q', [0])
+
+    def append(self, value):
+        self.data += value.encode('utf-8')
+        self.offsets.append(len(self.data))
+
+    def __getitem__(self, row):
+        return self.data[self.offsets[row]:self.offsets[row + 1]].decode('utf-8')
+
+    def nbytes(self):
+        return len(self.data) + self.offsets.itemsize * len(self.offsets)
+
+
+class ObjectCatalog:
+    """Listing metadata (Key, Size, LastModified, ETag) of every object of a job, kept compact.
+
+    Instead of a dict per object the catalog keeps columns: the directory part of every key is
+    interned, the rest of the key and the ETag are packed into byte strings, sizes and
+    modification times go into arrays. Rows are numbered in the order they were added. Once
+    the columns take more than `memory_limit` bytes they move to a SQLite file in `spill_dir`,
+    and every later row goes there as well, so memory stays flat however many objects the
+    prefix holds. Objects come back as the same slim dicts the listing produced.
+    """
+
+    def __init__(self, memory_limit=256 * 1024 * 1024, spill_dir=None):
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.spill_path = None
+        self._directories = {}
+        self._directory_names = []
+        self._subfolders = {}
+        self._subfolder_names = []
+        self._subfolder_counts = []
+        self._count = 0
+        self._directory_ids = array('I')
+        self._subfolder_ids = array('I')
+        self._names = _StringColumn()
+        self._etags = _StringColumn()
+        self._sizes = array('q')
+        self._mtimes = array('d')
+        # Rows of every subfolder, built on the first query by subfolder
+        self._subfolder_rows = None
+        self._db = None
+        self._pending = []
+        self._indexes = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def spilled(self):
+        return self._db is not None
+
+    def memory_bytes(self):
+        # Bytes held by the in-memory columns, the interned directory names aside
+        columns = (self._directory_ids, self._subfolder_ids, self._sizes, self._mtimes)
+        return (self._names.nbytes() + self._etags.nbytes()
+                + sum(column.itemsize * len(column) for column in columns))
+
+    def _intern(self, ids, names, value):
+        number = ids.get(value)
+        if number is None:
+            number = ids[value] = len(names)
+            names.append(value)
+        return number
+
+    def add(self, obj, subfolder=None):
+        # Returns the row number of the object
+        directory, _, name = obj['Key'].rpartition('/')
+        directory_id = self._intern(self._directories, self._directory_names, directory)
+        subfolder_id = self._intern(self._subfolders, self._subfolder_names, subfolder)
+        if subfolder_id == len(self._subfolder_counts):
+            self._subfolder_counts.append(0)
+        self._subfolder_counts[subfolder_id] += 1
+        row = self._count
+        self._count += 1
+        self._subfolder_rows = None
+        mtime = obj['LastModified'].timestamp()
+        etag = obj.get('ETag') or ''
+        if self._db is not None:
+            self._pending.append((row, directory_id, name, subfolder_id, obj['Size'], mtime, etag))
+            if len(self._pending) >= INSERT_CHUNK:
+                self._flush()
+            return row
+        self._directory_ids.append(directory_id)
+        self._subfolder_ids.append(subfolder_id)
+        self._names.append(name)
+        self._etags.append(etag)
+        self._sizes.append(obj['Size'])
+        self._mtimes.append(mtime)
+        if self._count % CHECK_INTERVAL == 0 and self.memory_bytes() > self.memory_limit:
+            self._spill()
+        return row
+
+    def _spill(self):
+        handle, self.spill_path = tempfile.mkstemp(prefix='catalog-', suffix='.db', dir=self.spill_dir)
+        os.close(handle)
+        # A scratch file: nothing needs to survive a crash, the listing is simply redone
+        self._db = sqlite3.connect(self.spill_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=OFF')
+        self._db.execute('PRAGMA synchronous=OFF')
+        self._db.execute('PRAGMA cache_size=-65536')
+        self._db.execute('CREATE TABLE objects (row INTEGER PRIMARY KEY, directory INTEGER, name TEXT, '
+                         'subfolder INTEGER, size INTEGER, mtime REAL, etag TEXT)')
+        for start in range(0, self._count, INSERT_CHUNK):
+            self._pending = [self._row(row) for row in range(start, min(start + INSERT_CHUNK, self._count))]
+            self._flush()
+        print(f"Object catalog passed {self.memory_limit / (1024 * 1024):.0f} MB at {self._count} objects, "
+              f"moved to {self.spill_path}")
+        self._directory_ids = array('I')
+        self._subfolder_ids = array('I')
+        self._names = _StringColumn()
+        self._etags = _StringColumn()
+        self._sizes = array('q')
+        self._mtimes = array('d')
+        self._subfolder_rows = None
+
+    def _row(self, row):
+        return (row, self._directory_ids[row], self._names[row], self._subfolder_ids[row],
+                self._sizes[row], self._mtimes[row], self._etags[row])
+
+    def _flush(self):
+        if self._pending:
+            self._db.executemany('INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?, ?)', self._pending)
+            self._pending = []
+
+    def _execute(self, sql, args=(), index=None):
+        # Cursor of a query on the spilled catalog, indexes are only built once they are needed
+        with self._lock:
+            self._flush()
+            if index is not None and index[0] not in self._indexes:
+                self._db.execute(f'CREATE INDEX {index[0]} ON objects ({index[1]})')
+                self._indexes.add(index[0])
+            return self._db.execute(sql, args)
+
+    def _query(self, sql, args=(), index=None):
+        cursor = self._execute(sql, args, index)
+        with self._lock:
+            return cursor.fetchall()
+
+    def _object(self, directory_id, name, size, mtime, etag):
+        directory = self._directory_names[directory_id]
+        return {
+            'Key': f"{directory}/{name}" if directory else name,
+            'Size': size,
+            'LastModified': datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc),
+            'ETag': etag or None
+        }
+
+    def get(self, row):
+        return self.get_many([row])[0]
+
+    def get_many(self, rows):
+        # Objects of the given rows, in that order
+        if self._db is None:
+            return [self._object(self._directory_ids[row], self._names[row], self._sizes[row],
+                                 self._mtimes[row], self._etags[row]) for row in rows]
+        objects = []
+        for i in range(0, len(rows), FETCH_CHUNK):
+            chunk = list(rows[i:i + FETCH_CHUNK])
+            found = {result[0]: self._object(*result[1:]) for result in self._query(
+                f"SELECT row, directory, name, size, mtime, etag FROM objects "
+                f"WHERE row IN ({','.join('?' * len(chunk))})", chunk)}
+            objects.extend(found[row] for row in chunk)
+        return objects
+
+    def _key(self, row):
+        directory = self._directory_names[self._directory_ids[row]]
+        return f"{directory}/{self._names[row]}" if directory else self._names[row]
+
+    def subfolders(self):
+        # {subfolder: object count}
+        return dict(zip(self._subfolder_names, self._subfolder_counts))
+
+    def rows(self, subfolder=None, limit=None):
+        """Row numbers in the order they were added, all of them or those of one subfolder."""
+        if self._db is None:
+            rows = range(self._count) if subfolder is None else self._rows_of(subfolder)
+            return list(rows[:limit] if limit is not None else rows)
+        where, args = self._subfolder_filter(subfolder)
+        return [result[0] for result in self._query(
+            f"SELECT row FROM objects{where} ORDER BY row" + (f" LIMIT {int(limit)}" if limit is not None else ""),
+            args, index=SUBFOLDER_INDEX if subfolder is not None else None)]
+
+    def _rows_of(self, subfolder):
+        # One pass over the rows serves the queries for every subfolder
+        if self._subfolder_rows is None:
+            self._subfolder_rows = [array('I') for _ in self._subfolder_names]
+            for row, subfolder_id in enumerate(self._subfolder_ids):
+                self._subfolder_rows[subfolder_id].append(row)
+        wanted = self._subfolders.get(subfolder)
+        return self._subfolder_rows[wanted] if wanted is not None else array('I')
+
+    def _subfolder_filter(self, subfolder):
+        if subfolder is None:
+            return '', ()
+        return ' WHERE subfolder = ?', (self._subfolders.get(subfolder, -1),)
+
+    def by_size(self, subfolder=None):
+        """(row, size) of every object, or those of one subfolder, largest first.
+
+        Objects of the same size keep the order they were added in.
+        """
+        if self._db is None:
+            rows = self.rows(subfolder)
+            rows.sort(key=lambda row: -self._sizes[row])
+            for row in rows:
+                yield row, self._sizes[row]
+            return
+        where, args = self._subfolder_filter(subfolder)
+        # Walks an index in that order and reads it in pages, a spilled catalog is never loaded at once
+        cursor = self._execute(f"SELECT row, size FROM objects{where} ORDER BY size DESC, row", args,
+                               index=SIZE_INDEX if subfolder is None else SUBFOLDER_INDEX)
+        while True:
+            with self._lock:
+                page = cursor.fetchmany(INSERT_CHUNK)
+            if not page:
+                return
+            yield from page
+
+    def sorted_by_key(self, rows):
+        # The given rows in key order
+        if self._db is None:
+            return array('I', sorted(rows, key=self._key))
+        keyed = []
+        for i in range(0, len(rows), FETCH_CHUNK):
+            chunk = list(rows[i:i + FETCH_CHUNK])
+            for row, directory_id, name in self._query(
+                    f"SELECT row, directory, name FROM objects WHERE row IN ({','.join('?' * len(chunk))})", chunk):
+                directory = self._directory_names[directory_id]
+                keyed.append((f"{directory}/{name}" if directory else name, row))
+        keyed.sort()
+        return array('I', (row for _, row in keyed))
+
+    def objects(self, rows):
+        return ObjectList(self, rows)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            os.remove(self.spill_path)
+
+
+class ObjectList:
+    """Read-only list of catalog objects, materialised as dicts only while they are used."""
+
+    def __init__(self, catalog, rows):
+        self.catalog = catalog
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return self.catalog.get_many(self.rows[position])
+        return self.catalog.get(self.rows[position])
+
+    def __iter__(self):
+        for i in range(0, len(self.rows), FETCH_CHUNK):
+            yield from self.catalog.get_many(self.rows[i:i + FETCH_CHUNK])
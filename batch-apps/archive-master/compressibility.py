@@ -0,0 +1,97 @@
+import os
+import re
+import zlib
+
+STORED = 'stored'
+COMPRESSED = 'compressed'
+
+# Formats that are compressed already, another pass of gzip gains next to nothing on them
+COMPRESSED_EXTENSIONS = frozenset((
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.br', '.snappy', '.zip', '.7z', '.rar', '.jar',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.aac', '.m4a', '.ogg', '.flac', '.mp4', '.m4v', '.mov', '.mkv', '.webm', '.avi',
+    '.parquet', '.orc', '.docx', '.xlsx', '.pptx',
+))
+
+# Leading bytes of the same formats, for files without a telling extension. Only signatures
+# that text can't start with: ORC files are recognised by extension only, bzip2 by BZIP2_MAGIC.
+MAGIC_NUMBERS = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'PK\x03\x04', 'zip'),
+    (b'7z\xbc\xaf\x27\x1c', '7z'),
+    (b'Rar!', 'rar'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG', 'png'),
+    (b'GIF8', 'gif'),
+    (b'PAR1', 'parquet'),
+)
+# 'BZh', the block size digit and the magic of the first block (pi in BCD)
+BZIP2_MAGIC = re.compile(rb'BZh[1-9]1AY&SY')
+
+SAMPLE_SIZE = 64 * 1024
+# Below this there is too little to judge, the file is compressed like any other
+MIN_SAMPLE_SIZE = 4 * 1024
+# Samples that zlib level 1 can't shrink below this ratio are stored
+STORE_RATIO = 0.95
+
+
+def classify(name, sample):
+    """Returns (policy, ratio, reason) for a file from its name and first bytes.
+
+    Known compressed formats are recognised by extension or magic number without any work.
+    Anything else big enough gets a trial compression of the sample with zlib level 1, which
+    costs a small fraction of compressing the whole file; ratio is that trial's result, None
+    when no trial was needed.
+    """
+    extension = os.path.splitext(name)[1].lower()
+    if extension in COMPRESSED_EXTENSIONS:
+        return STORED, None, f"{extension} file"
+    for magic, format_name in MAGIC_NUMBERS:
+        if sample.startswith(magic):
+            return STORED, None, f"{format_name} data"
+    if BZIP2_MAGIC.match(sample):
+        return STORED, None, "bzip2 data"
+    if sample[4:8] == b'ftyp':
+        return STORED, None, "MP4/QuickTime data"
+    if len(sample) < MIN_SAMPLE_SIZE:
+        return COMPRESSED, None, "small file"
+    ratio = len(zlib.compress(sample, 1)) / len(sample)
+    if ratio >= STORE_RATIO:
+        return STORED, ratio, f"sample compresses to {ratio:.0%}"
+    return COMPRESSED, ratio, f"sample compresses to {ratio:.0%}"
+
+
+class PeekedReader:
+    """Readable stream that returns already peeked bytes before the rest of the stream."""
+
+    def __init__(self, head, fileobj):
+        self.head = head
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if self.head:
+            if size < 0 or size >= len(self.head):
+                data, self.head = self.head, b''
+                rest = self.fileobj.read(-1 if size < 0 else size - len(data))
+                return data + rest
+            data, self.head = self.head[:size], self.head[size:]
+            return data
+        return self.fileobj.read(size)
+
+    def close(self):
+        self.fileobj.close()
+
+
+def peek(body, size=SAMPLE_SIZE):
+    # (first bytes, body to read from the start), without consuming an in-memory body
+    if hasattr(body, 'getbuffer'):
+        return bytes(body.getbuffer()[:size]), body
+    head = b''
+    while len(head) < size:
+        chunk = body.read(size - len(head))
+        if not chunk:
+            break
+        head += chunk
+    return head, PeekedReader(head, body)
@@ -0,0 +1,120 @@
+import hashlib
+import threading
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from backoff import attempts
+from manifest_writer import RETRYABLE_ERRORS
+
+BATCH_GET_LIMIT = 100   # DynamoDB limit on keys per BatchGetItem call
+
+
+def kms_encrypted(obj):
+    # Set from the GetObject response, listings don't say how an object is encrypted
+    return (obj.get('ServerSideEncryption') or '').startswith('aws:kms')
+
+
+def etag_identity(obj):
+    # The ETag with the size identifies content without reading it. SSE-KMS objects get an ETag
+    # unrelated to the content, so they have no ETag identity.
+    etag = (obj.get('ETag') or '').strip('"')
+    return f"etag:{etag}:{obj['Size']}" if etag and not kms_encrypted(obj) else None
+
+
+def content_md5(obj):
+    # Only single part uploads without SSE-KMS have the MD5 of the content as ETag. A multipart
+    # ETag is an MD5 of the part MD5s, the same content uploaded with other part sizes differs.
+    etag = (obj.get('ETag') or '').strip('"')
+    return etag if len(etag) == 32 and '-' not in etag and not kms_encrypted(obj) else None
+
+
+def sha256_identity(sha256):
+    return f"sha256:{sha256}"
+
+
+class ContentIndex:
+    """Finds objects whose content is already stored in an archive.
+
+    Every stored member gets content rows in `_archive_master` next to the file rows, keyed by
+    `etag:<etag>:<size>` and `sha256:<hex>` and pointing at the archive and member holding the
+    content. Identities seen earlier in this run are kept in memory. The content rows share the
+    `key` attribute with file rows, only a file named exactly like one of them would clash.
+    """
+
+    def __init__(self, dynamodb_client, table_name, max_attempts=8, base_delay=0.05):
+        self.client = dynamodb_client
+        self.table_name = table_name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.duplicates = 0
+        self.duplicate_bytes = 0
+        self._known = {}
+        self._lock = threading.Lock()
+
+    def preload(self, objects):
+        # Look up the ETag identities of objects about to be packed, 100 per BatchGetItem call
+        wanted = list(dict.fromkeys(identity for identity in map(etag_identity, objects)
+                                    if identity and identity not in self._known))
+        for i in range(0, len(wanted), BATCH_GET_LIMIT):
+            self._get(wanted[i:i + BATCH_GET_LIMIT])
+
+    def _get(self, identities):
+        keys = [{'key': {'S': identity}} for identity in identities]
+        for attempt in attempts(self.max_attempts, self.base_delay):
+            try:
+                response = self.client.batch_get_item(
+                    RequestItems={self.table_name: {'Keys': keys, 'ConsistentRead': True,
+                                                    'ProjectionExpression': '#k, TarFileName, MemberName',
+                                                    'ExpressionAttributeNames': {'#k': 'key'}}}
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] not in RETRYABLE_ERRORS:
+                    raise
+                continue
+            except BotoCoreError:
+                continue
+            with self._lock:
+                for item in response['Responses'].get(self.table_name, []):
+                    self._known[item['key']['S']] = (item['TarFileName']['S'], item['MemberName']['S'])
+            keys = response.get('UnprocessedKeys', {}).get(self.table_name, {}).get('Keys', [])
+            if not keys:
+                return
+        # Unresolved identities only mean their copies are archived again
+        print(f"Could not look up {len(keys)} content identities after retries")
+
+    def find(self, obj, body):
+        """Returns the (archive, member) already holding the content of obj, or None, and the
+        SHA-256 of the content if it had to be computed.
+
+        Objects whose ETag is not the MD5 of their content (multipart, SSE-KMS or no ETag) are
+        hashed and looked up by SHA-256 when their body is in memory. Larger streamed objects are
+        only recognised by their ETag.
+        """
+        identity = etag_identity(obj)
+        if identity in self._known:
+            return self._known[identity], None
+        if content_md5(obj) is not None or not hasattr(body, 'getvalue'):
+            return None, None
+        sha256 = hashlib.sha256(body.getvalue()).hexdigest()
+        identity = sha256_identity(sha256)
+        if identity not in self._known:
+            self._get([identity])
+        return self._known.get(identity), sha256
+
+    def duplicate(self, size):
+        self.duplicates += 1
+        self.duplicate_bytes += size
+
+    def add(self, obj, sha256, archive_name, member_name):
+        # Record a stored member; returns its content rows for the manifest
+        target = (archive_name, member_name)
+        identities = [identity for identity in (etag_identity(obj), sha256 and sha256_identity(sha256)) if identity]
+        with self._lock:
+            for identity in identities:
+                self._known.setdefault(identity, target)
+        return [{'key': identity, 'TarFileName': archive_name, 'MemberName': member_name} for identity in identities]
+
+    def forget(self, archive_name):
+        # Content of an archive that failed is not stored after all
+        with self._lock:
+            self._known = {identity: target for identity, target in self._known.items() if target[0] != archive_name}
@@ -0,0 +1,131 @@
+import datetime
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import BotoCoreError, ClientError
+
+from backoff import attempts
+from manifest_writer import BATCH_WRITE_LIMIT, RETRYABLE_ERRORS
+
+# Every archive of a run moves through these states in order. A restarted run skips the steps
+# an archive has already completed; each step can also be repeated safely:
+#   planned             uploading again overwrites the same archive name
+#   uploaded            manifest rows are put again with the same values
+#   manifest_committed  deleting sources that are already gone succeeds
+#   sources_deleted     nothing left to do
+PLANNED = 'planned'
+UPLOADED = 'uploaded'
+MANIFEST_COMMITTED = 'manifest_committed'
+SOURCES_DELETED = 'sources_deleted'
+STATES = (PLANNED, UPLOADED, MANIFEST_COMMITTED, SOURCES_DELETED)
+
+
+class ArchiveJournal:
+    """Progress of every planned archive of one run, kept in the `_archive_journal` table.
+
+    Rows are keyed by run_id and archive_name. The step number only ever moves forward, so a
+    late or repeated update can't move an archive back to an earlier state.
+    """
+
+    def __init__(self, dynamodb_client, table_name, run_id, max_attempts=8, base_delay=0.05):
+        self.client = dynamodb_client
+        self.table_name = table_name
+        self.run_id = run_id
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+
+    def load(self):
+        # {archive_name: row} of everything recorded for the run so far
+        rows = {}
+        args = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': 'run_id = :run_id',
+            'ExpressionAttributeValues': {':run_id': {'S': self.run_id}},
+            'ConsistentRead': True
+        }
+        while True:
+            response = self.client.query(**args)
+            for item in response.get('Items', []):
+                row = {k: self._deserializer.deserialize(v) for k, v in item.items()}
+                rows[row['archive_name']] = row
+            if 'LastEvaluatedKey' not in response:
+                return rows
+            args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def record_planned(self, archives):
+        # archives: (archive_name, archive_number, file count, size) of the whole plan
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        requests = [{'PutRequest': {'Item': {k: self._serializer.serialize(v) for k, v in {
+            'run_id': self.run_id,
+            'archive_name': name,
+            'archive_number': number,
+            'files': files,
+            'size': size,
+            'state': PLANNED,
+            'step': 0,
+            'updated_at': now
+        }.items()}}} for name, number, files, size in archives]
+        for i in range(0, len(requests), BATCH_WRITE_LIMIT):
+            self._write_batch(requests[i:i + BATCH_WRITE_LIMIT])
+
+    def _write_batch(self, requests):
+        for attempt in attempts(self.max_attempts, self.base_delay, max_delay=None):
+            try:
+                response = self.client.batch_write_item(RequestItems={self.table_name: requests})
+            except ClientError as e:
+                if e.response['Error']['Code'] not in RETRYABLE_ERRORS:
+                    raise
+                continue
+            except BotoCoreError:
+                continue
+            requests = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            if not requests:
+                return
+        raise RuntimeError(f"Could not record {len(requests)} planned archives in {self.table_name}")
+
+    def advance(self, archive_name, state, **attributes):
+        # Move an archive to `state`, storing any extra attributes with it. Returns False if the
+        # archive was already at or past that state.
+        step = STATES.index(state)
+        values = {':state': state, ':step': step,
+                  ':now': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+        assignments = ['#state = :state', 'step = :step', 'updated_at = :now']
+        names = {'#state': 'state'}
+        for number, (name, value) in enumerate(attributes.items()):
+            names[f'#a{number}'] = name
+            values[f':a{number}'] = value
+            assignments.append(f'#a{number} = :a{number}')
+        return self._update(archive_name, 'SET ' + ', '.join(assignments), names, values,
+                            'attribute_not_exists(step) OR step < :step')
+
+    def note(self, archive_name, **attributes):
+        # Store attributes without changing the state, e.g. the id of an upload in progress
+        names = {f'#a{number}': name for number, name in enumerate(attributes)}
+        values = {f':a{number}': value for number, value in enumerate(attributes.values())}
+        expression = 'SET ' + ', '.join(f'#a{number} = :a{number}' for number in range(len(attributes)))
+        return self._update(archive_name, expression, names, values)
+
+    def _update(self, archive_name, expression, names, values, condition=None):
+        args = {
+            'TableName': self.table_name,
+            'Key': {'run_id': {'S': self.run_id}, 'archive_name': {'S': archive_name}},
+            'UpdateExpression': expression,
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': {k: self._serializer.serialize(v) for k, v in values.items()}
+        }
+        if condition:
+            args['ConditionExpression'] = condition
+        for attempt in attempts(self.max_attempts, self.base_delay, max_delay=None):
+            try:
+                self.client.update_item(**args)
+                return True
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                if code == 'ConditionalCheckFailedException':
+                    return False
+                if code not in RETRYABLE_ERRORS:
+                    raise
+            except BotoCoreError:
+                continue
+        raise RuntimeError(f"Could not update {archive_name} in {self.table_name}")
@@ -0,0 +1,130 @@
+import queue
+import threading
+import time
+
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import BotoCoreError, ClientError
+
+from backoff import attempts
+
+BATCH_WRITE_LIMIT = 25   # DynamoDB limit on items per BatchWriteItem call
+RETRYABLE_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException',
+                    'RequestLimitExceeded', 'InternalServerError')
+
+
+class ManifestCommit:
+    """Tracks the rows of one archive until all of them are written or given up on."""
+
+    def __init__(self, archive_name, count):
+        self.archive_name = archive_name
+        self.written = 0
+        self.failed = 0
+        self._pending = count
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        if count == 0:
+            self._done.set()
+
+    def _record(self, written, failed):
+        with self._lock:
+            self.written += written
+            self.failed += failed
+            self._pending -= written + failed
+            if self._pending <= 0:
+                self._done.set()
+
+    def wait(self):
+        # True once every row of the archive is stored
+        self._done.wait()
+        return self.failed == 0
+
+
+class ManifestWriter:
+    """Writes `_archive_master` rows through BatchWriteItem on a few background threads.
+
+    Rows are handed over per archive with `commit` once the archive is uploaded. They are cut
+    into batches of 25; UnprocessedItems and throttling errors are retried with exponential
+    backoff and jitter.
+    """
+
+    def __init__(self, dynamodb_client, table_name, threads=4, max_attempts=8, base_delay=0.05, max_delay=5.0):
+        self.client = dynamodb_client
+        self.table_name = table_name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.items_written = 0
+        self.items_failed = 0
+        self.calls = 0
+        self.retries = 0
+        self.busy_seconds = 0.0
+        self._serializer = TypeSerializer()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=threads * 8)
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def commit(self, archive_name, items):
+        # Rows with the same key overwrite each other, like consecutive put_item calls would;
+        # BatchWriteItem rejects duplicate keys within one call
+        unique = list({item['key']: item for item in items}.values())
+        commit = ManifestCommit(archive_name, len(unique))
+        for i in range(0, len(unique), BATCH_WRITE_LIMIT):
+            self._queue.put((commit, unique[i:i + BATCH_WRITE_LIMIT]))
+        return commit
+
+    def _run(self):
+        while True:
+            work = self._queue.get()
+            if work is None:
+                return
+            commit, items = work
+            started = time.monotonic()
+            try:
+                failed = self._write_batch(items)
+            except Exception as e:
+                print(f"Error storing manifest rows of {commit.archive_name} in DynamoDB: {e}")
+                failed = len(items)
+            commit._record(len(items) - failed, failed)
+            with self._lock:
+                self.items_written += len(items) - failed
+                self.items_failed += failed
+                self.busy_seconds += time.monotonic() - started
+
+    def _write_batch(self, items):
+        # Returns the number of rows that could not be written
+        requests = [{'PutRequest': {'Item': {k: self._serializer.serialize(v) for k, v in item.items()}}}
+                    for item in items]
+        for attempt in attempts(self.max_attempts, self.base_delay, self.max_delay):
+            if attempt:
+                with self._lock:
+                    self.retries += 1
+            try:
+                with self._lock:
+                    self.calls += 1
+                response = self.client.batch_write_item(RequestItems={self.table_name: requests})
+            except ClientError as e:
+                if e.response['Error']['Code'] not in RETRYABLE_ERRORS:
+                    print(f"Error storing {len(requests)} manifest rows in DynamoDB: {e}")
+                    return len(requests)
+                continue
+            except BotoCoreError as e:
+                print(f"Retrying manifest write after {e}")
+                continue
+            requests = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            if not requests:
+                return 0
+        print(f"Giving up on {len(requests)} manifest rows after {self.max_attempts} attempts")
+        return len(requests)
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        # Throughput while the writer threads were busy, the job spends most of its time elsewhere
+        busy = self.busy_seconds / len(self._threads)
+        print(f"Manifest: wrote {self.items_written} rows in {self.calls} BatchWriteItem calls "
+              f"({self.retries} retries, {self.items_failed} failed) "
+              f"at {self.items_written / busy if busy else 0:.0f} rows/s")
@@ -0,0 +1,187 @@
+import csv
+import datetime
+import gzip
+import io
+import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def _slim(key, size, last_modified, etag=None):
+    # Only what planning and packing need, the full listing dicts are several times larger
+    return {'Key': key, 'Size': size, 'LastModified': last_modified, 'ETag': etag}
+
+
+def _is_folder_marker(key, size):
+    return key.endswith('/') and size == 0
+
+
+def _stream(tasks, threads, worker):
+    # Run worker(task, emit) for every task on a thread pool and yield whatever the workers
+    # emit as soon as it is emitted. Workers emit lists of objects, one per listed page.
+    results = queue.Queue()
+
+    def run(task):
+        try:
+            worker(task, results.put)
+        except Exception as e:
+            results.put(_Failure(e))
+        finally:
+            results.put(_DONE)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for task in tasks:
+            executor.submit(run, task)
+        remaining = len(tasks)
+        while remaining:
+            item = results.get()
+            if item is _DONE:
+                remaining -= 1
+            elif isinstance(item, _Failure):
+                raise item.error
+            else:
+                yield from item
+
+
+def _list_pages(s3_client, bucket, prefix, delimiter=None, start_after=None):
+    args = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': 1000}
+    if delimiter:
+        args['Delimiter'] = delimiter
+    if start_after and start_after > prefix:
+        args['StartAfter'] = start_after
+    while True:
+        response = s3_client.list_objects_v2(**args)
+        yield response
+        if not response.get('IsTruncated'):
+            return
+        args['ContinuationToken'] = response['NextContinuationToken']
+
+
+def _page_objects(response):
+    return [_slim(obj['Key'], obj['Size'], obj['LastModified'], obj.get('ETag'))
+            for obj in response.get('Contents', []) if not _is_folder_marker(obj['Key'], obj['Size'])]
+
+
+def _before(shard, start_after):
+    # True when every key under shard sorts before start_after
+    return start_after is not None and shard < start_after and not start_after.startswith(shard)
+
+
+def list_objects_sharded(s3_client, bucket, prefix, threads=16, max_depth=2, start_after=None):
+    """Yield every object under prefix, listing subfolders concurrently.
+
+    The prefix is split on '/' into the common prefixes S3 reports for it (the same subfolders
+    archivemaster groups by). If there are fewer subfolders than threads, the split goes one
+    level deeper, up to max_depth. Every shard is then listed on its own thread. With
+    start_after only keys after it are listed, subfolders entirely before it are not listed.
+    """
+    shards = [prefix]
+    # Objects listed on the way, those directly under the prefix and its subfolders so far
+    discovered_objects = 0
+    for depth in range(max_depth):
+        discovered = []
+
+        def discover(shard, emit):
+            for response in _list_pages(s3_client, bucket, shard, delimiter='/', start_after=start_after):
+                discovered.extend(common['Prefix'] for common in response.get('CommonPrefixes', []))
+                emit(_page_objects(response))
+
+        for obj in _stream(shards, threads, discover):
+            discovered_objects += 1
+            yield obj
+        shards = sorted(shard for shard in discovered if not _before(shard, start_after))
+        if len(shards) >= threads or depth == max_depth - 1:
+            break
+    if not shards:
+        print(f"Listed {discovered_objects} objects of {prefix}, there are no subfolders left to list")
+        return
+    print(f"Listed {discovered_objects} objects of {prefix} while finding subfolders, "
+          f"listing {len(shards)} subfolders on {threads} threads")
+
+    def list_shard(shard, emit):
+        for response in _list_pages(s3_client, bucket, shard, start_after=start_after):
+            emit(_page_objects(response))
+
+    yield from _stream(shards, threads, list_shard)
+
+
+def _parse_s3_uri(uri):
+    if not uri.startswith('s3://'):
+        raise ValueError(f"Expected an s3:// URI, got {uri}")
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def _inventory_time(value):
+    # Inventory CSVs use ISO 8601 with a Z suffix, which fromisoformat only accepts from 3.11 on
+    if isinstance(value, datetime.datetime):
+        return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _csv_rows(data, columns):
+    for row in csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(data)), encoding='utf-8')):
+        record = dict(zip(columns, row))
+        yield (unquote_plus(record['Key']), record.get('Size'), record.get('LastModifiedDate'),
+               record.get('ETag'), record.get('IsLatest'), record.get('IsDeleteMarker'))
+
+
+def _parquet_rows(data):
+    try:
+        import pyarrow.parquet as parquet
+    except ImportError:
+        raise ValueError("Parquet inventories need the pyarrow package")
+    for record in parquet.read_table(io.BytesIO(data)).to_pylist():
+        yield (record['key'], record.get('size'), record.get('last_modified_date'),
+               record.get('e_tag'), record.get('is_latest'), record.get('is_delete_marker'))
+
+
+def read_inventory(s3_client, manifest_uri, bucket, prefix, threads=16, start_after=None):
+    """Yield the objects under prefix from an S3 Inventory report instead of listing the bucket.
+
+    manifest_uri points at the manifest.json of one inventory delivery. CSV and Parquet reports
+    are supported; the data files are read concurrently. Objects deleted since the report was
+    produced are still yielded, packing skips them when they can't be read. With start_after
+    only keys after it are yielded.
+    """
+    manifest_bucket, manifest_key = _parse_s3_uri(manifest_uri)
+    manifest = json.loads(s3_client.get_object(Bucket=manifest_bucket, Key=manifest_key)['Body'].read())
+    if manifest['sourceBucket'] != bucket:
+        raise ValueError(f"Inventory {manifest_uri} is for bucket {manifest['sourceBucket']}, not {bucket}")
+    file_format = manifest['fileFormat'].upper()
+    if file_format not in ('CSV', 'PARQUET'):
+        raise ValueError(f"Unsupported inventory format {manifest['fileFormat']}")
+    columns = [column.strip() for column in manifest.get('fileSchema', '').split(',')]
+    data_bucket = manifest.get('destinationBucket', manifest_bucket).split(':::')[-1]
+    files = [entry['key'] for entry in manifest['files']]
+    print(f"Reading {len(files)} {file_format} inventory files from {data_bucket}")
+
+    def read_file(key, emit):
+        data = s3_client.get_object(Bucket=data_bucket, Key=key)['Body'].read()
+        rows = _csv_rows(data, columns) if file_format == 'CSV' else _parquet_rows(data)
+        page = []
+        for object_key, size, last_modified, etag, is_latest, is_delete_marker in rows:
+            if not object_key.startswith(prefix) or str(is_delete_marker).lower() == 'true':
+                continue
+            if start_after is not None and object_key <= start_after:
+                continue
+            if is_latest is not None and str(is_latest).lower() == 'false':
+                continue
+            size = int(size or 0)
+            if _is_folder_marker(object_key, size):
+                continue
+            page.append(_slim(object_key, size, _inventory_time(last_modified), etag))
+            if len(page) >= 1000:
+                emit(page)
+                page = []
+        emit(page)
+
+    yield from _stream(files, threads, read_file)
@@ -0,0 +1,172 @@
+import io
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ByteBudget:
+    """Caps the bytes held by a pipeline stage; `acquire` blocks until enough is released.
+
+    A single request larger than the whole budget is clamped to it, so it waits for the stage
+    to drain instead of waiting forever.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def _take(self, amount):
+        self.used += amount
+        self.peak = max(self.peak, self.used)
+        return amount
+
+    def try_acquire(self, amount):
+        # The amount actually reserved, or None if it doesn't fit right now
+        amount = min(amount, self.limit)
+        with self._cond:
+            if self.used + amount > self.limit:
+                return None
+            return self._take(amount)
+
+    def acquire(self, amount):
+        amount = min(amount, self.limit)
+        with self._cond:
+            while self.used + amount > self.limit:
+                self._cond.wait()
+            return self._take(amount)
+
+    def release(self, amount):
+        with self._cond:
+            self.used -= amount
+            self._cond.notify_all()
+
+
+class StageStats:
+    """Bytes moved through one pipeline stage and the time the packer spent waiting on it."""
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self._lock:
+            self.bytes += nbytes
+
+    def waited(self, seconds):
+        with self._lock:
+            self.wait_seconds += seconds
+
+
+def report_stages(stages, wall_seconds):
+    print(f"Pipeline ran for {wall_seconds:.1f} s")
+    for stage in stages:
+        rate = stage.bytes / wall_seconds / (1024 * 1024) if wall_seconds else 0
+        print(f"  {stage.name}: {stage.bytes / (1024 * 1024):.2f} MB at {rate:.2f} MB/s, "
+              f"packer waited {stage.wait_seconds:.1f} s")
+    # The stage the packer spent most time waiting on is the one holding the pipeline back; if
+    # it hardly waited at all, packing itself is
+    slowest = max(stages, key=lambda stage: stage.wait_seconds)
+    if slowest.wait_seconds > 0.05 * wall_seconds:
+        print(f"  Bottleneck: {slowest.name}")
+    else:
+        print("  Bottleneck: packing (tar and hashing on the main thread)")
+
+
+class TimedReader:
+    """Wraps a source stream read by the packer, counting its bytes and the time spent waiting for them."""
+
+    def __init__(self, fileobj, stats):
+        self.fileobj = fileobj
+        self.stats = stats
+
+    def read(self, size=-1):
+        started = time.monotonic()
+        data = self.fileobj.read(size)
+        self.stats.waited(time.monotonic() - started)
+        self.stats.add(len(data))
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+class Prefetcher:
+    """Opens source objects ahead of the packer, across archive boundaries.
+
+    `items` is the (archive number, object) sequence in packing order. Up to `max_outstanding`
+    objects are requested ahead on a thread pool, as long as their reserved bytes fit in
+    `budget`. `take(archive_number)` yields (obj, size, body, reserved) for the objects of that
+    archive; the caller releases `reserved` once it is done with the body. So while one archive
+    is finishing, the first objects of the next one are already downloading.
+    """
+
+    def __init__(self, items, open_object, budget, cost, max_outstanding, stats):
+        self.items = iter(items)
+        self.open_object = open_object
+        self.budget = budget
+        self.cost = cost
+        self.max_outstanding = max_outstanding
+        self.stats = stats
+        self._next_item = next(self.items, None)
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=max_outstanding)
+
+    def _fill(self):
+        while self._next_item is not None and len(self._pending) < self.max_outstanding:
+            cost = self.cost(self._next_item[1])
+            # Block for budget only when nothing is in flight, otherwise the packer would wait
+            # for bytes only it can release
+            reserved = self.budget.try_acquire(cost) if self._pending else self.budget.acquire(cost)
+            if reserved is None:
+                return
+            archive_number, obj = self._next_item
+            self._pending.append((archive_number, reserved, self._executor.submit(self._open, obj)))
+            self._next_item = next(self.items, None)
+
+    def _open(self, obj):
+        obj, size, body = self.open_object(obj)
+        # Streamed bodies are counted as the packer reads them
+        if isinstance(body, io.BytesIO):
+            self.stats.add(size)
+        return obj, size, body
+
+    def take(self, archive_number):
+        while True:
+            self._fill()
+            if not self._pending or self._pending[0][0] != archive_number:
+                return
+            _, reserved, future = self._pending.popleft()
+            started = time.monotonic()
+            try:
+                obj, size, body = future.result()
+            except Exception:
+                self.budget.release(reserved)
+                raise
+            self.stats.waited(time.monotonic() - started)
+            yield obj, size, body, reserved
+
+    def skip(self, archive_number):
+        # Drop whatever is still queued for an archive that failed while packing
+        for obj, size, body, reserved in self._drain(archive_number):
+            self.budget.release(reserved)
+            if body is not None:
+                body.close()
+
+    def _drain(self, archive_number):
+        while self._pending and self._pending[0][0] == archive_number:
+            _, reserved, future = self._pending.popleft()
+            try:
+                obj, size, body = future.result()
+            except Exception:
+                obj, size, body = None, 0, None
+            yield obj, size, body, reserved
+        while self._next_item is not None and self._next_item[0] == archive_number:
+            self._next_item = next(self.items, None)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,166 @@
+import datetime
+import gzip
+import heapq
+import json
+import tempfile
+from array import array
+
+from catalog import ObjectCatalog
+
+
+class _FirstFitTree:
+    """Max segment tree over the remaining capacity of the bins opened so far.
+
+    Finds the first (lowest numbered) bin that can still take an object in O(log bins), which
+    keeps first-fit-decreasing at O(n log n) instead of scanning every open bin per object.
+    The tree doubles as bins are opened, so it is sized by the bins rather than the objects.
+    """
+
+    def __init__(self):
+        self.leaves = 1
+        self.tree = array('q', [-1, -1])
+
+    def first_fit(self, size):
+        # Index of the first bin whose remaining capacity is larger than size, or None
+        if self.tree[1] <= size:
+            return None
+        node = 1
+        while node < self.leaves:
+            node *= 2
+            if self.tree[node] <= size:
+                node += 1
+        return node - self.leaves
+
+    def _grow(self):
+        leaves = self.leaves
+        tree = array('q', [-1]) * (4 * leaves)
+        tree[2 * leaves:3 * leaves] = self.tree[leaves:]
+        for node in range(2 * leaves - 1, 0, -1):
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+        self.leaves, self.tree = 2 * leaves, tree
+
+    def update(self, index, remaining):
+        while index >= self.leaves:
+            self._grow()
+        node = index + self.leaves
+        self.tree[node] = remaining
+        node //= 2
+        while node:
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+            node //= 2
+
+
+def _pack(catalog, subfolder, size_limit, count_limit):
+    # First-fit-decreasing on object sizes. Like the original greedy packing, an archive stays
+    # strictly below size_limit unless a single object is larger than the limit on its own.
+    # Bins only hold catalog row numbers.
+    tree = _FirstFitTree()
+    bins = []
+    for row, size in catalog.by_size(subfolder):
+        index = tree.first_fit(size)
+        if index is None:
+            index = len(bins)
+            bins.append({'rows': array('I'), 'size': 0})
+        archive = bins[index]
+        archive['rows'].append(row)
+        archive['size'] += size
+        full = len(archive['rows']) >= count_limit or archive['size'] >= size_limit
+        tree.update(index, -1 if full else size_limit - archive['size'])
+    # Members are stored in key order, which is also the order restores ask for them in
+    return [{'objects': catalog.objects(catalog.sorted_by_key(archive['rows'])), 'size': archive['size']}
+            for archive in bins]
+
+
+def plan_archives(catalog, size_limit, count_limit, group_by_subfolder=False):
+    """Compute every archive of the job from listing metadata (Key, Size) alone.
+
+    Returns a list of {'objects': [...], 'size': total bytes, 'subfolder': name or None}, where
+    objects is an ObjectList over the catalog. With group_by_subfolder every archive only holds
+    objects of one subfolder.
+    """
+    if group_by_subfolder:
+        plan = []
+        for subfolder in sorted(catalog.subfolders()):
+            for archive in _pack(catalog, subfolder, size_limit, count_limit):
+                archive['subfolder'] = subfolder
+                plan.append(archive)
+        return plan
+    plan = _pack(catalog, None, size_limit, count_limit)
+    for archive in plan:
+        archive['subfolder'] = None
+    return plan
+
+
+def print_plan(plan, size_limit, count_limit, limit=None):
+    total_size = sum(archive['size'] for archive in plan)
+    total_files = sum(len(archive['objects']) for archive in plan)
+    print(f"Archive plan: {len(plan)} archives, {total_files} files, {total_size / (1024 * 1024):.2f} MB")
+    if plan:
+        fill = total_size / (len(plan) * size_limit) * 100
+        print(f"Average archive fill: {fill:.1f}% of {size_limit / (1024 * 1024):.0f} MB, "
+              f"{total_files / len(plan):.1f} of {count_limit} files")
+    for number, archive in enumerate(plan[:limit], start=1):
+        subfolder = f" [{archive['subfolder']}]" if archive['subfolder'] else ""
+        print(f"  part{number}{subfolder}: {len(archive['objects'])} files, {archive['size'] / (1024 * 1024):.2f} MB, "
+              f"{archive['objects'][0]['Key']} .. {archive['objects'][-1]['Key']}")
+    if limit is not None and len(plan) > limit:
+        print(f"  ... and {len(plan) - limit} more archives")
+
+
+def write_plan(s3_client, bucket, key, plan, spill_dir=None, source=None):
+    # Stored once by the planning job of a sharded run and read by every archiving shard: one
+    # JSON line per archive, compressed into a local file an archive at a time. The first line
+    # holds the source the plan was made for.
+    with tempfile.TemporaryFile(dir=spill_dir) as body:
+        with gzip.GzipFile(fileobj=body, mode='wb') as out:
+            if source is not None:
+                out.write(json.dumps({'source': source}).encode('utf-8') + b'\n')
+            for archive in plan:
+                line = dict(archive, objects=[dict(obj, LastModified=obj['LastModified'].isoformat())
+                                              for obj in archive['objects']])
+                out.write(json.dumps(line).encode('utf-8') + b'\n')
+        body.seek(0)
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=body,
+            ContentType='application/json',
+            ContentEncoding='gzip'
+        )
+
+
+def read_plan(s3_client, bucket, key, catalog=None, source=None):
+    # The objects go into catalog (a new one if not given), the plan only keeps their rows.
+    # Raises ValueError when source is given and the plan was made for another one.
+    catalog = catalog if catalog is not None else ObjectCatalog()
+    plan = []
+    with gzip.GzipFile(fileobj=s3_client.get_object(Bucket=bucket, Key=key)['Body'], mode='rb') as body:
+        for line in body:
+            archive = json.loads(line)
+            if 'source' in archive:
+                stored = archive['source']
+                if source is not None and stored != source:
+                    raise ValueError(f"Plan {key} was made for {stored['bucket']}/{stored['prefix']}, "
+                                     f"not {source['bucket']}/{source['prefix']}")
+                continue
+            rows = array('I', (catalog.add(dict(obj, LastModified=datetime.datetime.fromisoformat(obj['LastModified'])))
+                               for obj in archive['objects']))
+            plan.append(dict(archive, objects=catalog.objects(rows)))
+    return plan
+
+
+def shard_archives(plan, shard_count, shard_index):
+    """Return the (archive number, archive) pairs of the plan that shard_index archives.
+
+    Archives are handed out largest first to the shard with the fewest bytes so far, so shards
+    end up within one archive of each other. Archive numbers are positions in the whole plan,
+    which keeps archive names unique across shards.
+    """
+    loads = [(0, shard) for shard in range(shard_count)]
+    assigned = []
+    for number, archive in sorted(enumerate(plan, start=1), key=lambda item: (-item[1]['size'], item[0])):
+        load, shard = heapq.heappop(loads)
+        if shard == shard_index:
+            assigned.append((number, archive))
+        heapq.heappush(loads, (load + archive['size'], shard))
+    return sorted(assigned, key=lambda item: item[0])
@@ -0,0 +1,85 @@
+import json
+
+from botocore.exceptions import ClientError
+
+# A sharded run keeps its plan and the result of every shard in the destination bucket:
+#
+#   runs/<project>/<run id>/plan.json.gz     written by the planning job
+#   runs/<project>/<run id>/shard-<n>.json   written by every archiving shard when it finishes
+#   runs/<project>/<run id>/summary.json     written by the aggregate job
+#   runs/<project>/<run id>/duplicates/<archive>.json
+#                                            copies left out of an archive by deduplication
+#   runs/<project>/<run id>/skipped/<archive>.json
+#                                            planned objects that were gone when it was packed
+#   runs/<project>/<run id>/watermark.json   where an incremental run moves the watermark to
+#
+# Incremental runs of a prefix list only the keys after its watermark, the last key up to
+# which everything has been archived:
+#
+#   watermarks/<project>/<prefix>/watermark.json
+
+
+def run_prefix(project_name, run_id):
+    return f"runs/{project_name}/{run_id}/"
+
+
+def plan_key(project_name, run_id):
+    return run_prefix(project_name, run_id) + 'plan.json.gz'
+
+
+def shard_result_key(project_name, run_id, shard_index):
+    return run_prefix(project_name, run_id) + f'shard-{shard_index}.json'
+
+
+def summary_key(project_name, run_id):
+    return run_prefix(project_name, run_id) + 'summary.json'
+
+
+def duplicates_key(project_name, run_id, archive_name):
+    return run_prefix(project_name, run_id) + f'duplicates/{archive_name}.json'
+
+
+def skipped_key(project_name, run_id, archive_name):
+    return run_prefix(project_name, run_id) + f'skipped/{archive_name}.json'
+
+
+def pending_watermark_key(project_name, run_id):
+    return run_prefix(project_name, run_id) + 'watermark.json'
+
+
+def watermark_key(project_name, prefix):
+    return f"watermarks/{project_name}/{prefix.rstrip('/')}/watermark.json"
+
+
+def advance_watermark(s3_client, bucket, project_name, run_id):
+    # Once a run has archived everything it planned, its prefix's watermark moves to where the
+    # run recorded; it never moves back. Returns the watermark now in place, None if the run
+    # was not incremental.
+    pending = read_result(s3_client, bucket, pending_watermark_key(project_name, run_id))
+    if pending is None:
+        return None
+    key = watermark_key(project_name, pending['prefix'])
+    current = read_result(s3_client, bucket, key)
+    if current is not None and (pending['start_after'] or '') <= (current['start_after'] or ''):
+        return current
+    write_result(s3_client, bucket, key, pending)
+    return pending
+
+
+def write_result(s3_client, bucket, key, result):
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(result, indent=2).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+
+def read_result(s3_client, bucket, key):
+    # None if the object was never written, e.g. by a shard that didn't finish
+    try:
+        return json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
@@ -0,0 +1,57 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from backoff import attempts
+
+DELETE_LIMIT = 1000   # S3 limit on keys per DeleteObjects request
+
+
+class SourceDeleter:
+    """Deletes archived source objects with DeleteObjects, 1,000 keys per request.
+
+    Requests run concurrently on a thread pool. Keys S3 reports as failed, or whose request
+    failed as a whole, are retried with backoff up to `max_attempts` times.
+    """
+
+    def __init__(self, s3_client, bucket, threads=8, max_attempts=5, base_delay=0.2):
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.threads = threads
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.deleted = 0
+        self.failed = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def delete(self, keys):
+        # Returns {key: error} for the keys that are still there after every attempt
+        errors = {}
+        remaining = list(keys)
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for attempt in attempts(self.max_attempts, self.base_delay, max_delay=None):
+                chunks = [remaining[i:i + DELETE_LIMIT] for i in range(0, len(remaining), DELETE_LIMIT)]
+                errors = {}
+                for chunk_errors in executor.map(self._delete_chunk, chunks):
+                    errors.update(chunk_errors)
+                remaining = list(errors)
+                if not remaining:
+                    break
+        with self._lock:
+            self.deleted += len(keys) - len(errors)
+            self.failed += len(errors)
+        return errors
+
+    def _delete_chunk(self, keys):
+        with self._lock:
+            self.requests += 1
+        try:
+            response = self.s3.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+            )
+        except (ClientError, BotoCoreError) as e:
+            return {key: str(e) for key in keys}
+        return {error['Key']: f"{error.get('Code')}: {error.get('Message')}" for error in response.get('Errors', [])}
@@ -0,0 +1,401 @@
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+
+from corpus import SHAPES, generate
+from request_counter import CountingProxy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common', 'layer', 'python'))
+from manifest_index import ManifestIndex, directories, manifest_index_table  # noqa: E402
+
+# Runs archivemaster.py and restore.py as they run in their containers, against local
+# stand-ins for S3, DynamoDB and SNS (moto server by default, or MinIO / DynamoDB Local), and
+# writes what it measured as JSON. See the "Benchmarks" section of the README.
+BATCH_APPS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ARCHIVER = os.path.join(BATCH_APPS, 'archive-master', 'archivemaster.py')
+RESTORER = os.path.join(BATCH_APPS, 'restorer', 'restore.py')
+MB = 1024 * 1024
+SAMPLE_INTERVAL = 0.2
+EMF_METRICS = ('Seconds', 'Bytes', 'Items', 'Requests', 'Retries', 'Errors', 'Throughput')
+
+# Lines of the job logs that end a phase; a phase whose line never shows up is merged into the next
+ARCHIVE_PHASES = [
+    ('list', re.compile(r'^(Found \d+ files in|Resuming run)')),
+    ('plan', re.compile(r'^(Stored the plan of run|Dry run requested)')),
+    ('archive', re.compile(r'^File Manifest Stored')),
+    ('report', None),
+]
+RESTORE_PHASES = [
+    ('index', re.compile(r'^(Fetching|Streaming|No member index)')),
+    ('restore', re.compile(r'^Transfers:')),
+    ('notify', None),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the archive and restore jobs against local stand-ins")
+    parser.add_argument('--shape', choices=sorted(SHAPES), default='mixed',
+                        help='; '.join(f"{name}: {text}" for name, text in sorted(SHAPES.items())))
+    parser.add_argument('--files', type=int, default=1000, help="files in the corpus")
+    parser.add_argument('--size-mb', type=int, default=64, help="size of every file of the huge shape")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--archive-size-mb', type=int, default=256, help="ARCHIVE_SIZE of the archive job")
+    parser.add_argument('--file-count', type=int, default=10000, help="FILE_COUNT of the archive job")
+    parser.add_argument('--restore-files', type=int, default=10,
+                        help="members of the first archive to restore, 0 to skip the restore benchmark")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help="extra environment for both jobs, e.g. COMPRESSION_CODEC=zstd")
+    parser.add_argument('--s3-endpoint', help="S3 stand-in to use instead of moto, e.g. MinIO at http://localhost:9000")
+    parser.add_argument('--dynamodb-endpoint', help="DynamoDB stand-in to use instead of moto, e.g. DynamoDB Local")
+    parser.add_argument('--moto-port', type=int, default=5055)
+    parser.add_argument('--output', help="result file, default results/<shape>-<time>.json next to this script")
+    parser.add_argument('--compare', help="earlier result file to compare against")
+    return parser.parse_args()
+
+
+def start_moto(port):
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        raise SystemExit("moto is not installed: pip install 'moto[server]', or pass --s3-endpoint and --dynamodb-endpoint")
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    return server, f"http://127.0.0.1:{port}"
+
+
+def clients(endpoints):
+    config = Config(s3={'addressing_style': 'path'}, max_pool_connections=64, retries={'mode': 'standard'})
+    return {service: boto3.client(service, endpoint_url=endpoint, config=config)
+            for service, endpoint in endpoints.items()}
+
+
+def create_resources(aws, project):
+    for bucket in ('bench-src', 'bench-dest', 'bench-restore'):
+        aws['s3'].create_bucket(Bucket=bucket)
+    tables = {
+        f'{project}_archive_master': [('key', 'HASH')],
+        f'{project}_archive_journal': [('run_id', 'HASH'), ('archive_name', 'RANGE')],
+        f'{project}_restore_tracker': [('archive_key', 'HASH'), ('key', 'RANGE')],
+        f'{project}_restore_cache': [('archive_key', 'HASH'), ('member', 'RANGE')],
+        f'{project}_manifest_index': [('partition', 'HASH'), ('archive_name', 'RANGE')],
+    }
+    for table, schema in tables.items():
+        aws['dynamodb'].create_table(
+            TableName=table,
+            KeySchema=[{'AttributeName': name, 'KeyType': key_type} for name, key_type in schema],
+            AttributeDefinitions=[{'AttributeName': name, 'AttributeType': 'S'} for name, _ in schema],
+            BillingMode='PAY_PER_REQUEST'
+        )
+    return aws['sns'].create_topic(Name=f'{project}-restore')['TopicArn']
+
+
+def process_tree(root_pid):
+    # Pids of root_pid and all of its descendants, from /proc
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as stat:
+                    parent = int(stat.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(parent, []).append(int(entry))
+    pids, pending = [], [root_pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(children.get(pid, []))
+    return pids
+
+
+def peak_rss(pid):
+    # High-water mark of one process's resident memory, kept by the kernel since its exec
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def tree_rss(root_pid):
+    total = 0
+    for pid in process_tree(root_pid):
+        try:
+            with open(f'/proc/{pid}/statm') as statm:
+                total += int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+def disk_usage(path):
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def run_job(name, script, env, work_dir, phases, log_path):
+    """Run one job to completion; returns its exit code, wall time, memory, disk and phases."""
+    started = time.monotonic()
+    process = subprocess.Popen([sys.executable, '-u', script], cwd=work_dir, env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    peaks = {'rss': 0, 'tree_rss': 0, 'disk': 0}
+    done = threading.Event()
+
+    def sample():
+        # Memory of the job with its compression workers, and what it keeps on local disk
+        while not done.is_set():
+            peaks['rss'] = max(peaks['rss'], peak_rss(process.pid))
+            peaks['tree_rss'] = max(peaks['tree_rss'], tree_rss(process.pid))
+            peaks['disk'] = max(peaks['disk'], disk_usage(work_dir))
+            done.wait(SAMPLE_INTERVAL)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    phase_times = {}
+    # What the job reported about its own phases, from its metric records
+    job_metrics = {}
+    phase, phase_started = 0, started
+    with open(log_path, 'wb') as log:
+        for line in process.stdout:
+            log.write(line)
+            if line.startswith(b'{"_aws"'):
+                record = json.loads(line)
+                job_metrics[record['Phase']] = {metric: record[metric] for metric in EMF_METRICS}
+            pattern = phases[phase][1]
+            if pattern is not None and pattern.search(line.decode('utf-8', 'replace')):
+                now = time.monotonic()
+                phase_times[phases[phase][0]] = round(now - phase_started, 3)
+                phase, phase_started = phase + 1, now
+    # wait4 reports the CPU time of the job and every process it waited for. Its maxrss is
+    # not used, a forked child starts out with the RSS of this process.
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    ended = time.monotonic()
+    done.set()
+    sampler.join()
+    phase_times[phases[phase][0]] = round(ended - phase_started, 3)
+    print(f"{name}: exit code {process.returncode} after {ended - started:.1f} s, log in {log_path}")
+    return {
+        'exit_code': process.returncode,
+        'wall_seconds': round(ended - started, 3),
+        'phases': phase_times,
+        'job_metrics': job_metrics,
+        'peak_rss_mb': round(peaks['rss'] / MB, 1),
+        'peak_tree_rss_mb': round(peaks['tree_rss'] / MB, 1),
+        'disk_high_water_mb': round(peaks['disk'] / MB, 1),
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3),
+        'log': log_path,
+    }
+
+
+def job_env(proxies, work_dir, settings):
+    env = {name: value for name, value in os.environ.items() if not name.startswith('AWS_')}
+    config_file = os.path.join(work_dir, 'aws-config')
+    with open(config_file, 'w') as config:
+        # Path-style addressing works with every S3 stand-in
+        config.write("[default]\nregion = us-east-1\ns3 =\n    addressing_style = path\n")
+    env.update({
+        'AWS_ACCESS_KEY_ID': os.environ.get('AWS_ACCESS_KEY_ID', 'benchmark'),
+        'AWS_SECRET_ACCESS_KEY': os.environ.get('AWS_SECRET_ACCESS_KEY', 'benchmark'),
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_CONFIG_FILE': config_file,
+        'AWS_SHARED_CREDENTIALS_FILE': os.devnull,
+        'PYTHONPATH': os.pathsep.join([os.path.join(BATCH_APPS, 'common'), os.path.join(BATCH_APPS, 'common', 'layer', 'python'),
+                                       os.path.join(BATCH_APPS, 'archive-master')]),
+        'TMPDIR': work_dir,
+        'CATALOG_DIR': work_dir,
+    })
+    # Every service call goes through its counting proxy
+    for service, proxy in proxies.items():
+        env[f'AWS_ENDPOINT_URL_{service.upper()}'] = proxy.endpoint
+    env.update(settings)
+    return env
+
+
+def index_selectivity(aws, project, stored, dedup):
+    # For every directory of the corpus, the archives a prefix restore selects from the manifest
+    # index and the keys it matches, against the archives holding files under the directory
+    # according to their member indexes. Copies left out by dedup are listed in the key file of
+    # the archive that found them, so with dedup that archive is selected too.
+    holding = {}
+    for obj in stored:
+        index = json.loads(gzip.decompress(
+            aws['s3'].get_object(Bucket='bench-dest', Key=obj['Key'] + '.index.json.gz')['Body'].read()))
+        for member in index['members']:
+            for directory in directories(member['name']):
+                archives, keys = holding.setdefault(directory, (set(), set()))
+                archives.add(obj['Key'])
+                keys.add(member['name'])
+    manifest_index = ManifestIndex(aws['dynamodb'], aws['s3'], manifest_index_table(project), 'bench-dest')
+    report = {}
+    for directory, (archives, keys) in sorted(holding.items()):
+        selected = set(manifest_index.archives(directory))
+        matched = set(manifest_index.match(directory))
+        exact = selected >= archives and matched >= keys if dedup else selected == archives and matched == keys
+        report[directory or '/'] = {'archives': len(stored), 'selected': len(selected), 'holding': len(archives),
+                                    'matched': len(matched), 'exact': exact}
+    return report
+
+
+def counted(proxies):
+    report = {service: proxy.report() for service, proxy in proxies.items()}
+    for proxy in proxies.values():
+        proxy.reset()
+    return report
+
+
+def compare(result, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f"Compared with {baseline_path} ({baseline.get('started')}, {baseline.get('git_commit')}):")
+    for job in ('archive', 'restore'):
+        if job not in result or job not in baseline:
+            continue
+        for metric in ('wall_seconds', 'files_per_sec', 'mb_per_sec', 'peak_tree_rss_mb', 'disk_high_water_mb',
+                       'cpu_seconds', 'total_requests'):
+            now, before = result[job].get(metric), baseline[job].get(metric)
+            if now is None or before is None:
+                continue
+            change = f"{(now - before) / before * 100:+.1f}%" if before else "n/a"
+            print(f"  {job} {metric}: {before} -> {now} ({change})")
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BATCH_APPS, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_args()
+    extra_env = dict(setting.split('=', 1) for setting in args.env)
+    project = 'bench'
+    started = datetime.datetime.now(datetime.timezone.utc)
+    results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+    output = args.output or os.path.join(results_dir, f"{args.shape}-{started:%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='archive-bench-')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    # moto stands in for every service without an endpoint of its own, SNS always
+    moto, moto_endpoint = start_moto(args.moto_port)
+    endpoints = {
+        's3': args.s3_endpoint or moto_endpoint,
+        'dynamodb': args.dynamodb_endpoint or moto_endpoint,
+        'sns': moto_endpoint,
+    }
+    proxies = {service: CountingProxy(service, endpoint).start() for service, endpoint in endpoints.items()}
+    aws = clients(endpoints)
+    result = {
+        'started': started.isoformat(),
+        'git_commit': git_commit(),
+        'stand_ins': endpoints,
+        'config': {'shape': args.shape, 'files': args.files, 'size_mb': args.size_mb, 'seed': args.seed,
+                   'archive_size_mb': args.archive_size_mb, 'file_count': args.file_count,
+                   'restore_files': args.restore_files, 'env': extra_env},
+    }
+    try:
+        topic_arn = create_resources(aws, project)
+        print(f"Generating {args.files} files of shape {args.shape}")
+        setup_started = time.monotonic()
+        files, total_bytes = generate(aws['s3'], 'bench-src', 'corpus/', args.shape, args.files, args.size_mb, args.seed)
+        result['corpus'] = {'files': files, 'bytes': total_bytes, 'setup_seconds': round(time.monotonic() - setup_started, 3)}
+        print(f"Corpus: {files} files, {total_bytes / MB:.1f} MB")
+
+        env = job_env(proxies, work_dir, {
+            'PROJECT_NAME': project, 'SRC_BUCKET_NAME': 'bench-src', 'DEST_BUCKET_NAME': 'bench-dest',
+            'PREFIX': 'corpus', 'ARCHIVE_SIZE': str(args.archive_size_mb), 'FILE_COUNT': str(args.file_count),
+            'RUN_ID': f"bench{started:%Y%m%d%H%M%S}",
+        })
+        env.update(extra_env)
+        archive = run_job('archive', ARCHIVER, env, work_dir, ARCHIVE_PHASES, os.path.join(work_dir, 'archive.log'))
+        archive.update(counted(proxies))
+        archive['total_requests'] = sum(service['total_requests'] for service in archive.values()
+                                        if isinstance(service, dict) and 'total_requests' in service)
+        archive['files_per_sec'] = round(files / archive['wall_seconds'], 1)
+        archive['mb_per_sec'] = round(total_bytes / MB / archive['wall_seconds'], 2)
+        stored = [obj for page in aws['s3'].get_paginator('list_objects_v2').paginate(Bucket='bench-dest')
+                  for obj in page.get('Contents', []) if obj['Key'].endswith(('.tar.gz', '.tar.zst'))]
+        archive['archives'] = len(stored)
+        archive['archived_bytes'] = sum(obj['Size'] for obj in stored)
+        result['archive'] = archive
+        if stored and archive['exit_code'] == 0:
+            result['index_selectivity'] = index_selectivity(aws, project, stored, extra_env.get('DEDUP') == 'true')
+            for directory, selectivity in result['index_selectivity'].items():
+                print(f"Prefix {directory}: {selectivity['selected']} of {selectivity['archives']} archives selected, "
+                      f"{selectivity['holding']} hold its files"
+                      + ("" if selectivity['exact'] else ", NOT EXACT"))
+
+        if args.restore_files and stored and archive['exit_code'] == 0:
+            archive_key = stored[0]['Key']
+            index = json.loads(gzip.decompress(
+                aws['s3'].get_object(Bucket='bench-dest', Key=archive_key + '.index.json.gz')['Body'].read()))
+            members = [member['name'] for member in index['members']][:args.restore_files]
+            # What the restore Lambda does before it submits the job
+            aws['s3'].restore_object(Bucket='bench-dest', Key=archive_key, RestoreRequest={'Days': 1})
+            counted(proxies)
+            restore_env = dict(env, ARCHIVE_KEY=archive_key, KEYS=json.dumps(members), SRC_BUCKET_NAME='bench-dest',
+                               RESTORE_BUCKET_NAME='bench-restore', TOPIC_ARN=topic_arn)
+            restore = run_job('restore', RESTORER, restore_env, work_dir, RESTORE_PHASES,
+                              os.path.join(work_dir, 'restore.log'))
+            restore.update(counted(proxies))
+            restore['total_requests'] = sum(service['total_requests'] for service in restore.values()
+                                            if isinstance(service, dict) and 'total_requests' in service)
+            restored_bytes = sum(member['size'] for member in index['members'][:args.restore_files])
+            restore['files'] = len(members)
+            restore['files_per_sec'] = round(len(members) / restore['wall_seconds'], 1)
+            restore['mb_per_sec'] = round(restored_bytes / MB / restore['wall_seconds'], 2)
+            result['restore'] = restore
+    finally:
+        for proxy in proxies.values():
+            proxy.stop()
+        moto.stop()
+
+    # Logs go next to the result, the work directory is removed
+    for job in ('archive', 'restore'):
+        if job in result:
+            log_copy = os.path.splitext(output)[0] + f'.{job}.log'
+            shutil.copy(result[job]['log'], log_copy)
+            result[job]['log'] = log_copy
+    shutil.rmtree(work_dir, ignore_errors=True)
+    with open(output, 'w') as output_file:
+        json.dump(result, output_file, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(result, args.compare)
+    if result.get('archive', {}).get('exit_code') or result.get('restore', {}).get('exit_code'):
+        exit(1)
+    if not all(selectivity['exact'] for selectivity in result.get('index_selectivity', {}).values()):
+        print("The manifest index selects other archives or keys than those holding the files of a prefix")
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
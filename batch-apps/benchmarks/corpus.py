@@ -0,0 +1,83 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.s3.transfer import TransferConfig
+
+MB = 1024 * 1024
+# Words for text content, which compresses roughly like CSV or log data
+WORDS = [b'archive', b'bucket', b'customer', b'2025-04-10', b'invoice', b'status=OK', b'region', b'0.75',
+         b'order_id', b'12345', b'glacier', b'restore', b'true', b'false', b'null', b'payload']
+
+# name -> description; every shape is a function of (files, size_mb, seed) yielding
+# (relative key, size, content kind)
+SHAPES = {
+    'tiny': "many files of 100 B to 4 KB in a few subfolders",
+    'huge': "a few files of size_mb each",
+    'mixed': "text, random and already compressed files of 1 KB to 8 MB",
+    'deep': "small text files spread over a deep subfolder tree",
+}
+
+
+def _tiny(files, size_mb, rng):
+    for i in range(files):
+        yield f"sub{i % 8}/tiny{i:08d}.txt", rng.randint(100, 4096), 'text'
+
+
+def _huge(files, size_mb, rng):
+    for i in range(files):
+        yield f"huge/blob{i:04d}.bin", size_mb * MB, 'random' if i % 2 else 'text'
+
+
+def _mixed(files, size_mb, rng):
+    kinds = (('text', '.csv'), ('random', '.bin'), ('random', '.jpg'), ('random', '.gz'))
+    for i in range(files):
+        kind, extension = kinds[i % len(kinds)]
+        size = int(2 ** rng.uniform(10, 23))
+        yield f"sub{i % 4}/mixed{i:07d}{extension}", size, kind
+
+
+def _deep(files, size_mb, rng, depth=6, fanout=4):
+    for i in range(files):
+        parts = [f"d{rng.randrange(fanout)}" for _ in range(depth)]
+        yield '/'.join(parts) + f"/deep{i:07d}.json", rng.randint(200, 64 * 1024), 'text'
+
+
+GENERATORS = {'tiny': _tiny, 'huge': _huge, 'mixed': _mixed, 'deep': _deep}
+
+
+class SyntheticFile:
+    """Readable stream of `size` bytes of text or random content, produced as it is read."""
+
+    def __init__(self, size, kind, seed):
+        self.remaining = size
+        self.kind = kind
+        self.rng = random.Random(seed)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.remaining
+        size = min(size, self.remaining)
+        self.remaining -= size
+        if self.kind == 'random':
+            return self.rng.randbytes(size)
+        line = b' '.join(self.rng.choice(WORDS) for _ in range(12)) + b'\n'
+        return (line * (size // len(line) + 1))[:size]
+
+
+def generate(s3_client, bucket, prefix, shape, files, size_mb=64, seed=1, threads=32):
+    """Upload a synthetic corpus under prefix; returns its file count and total bytes."""
+    rng = random.Random(seed)
+    objects = list(GENERATORS[shape](files, size_mb, rng))
+    transfer = TransferConfig(multipart_threshold=64 * MB, multipart_chunksize=64 * MB)
+
+    def upload(item):
+        number, (key, size, kind) = item
+        body = SyntheticFile(size, kind, seed * 1000003 + number)
+        if size > transfer.multipart_threshold:
+            s3_client.upload_fileobj(body, bucket, prefix + key, Config=transfer)
+        else:
+            s3_client.put_object(Bucket=bucket, Key=prefix + key, Body=body.read())
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(upload, enumerate(objects)))
+    return len(objects), sum(size for _, size, _ in objects)
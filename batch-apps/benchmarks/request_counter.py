@@ -0,0 +1,188 @@
+import http.client
+import sys
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+RELAY_CHUNK = 1024 * 1024
+# Response headers that describe the hop rather than the content, the proxy sets its own
+HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'content-length')
+
+
+def s3_operation(method, path, query, headers):
+    # Name of the S3 API call behind a path-style request
+    bucket_level = '/' not in path.strip('/')
+    if 'uploadId' in query:
+        if method == 'PUT':
+            return 'UploadPartCopy' if 'x-amz-copy-source' in headers else 'UploadPart'
+        return {'POST': 'CompleteMultipartUpload', 'DELETE': 'AbortMultipartUpload',
+                'GET': 'ListParts'}.get(method, f'S3 {method}')
+    if 'uploads' in query:
+        return 'CreateMultipartUpload' if method == 'POST' else 'ListMultipartUploads'
+    if 'delete' in query and method == 'POST':
+        return 'DeleteObjects'
+    if 'restore' in query:
+        return 'RestoreObject'
+    if bucket_level:
+        if method == 'GET':
+            return 'ListObjectsV2' if query.get('list-type') == ['2'] else 'ListObjects'
+        return {'PUT': 'CreateBucket', 'HEAD': 'HeadBucket', 'DELETE': 'DeleteBucket'}.get(method, f'S3 {method}')
+    if method == 'PUT':
+        return 'CopyObject' if 'x-amz-copy-source' in headers else 'PutObject'
+    return {'GET': 'GetObject', 'HEAD': 'HeadObject', 'DELETE': 'DeleteObject'}.get(method, f'S3 {method}')
+
+
+class _QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping kept-alive connections are not worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class CountingProxy:
+    """HTTP proxy in front of one local stand-in service that counts the API calls sent to it.
+
+    The benchmarked scripts get the proxy as their endpoint for the service. Requests are
+    relayed unchanged, Host header included, so signatures still verify against stand-ins that
+    check them. `service` is 's3', 'dynamodb' or 'sns' and decides how calls are named.
+    """
+
+    def __init__(self, service, upstream, port=0):
+        self.service = service
+        self.upstream = urlsplit(upstream)
+        self.requests = Counter()
+        self.errors = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.server = _QuietServer(('127.0.0.1', port), self._handler())
+        self.endpoint = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.errors.clear()
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    def report(self):
+        with self._lock:
+            return {'requests': dict(sorted(self.requests.items())), 'errors': dict(sorted(self.errors.items())),
+                    'total_requests': sum(self.requests.values()),
+                    'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received}
+
+    def _operation(self, method, path, headers, body):
+        split = urlsplit(path)
+        query = parse_qs(split.query, keep_blank_values=True)
+        if self.service == 's3':
+            return s3_operation(method, split.path, query, {name.lower() for name in headers})
+        if self.service == 'dynamodb':
+            return (headers.get('X-Amz-Target') or 'DynamoDB ?').rpartition('.')[2]
+        action = parse_qs(body.decode('utf-8', 'replace')).get('Action', query.get('Action', ['?']))
+        return action[0]
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(
+                self.upstream.hostname, self.upstream.port, timeout=300)
+        return connection
+
+    def _record(self, operation, status, sent, received):
+        with self._lock:
+            self.requests[operation] += 1
+            if status >= 400:
+                self.errors[f"{operation} {status}"] += 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def _handler(self):
+        proxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _read_body(self):
+                if 'chunked' in (self.headers.get('Transfer-Encoding') or '').lower():
+                    # Relayed as is, the chunk framing is part of what was signed for aws-chunked uploads
+                    raw = bytearray()
+                    while True:
+                        line = self.rfile.readline()
+                        raw += line
+                        size = int(line.split(b';')[0].strip() or b'0', 16)
+                        if size == 0:
+                            while True:
+                                trailer = self.rfile.readline()
+                                raw += trailer
+                                if trailer in (b'\r\n', b'\n', b''):
+                                    return bytes(raw)
+                        raw += self.rfile.read(size + 2)
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def _relay(self):
+                body = self._read_body()
+                operation = proxy._operation(self.command, self.path, self.headers, body)
+                for attempt in range(2):
+                    connection = proxy._connection()
+                    try:
+                        connection.putrequest(self.command, self.path, skip_host=True, skip_accept_encoding=True)
+                        for name, value in self.headers.items():
+                            if name.lower() not in ('connection', 'keep-alive'):
+                                connection.putheader(name, value)
+                        connection.endheaders(body or None)
+                        response = connection.getresponse()
+                        break
+                    except (ConnectionError, http.client.HTTPException):
+                        # The stand-in closed a kept-alive connection, retry once on a new one
+                        connection.close()
+                        proxy._local.connection = None
+                        if attempt:
+                            raise
+                self.send_response(response.status, response.reason)
+                for name, value in response.getheaders():
+                    if name.lower() not in HOP_HEADERS:
+                        self.send_header(name, value)
+                received = 0
+                if self.command == 'HEAD':
+                    self.send_header('Content-Length', response.getheader('Content-Length') or '0')
+                    self.end_headers()
+                    response.read()
+                elif response.getheader('Content-Length') is not None:
+                    self.send_header('Content-Length', response.getheader('Content-Length'))
+                    self.end_headers()
+                    while True:
+                        chunk = response.read(RELAY_CHUNK)
+                        if not chunk:
+                            break
+                        received += len(chunk)
+                        self.wfile.write(chunk)
+                else:
+                    data = response.read()
+                    received = len(data)
+                    self.send_header('Content-Length', str(received))
+                    self.end_headers()
+                    self.wfile.write(data)
+                if response.will_close:
+                    connection.close()
+                    proxy._local.connection = None
+                proxy._record(operation, response.status, len(body), received)
+
+            do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _relay
+
+        return Handler
@@ -0,0 +1,111 @@
+import gzip
+import hashlib
+import json
+import tarfile
+
+from botocore.exceptions import ClientError
+
+from compression import decompressing_reader
+
+# The index of `<archive>` is stored next to it as `<archive>.index.json.gz`, in a storage class
+# that can be read without thawing the archive:
+#
+#   {"archive": ..., "codec": "gzip", "version": 1, "members": [
+#       {"name": ..., "offset": ..., "length": ..., "inner_offset": ..., "size": ..., "sha256": ...}]}
+#
+# offset/length is the compressed byte range of the blocks holding the member's tar header and
+# data, inner_offset is where the tar header starts once that range is decompressed. Archives
+# packed with compressibility detection add "compression" ("compressed" or "stored") to every
+# member, and "ratio" when a sample of it was trial compressed.
+INDEX_SUFFIX = '.index.json.gz'
+INDEX_VERSION = 1
+
+
+def index_key(archive_key):
+    return archive_key + INDEX_SUFFIX
+
+
+class HashingReader:
+    """Readable wrapper that computes the sha256 of everything read through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+class ArchiveIndexBuilder:
+    """Collects member positions in the uncompressed tar stream while an archive is written."""
+
+    def __init__(self, archive_name, codec):
+        self.archive_name = archive_name
+        self.codec = codec
+        self._members = []
+
+    def add(self, name, raw_start, raw_end, size, sha256, **attrs):
+        self._members.append((name, raw_start, raw_end, size, sha256, attrs))
+
+    def build(self, compressor):
+        # Resolve the raw tar offsets into compressed ranges once all blocks have been written
+        members = []
+        for name, raw_start, raw_end, size, sha256, attrs in self._members:
+            offset, length, inner_offset = compressor.compressed_range(raw_start, raw_end)
+            member = {
+                'name': name,
+                'offset': offset,
+                'length': length,
+                'inner_offset': inner_offset,
+                'size': size,
+                'sha256': sha256
+            }
+            member.update(attrs)
+            members.append(member)
+        return {'archive': self.archive_name, 'codec': self.codec, 'version': INDEX_VERSION, 'members': members}
+
+
+def write_index(s3_client, bucket, archive_key, index, storage_class='STANDARD'):
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=index_key(archive_key),
+        Body=gzip.compress(json.dumps(index).encode('utf-8')),
+        ContentType='application/json',
+        ContentEncoding='gzip',
+        StorageClass=storage_class
+    )
+
+
+def load_index(s3_client, bucket, archive_key):
+    # Archives written before the index existed have none, the caller falls back to a full read
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=index_key(archive_key))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(gzip.decompress(response['Body'].read()))
+
+
+def open_member(s3_client, bucket, archive_key, index, entry):
+    # Fetch only the blocks holding the member with a ranged GET and return its TarInfo and a
+    # stream over its data
+    end = entry['offset'] + entry['length'] - 1
+    response = s3_client.get_object(Bucket=bucket, Key=archive_key, Range=f"bytes={entry['offset']}-{end}")
+    reader = decompressing_reader(index['codec'], response['Body'])
+    skip = entry['inner_offset']
+    while skip:
+        skipped = len(reader.read(min(skip, 1024 * 1024)))
+        if not skipped:
+            raise tarfile.ReadError(f"Unexpected end of {archive_key} before {entry['name']}")
+        skip -= skipped
+    tar = tarfile.open(fileobj=reader, mode='r|')
+    tarinfo = tar.next()
+    if tarinfo is None or tarinfo.name != entry['name']:
+        raise tarfile.ReadError(f"Index of {archive_key} doesn't match the archive at {entry['name']}")
+    return tarinfo, tar.extractfile(tarinfo)
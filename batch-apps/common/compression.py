@@ -0,0 +1,187 @@
+import gzip
+import os
+import time
+from bisect import bisect_right
+from collections import deque
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, gzip is always available
+    zstandard = None
+
+BLOCK_SIZE = 1024 * 1024
+
+# Codec name -> (archive extension, valid compression levels)
+CODECS = {
+    'gzip': ('.tar.gz', range(0, 10)),
+    'zstd': ('.tar.zst', range(1, 23)),
+}
+# Level for blocks of data that doesn't compress: gzip level 0 writes stored deflate blocks,
+# zstd's fastest negative level does next to no work and falls back to raw blocks
+STORE_LEVELS = {'gzip': 0, 'zstd': -131072}
+
+
+def check_codec(codec, level):
+    # Raise ValueError for codecs or levels the packer can't produce
+    if codec not in CODECS:
+        raise ValueError(f"Unsupported compression codec {codec}, expected one of {', '.join(CODECS)}")
+    if level not in CODECS[codec][1]:
+        raise ValueError(f"Compression level {level} is out of range for {codec}")
+    if codec == 'zstd' and zstandard is None:
+        raise ValueError("Compression codec zstd needs the zstandard package")
+
+
+def archive_extension(codec):
+    return CODECS[codec][0]
+
+
+def codec_for(archive_key):
+    # Archives are named after their codec, anything else is read as gzip like the original archives
+    for codec, (extension, _) in CODECS.items():
+        if archive_key.endswith(extension):
+            return codec
+    return 'gzip'
+
+
+def decompressing_reader(codec, fileobj):
+    # Readable stream over any run of consecutive blocks, read across member/frame boundaries
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("Compression codec zstd needs the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+    return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+
+def compression_workers():
+    # vCPUs this container may run on, which is what Batch/Fargate actually gives us
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def compress_block(codec, level, data):
+    # Every block becomes a complete gzip member or zstd frame. Concatenated members/frames are
+    # a valid stream for gzip, tar -xz, zstd -d and Python's tarfile. Returns the compressed
+    # block and the CPU seconds it took.
+    started = time.process_time()
+    if codec == 'zstd':
+        compressed = zstandard.ZstdCompressor(level=level).compress(data)
+    else:
+        compressed = gzip.compress(data, compresslevel=level, mtime=0)
+    return compressed, time.process_time() - started
+
+
+class ParallelCompressor:
+    """Write-only file object that compresses fixed-size blocks on a process pool.
+
+    Compressed blocks are written to `sink` in order. At most `max_pending` blocks are queued
+    in the pool, so `write` blocks when compression can't keep up. `blocks` records the
+    (uncompressed offset, compressed offset) of every block written, which is what makes the
+    archive seekable: any block can be decompressed on its own.
+
+    `store_from(offset, store)` sets whether the data from a raw offset on is known not to
+    compress. The block in progress ends at that offset, so a stored member never shares a
+    block with compressible data; its blocks are written at the codec's store level.
+    """
+
+    def __init__(self, sink, executor, codec='gzip', level=6, block_size=BLOCK_SIZE, max_pending=None):
+        self.sink = sink
+        self.executor = executor
+        self.codec = codec
+        self.level = level
+        self.block_size = block_size
+        self.max_pending = max_pending or 2 * compression_workers()
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.block_count = 0
+        self.store = False
+        self.stored_bytes = 0
+        # (raw offset, store) changes of policy the written data has not reached yet
+        self._changes = deque()
+        # CPU seconds the pool spent on blocks compressed at `level`, and their raw bytes
+        self.compress_seconds = 0.0
+        self.compressed_raw_bytes = 0
+        # Time spent waiting for the pool to finish a block, i.e. held up by compression
+        self.wait_seconds = 0.0
+        self.blocks = []
+        self._raw_offsets = []
+        self._buffer = bytearray()
+        self._pending = deque()
+
+    def writable(self):
+        return True
+
+    def store_from(self, offset, store):
+        # The offset can be ahead of the data written so far, tarfile buffers what it writes
+        if store != (self._changes[-1][1] if self._changes else self.store):
+            self._changes.append((offset, store))
+            self._cut()
+
+    def write(self, data):
+        self._buffer += data
+        self._cut()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _cut(self):
+        # Submit full blocks, and the blocks ending where the policy changes
+        while True:
+            end = self.raw_bytes + self.block_size
+            change = bool(self._changes) and self._changes[0][0] <= end
+            if change:
+                end = self._changes[0][0]
+            if end > self.raw_bytes + len(self._buffer):
+                return
+            if end > self.raw_bytes:
+                block = bytes(self._buffer[:end - self.raw_bytes])
+                del self._buffer[:end - self.raw_bytes]
+                self._submit(block)
+            if change:
+                self.store = self._changes.popleft()[1]
+
+    def _submit(self, block):
+        compressible = not self.store
+        level = self.level if compressible else STORE_LEVELS[self.codec]
+        future = self.executor.submit(compress_block, self.codec, level, block)
+        self._pending.append((self.raw_bytes, compressible, len(block), future))
+        self.raw_bytes += len(block)
+        self.block_count += 1
+        while len(self._pending) > self.max_pending:
+            self._write_next()
+        while self._pending and self._pending[0][-1].done():
+            self._write_next()
+
+    def _write_next(self):
+        raw_offset, compressible, raw_length, future = self._pending.popleft()
+        started = time.monotonic()
+        compressed, cpu_seconds = future.result()
+        self.wait_seconds += time.monotonic() - started
+        if compressible:
+            self.compress_seconds += cpu_seconds
+            self.compressed_raw_bytes += raw_length
+        else:
+            self.stored_bytes += raw_length
+        self.blocks.append((raw_offset, self.compressed_bytes))
+        self._raw_offsets.append(raw_offset)
+        self.sink.write(compressed)
+        self.compressed_bytes += len(compressed)
+
+    def close(self):
+        # An empty archive still needs one member/frame to be a valid compressed file
+        if self._buffer or self.block_count == 0:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._write_next()
+
+    def compressed_range(self, raw_start, raw_end):
+        # Compressed (offset, length) of the blocks holding raw bytes [raw_start, raw_end), and
+        # where raw_start falls inside the first of those blocks once decompressed
+        first = bisect_right(self._raw_offsets, raw_start) - 1
+        last = bisect_right(self._raw_offsets, raw_end - 1) - 1
+        offset = self.blocks[first][1]
+        end = self.blocks[last + 1][1] if last + 1 < len(self.blocks) else self.compressed_bytes
+        return offset, end - offset, raw_start - self.blocks[first][0]
@@ -0,0 +1,25 @@
+import random
+import time
+
+# Retries of DynamoDB and S3 calls sleep base_delay * 2^attempt, capped at max_delay, with jitter
+# so that many workers throttled together don't come back at the same time.
+
+
+def backoff_delay(attempt, base_delay=0.05, max_delay=5.0):
+    delay = base_delay * 2 ** attempt
+    if max_delay is not None:
+        delay = min(max_delay, delay)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def attempts(max_attempts, base_delay=0.05, max_delay=5.0):
+    # Numbers the attempts of a call, sleeping before every one but the first:
+    #
+    #   for attempt in attempts(8):
+    #       ...
+    #       if done:
+    #           break
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(backoff_delay(attempt, base_delay, max_delay))
+        yield attempt
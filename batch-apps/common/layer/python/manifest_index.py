@@ -0,0 +1,224 @@
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from backoff import attempts
+
+# The manifest rows every archive commits are also kept, sorted by key, in a SQLite file next to
+# the archive, <archive>.keys.sqlite, in a storage class that can be read without thawing it:
+#
+#   keys (key, archive, member, size, modified)
+#
+# The <project>_manifest_index table has a row for every directory an archive holds keys under,
+# down to INDEX_DEPTH levels, partitioned by the directory and sorted by archive name:
+#
+#   dir:                  every archive
+#   dir:data/             archives with keys under data/
+#   dir:data/sub07/       archives with keys under data/sub07/
+#
+# with the range of last modified times of those keys. Archives are packed by size, so the keys
+# of one archive are spread over the whole prefix of the run; the directory rows still let a
+# prefix query open only the key files of archives holding keys under its directory.
+KEYS_SUFFIX = '.keys.sqlite'
+DIRECTORY_PARTITION = 'dir:'
+# Deeper directories share the rows of their ancestor at this depth. The archive job and the
+# restore Lambda must agree on it, changing it needs the index rebuilt.
+INDEX_DEPTH = 4
+BATCH_WRITE_LIMIT = 25     # DynamoDB limit on items per BatchWriteItem call
+GLOB_CHARACTERS = '*?['
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def manifest_index_table(project_name):
+    return project_name + '_manifest_index'
+
+
+def keys_key(archive_name):
+    return archive_name + KEYS_SUFFIX
+
+
+def directories(key):
+    # The directories a key is under, from the root down to INDEX_DEPTH levels
+    parts = key.split('/')[:-1][:INDEX_DEPTH]
+    return [''.join(part + '/' for part in parts[:depth]) for depth in range(len(parts) + 1)]
+
+
+def prefix_directory(prefix):
+    # The deepest indexed directory every key starting with prefix is under
+    return directories(prefix)[-1]
+
+
+def literal_prefix(pattern):
+    # The part of a glob pattern before its first wildcard, every match starts with it
+    for i, character in enumerate(pattern):
+        if character in GLOB_CHARACTERS:
+            return pattern[:i]
+    return pattern
+
+
+def prefix_end(prefix):
+    # The first string after every string starting with prefix, None when that is all strings.
+    # Python orders strings by code point like DynamoDB and SQLite order UTF-8 bytes.
+    prefix = prefix.rstrip('\U0010ffff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def parse_time(value):
+    # 2025-03-01 or an ISO 8601 time, in UTC unless it has an offset
+    parsed = datetime.datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed.strftime(TIME_FORMAT)
+
+
+def _modified(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value.strftime(TIME_FORMAT)
+
+
+class ManifestIndex:
+    """Finds the archived keys matching a prefix or glob pattern, and a modification time range.
+
+    The archive job adds the rows of every archive with `add` once they are committed to
+    `_archive_master`. `match` reads the archives holding keys under the directory of the
+    pattern and returns the matching keys; `_archive_master` still decides which archive holds
+    each of them.
+    """
+
+    def __init__(self, dynamodb_client, s3_client, table_name, bucket, max_attempts=8):
+        self.dynamodb = dynamodb_client
+        self.s3 = s3_client
+        self.table_name = table_name
+        self.bucket = bucket
+        self.max_attempts = max_attempts
+
+    def add(self, archive_name, rows, run_id=None):
+        """Store the key file of an archive and its directory rows in the index table.
+
+        `rows` are the manifest rows of the archive with the Size and LastModified of their
+        source object. Adding an archive again overwrites both. Raises RuntimeError when
+        DynamoDB leaves rows unwritten after every attempt.
+        """
+        if not rows:
+            return
+        rows = sorted(rows, key=lambda row: row['key'])
+        handle, path = tempfile.mkstemp(suffix=KEYS_SUFFIX)
+        os.close(handle)
+        try:
+            with sqlite3.connect(path) as db:
+                db.execute('CREATE TABLE keys (key TEXT PRIMARY KEY, archive TEXT NOT NULL, member TEXT, '
+                           'size INTEGER, modified TEXT) WITHOUT ROWID')
+                db.executemany('INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?)', (
+                    (row['key'], row['TarFileName'], row.get('MemberName'), row['Size'], _modified(row['LastModified']))
+                    for row in rows))
+                db.execute('CREATE INDEX keys_modified ON keys (modified)')
+            db.close()
+            with open(path, 'rb') as keys_file:
+                self.s3.put_object(Bucket=self.bucket, Key=keys_key(archive_name), Body=keys_file.read(),
+                                   ContentType='application/vnd.sqlite3', StorageClass='STANDARD')
+        finally:
+            os.remove(path)
+        # Files and time range of the keys under every directory of the archive
+        ranges = {}
+        for row in rows:
+            modified = _modified(row['LastModified'])
+            for directory in directories(row['key']):
+                files, oldest, newest = ranges.get(directory, (0, modified, modified))
+                ranges[directory] = (files + 1, min(oldest, modified), max(newest, modified))
+        requests = []
+        for directory, (files, oldest, newest) in ranges.items():
+            item = {
+                'partition': {'S': DIRECTORY_PARTITION + directory},
+                'archive_name': {'S': archive_name},
+                'oldest': {'S': oldest},
+                'newest': {'S': newest},
+                'files': {'N': str(files)}
+            }
+            if run_id:
+                item['run_id'] = {'S': run_id}
+            requests.append({'PutRequest': {'Item': item}})
+        for i in range(0, len(requests), BATCH_WRITE_LIMIT):
+            self._write_batch(requests[i:i + BATCH_WRITE_LIMIT])
+
+    def _write_batch(self, requests):
+        for attempt in attempts(self.max_attempts):
+            response = self.dynamodb.batch_write_item(RequestItems={self.table_name: requests})
+            requests = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            if not requests:
+                return
+        raise RuntimeError(f"Could not store {len(requests)} manifest index rows after {self.max_attempts} attempts")
+
+    def archives(self, prefix='', modified_after=None, modified_before=None):
+        # Names of the archives with keys under the directory of prefix in the time range
+        args = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': '#p = :partition',
+            'ProjectionExpression': 'archive_name',
+            'ExpressionAttributeNames': {'#p': 'partition'},
+            'ExpressionAttributeValues': {':partition': {'S': DIRECTORY_PARTITION + prefix_directory(prefix)}}
+        }
+        filters = []
+        if modified_after:
+            filters.append('newest >= :after')
+            args['ExpressionAttributeValues'][':after'] = {'S': modified_after}
+        if modified_before:
+            filters.append('oldest < :before')
+            args['ExpressionAttributeValues'][':before'] = {'S': modified_before}
+        if filters:
+            args['FilterExpression'] = ' AND '.join(filters)
+        names = []
+        while True:
+            response = self.dynamodb.query(**args)
+            names.extend(item['archive_name']['S'] for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return names
+            args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def match(self, pattern='', modified_after=None, modified_before=None, limit=None):
+        """Keys matching the pattern, modified in [modified_after, modified_before).
+
+        A pattern with `*`, `?` or `[` is a glob over the whole key, where `*` also matches `/`;
+        any other pattern is a key prefix. Times are in the format of `parse_time`. Stops after
+        `limit` keys, the caller can tell a query matched more than it allows.
+        """
+        glob = any(character in pattern for character in GLOB_CHARACTERS)
+        prefix = literal_prefix(pattern)
+        end = prefix_end(prefix)
+        conditions, args = ['key >= ?'], [prefix]
+        if end:
+            conditions.append('key < ?')
+            args.append(end)
+        if glob:
+            conditions.append('key GLOB ?')
+            args.append(pattern)
+        if modified_after:
+            conditions.append('modified >= ?')
+            args.append(modified_after)
+        if modified_before:
+            conditions.append('modified < ?')
+            args.append(modified_before)
+        query = f"SELECT key FROM keys WHERE {' AND '.join(conditions)} ORDER BY key"
+        keys = {}
+        for archive_name in self.archives(prefix, modified_after, modified_before):
+            handle, path = tempfile.mkstemp(suffix=KEYS_SUFFIX)
+            os.close(handle)
+            try:
+                response = self.s3.get_object(Bucket=self.bucket, Key=keys_key(archive_name))
+                with open(path, 'wb') as keys_file:
+                    shutil.copyfileobj(response['Body'], keys_file)
+                db = sqlite3.connect(path)
+                try:
+                    for (key,) in db.execute(query, args):
+                        keys[key] = None
+                        if limit is not None and len(keys) > limit:
+                            return list(keys)
+                finally:
+                    db.close()
+            finally:
+                os.remove(path)
+        return list(keys)
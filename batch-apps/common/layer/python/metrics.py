@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Shared by the Batch jobs, which copy it into their image, and the Lambdas, which get it from
+# the layer built out of this directory
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+LOG_LEVEL = LOG_LEVELS.get(os.environ.get('LOG_LEVEL', 'INFO').upper(), LOG_LEVELS['INFO'])
+# Lines about single files: every one at DEBUG, the first and then one in FILE_LOG_SAMPLE at INFO
+FILE_LOG_SAMPLE = max(1, int(os.environ.get('FILE_LOG_SAMPLE', '1000')))
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'DataArchiving')
+# (name, unit) of the metrics in every phase record
+PHASE_METRICS = (('Seconds', 'Seconds'), ('Bytes', 'Bytes'), ('Items', 'Count'), ('Requests', 'Count'),
+                 ('Retries', 'Count'), ('Errors', 'Count'), ('Throughput', 'Bytes/Second'))
+
+
+def log(level, message):
+    if LOG_LEVELS[level] >= LOG_LEVEL:
+        print(message)
+
+
+class FileLog:
+    """Prints per-file lines, all of them at DEBUG and a sample of them at INFO.
+
+    At millions of files printing every line costs more than it tells, the sample still shows
+    the job moving. Every `sample`-th line is printed, starting with the first.
+    """
+
+    def __init__(self, sample=FILE_LOG_SAMPLE):
+        self.sample = sample
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, message):
+        if LOG_LEVEL > LOG_LEVELS['INFO']:
+            return
+        with self._lock:
+            self.count += 1
+            count = self.count
+        if LOG_LEVEL <= LOG_LEVELS['DEBUG'] or (count - 1) % self.sample == 0:
+            print(message)
+
+
+class Phase:
+    """Time, bytes, items and AWS requests of one phase of a job.
+
+    Whoever does the work adds its time, so a phase run on several threads counts the time of
+    each of them. A phase nobody times reports the time its requests took instead.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.request_seconds = 0.0
+        self.bytes = 0
+        self.items = 0
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds=0.0, nbytes=0, items=0, retries=0, errors=0):
+        with self._lock:
+            self.seconds += seconds
+            self.bytes += nbytes
+            self.items += items
+            self.retries += retries
+            self.errors += errors
+
+    @contextmanager
+    def timed(self, nbytes=0, items=0):
+        started = time.monotonic()
+        try:
+            yield self
+        finally:
+            self.add(time.monotonic() - started, nbytes, items)
+
+    def _request(self, seconds, attempts, failed):
+        with self._lock:
+            self.requests += 1
+            self.retries += max(0, attempts - 1)
+            self.errors += failed
+            self.request_seconds += seconds
+
+    def values(self):
+        seconds = self.seconds or self.request_seconds
+        return {
+            'Seconds': round(seconds, 3),
+            'Bytes': self.bytes,
+            'Items': self.items,
+            'Requests': self.requests,
+            'Retries': self.retries,
+            'Errors': self.errors,
+            'Throughput': round(self.bytes / seconds) if seconds else 0
+        }
+
+
+class Metrics:
+    """Phases of one job or Lambda invocation, emitted in CloudWatch Embedded Metric Format.
+
+    `emit` prints one JSON line per phase with its metrics under the Job and Phase dimensions,
+    and a last one for the whole job under Phase "total". The correlation id ties the records
+    of Batch jobs to the API request that started them; it is a property rather than a
+    dimension, so it can be searched for in Logs Insights without adding a metric per run.
+    """
+
+    def __init__(self, job, correlation_id=None, namespace=NAMESPACE, **properties):
+        self.job = job
+        self.correlation_id = (correlation_id or os.environ.get('CORRELATION_ID') or os.environ.get('AWS_BATCH_JOB_ID')
+                               or str(uuid.uuid4()))
+        self.namespace = namespace
+        self.properties = properties
+        self.phases = {}
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def phase(self, name):
+        with self._lock:
+            if name not in self.phases:
+                self.phases[name] = Phase(name)
+            return self.phases[name]
+
+    def count_requests(self, client, operations):
+        """Count the calls a boto3 client makes for `operations`, {operation name: phase name}.
+
+        Every call counts once, with the attempts botocore retried it, whether it failed in the
+        end and how long it took from the first attempt to the answer.
+        """
+        phases = {operation: self.phase(name) for operation, name in operations.items()}
+
+        def before_call(model, context, **kwargs):
+            if model.name in phases:
+                # [phase, start, attempts], kept with the call
+                context['metrics'] = [phases[model.name], time.monotonic(), 0]
+
+        def request_created(request, **kwargs):
+            call = getattr(request, 'context', {}).get('metrics')
+            if call is not None:
+                call[2] += 1
+
+        def after_call(context, http_response=None, **kwargs):
+            # Also sent for calls that raised, without a response
+            call = context.get('metrics')
+            if call is not None:
+                failed = http_response is None or http_response.status_code >= 300
+                call[0]._request(time.monotonic() - call[1], call[2], int(failed))
+
+        events = client.meta.events
+        events.register('before-call', before_call)
+        events.register('request-created', request_created)
+        events.register('after-call', after_call)
+        events.register('after-call-error', after_call)
+
+    def emit(self, nbytes=0, items=0, **properties):
+        # nbytes and items are those of the whole job, for the total record
+        timestamp = int(time.time() * 1000)
+        phases = list(self.phases.values())
+        total = Phase('total')
+        total.add(time.monotonic() - self._started, nbytes, items, retries=sum(phase.retries for phase in phases),
+                  errors=sum(phase.errors for phase in phases))
+        total.requests = sum(phase.requests for phase in phases)
+        for phase in phases + [total]:
+            record = {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [['Job', 'Phase']],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, unit in PHASE_METRICS]
+                    }]
+                },
+                'Job': self.job,
+                'Phase': phase.name,
+                'CorrelationId': self.correlation_id
+            }
+            record.update((name, value) for name, value in {**self.properties, **properties}.items() if value is not None)
+            record.update(phase.values())
+            print(json.dumps(record, default=str))
@@ -0,0 +1,212 @@
+import math
+import time
+
+from botocore.exceptions import ClientError
+
+from backoff import attempts
+
+# Members extracted by restore jobs are kept as plain objects under CACHE_PREFIX in the bucket
+# holding the archives, one row per member in the <project>_restore_cache table (archive_key,
+# member). Later requests for them are copied from there instead of waiting for Glacier. The
+# row under ACCESS_ROW of every archive keeps the times it was last requested.
+CACHE_PREFIX = 'restore-cache/'
+ACCESS_ROW = '#access'
+ACCESS_HISTORY = 20        # request times kept per archive
+BATCH_GET_LIMIT = 100      # DynamoDB limit on keys per BatchGetItem call
+COPY_OBJECT_LIMIT = 5 * 1024 * 1024 * 1024   # S3 limit for a single CopyObject, larger copies go multipart
+# member and size are DynamoDB reserved words
+ATTRIBUTE_NAMES = {'#m': 'member', '#s': 'size'}
+
+
+def cache_table(project_name):
+    return project_name + '_restore_cache'
+
+
+def cache_key(archive_key, member):
+    return f"{CACHE_PREFIX}{archive_key}/{member}"
+
+
+def restore_days(request_times, now, min_days=1, max_days=7, history_days=30):
+    """Days to keep an archive restored, from how often it was requested lately.
+
+    An archive requested again and again, on average at most max_days apart, stays restored
+    until the next request is due, so that request doesn't pay for another retrieval and wait
+    12 hours for it. Anything requested rarely is kept for min_days.
+    """
+    recent = sorted(t for t in request_times if now - t <= history_days * 86400)
+    if len(recent) < 2:
+        return min_days
+    gap = (recent[-1] - recent[0]) / (len(recent) - 1) / 86400
+    if gap > max_days:
+        return min_days
+    return max(min_days, min(max_days, math.ceil(gap) + 1))
+
+
+class RestoreCache:
+    """Restored archive members kept in S3 for `ttl_hours` after their last use.
+
+    Every use moves the expiry of a member forward. `evict` drops expired members, and then
+    the least recently used ones until the cache holds at most `budget_bytes`.
+    """
+
+    def __init__(self, dynamodb_client, s3_client, table_name, bucket, ttl_hours=168, budget_bytes=0,
+                 storage_class='STANDARD', max_attempts=8):
+        self.dynamodb = dynamodb_client
+        self.s3 = s3_client
+        self.table_name = table_name
+        self.bucket = bucket
+        self.ttl_seconds = int(ttl_hours * 3600)
+        self.budget_bytes = budget_bytes
+        self.storage_class = storage_class
+        self.max_attempts = max_attempts
+
+    def _copy(self, source_bucket, source_key, bucket, key, size, **extra):
+        source = {'Bucket': source_bucket, 'Key': source_key}
+        if size > COPY_OBJECT_LIMIT:
+            self.s3.copy(CopySource=source, Bucket=bucket, Key=key, ExtraArgs=extra)
+        else:
+            self.s3.copy_object(CopySource=source, Bucket=bucket, Key=key, **extra)
+
+    def lookup(self, archive_key, members):
+        # {member: row} of the members of the archive that are cached and not expired
+        now = int(time.time())
+        found = {}
+        members = list(dict.fromkeys(members))
+        for i in range(0, len(members), BATCH_GET_LIMIT):
+            keys = [{'archive_key': {'S': archive_key}, 'member': {'S': member}}
+                    for member in members[i:i + BATCH_GET_LIMIT]]
+            for attempt in attempts(self.max_attempts):
+                response = self.dynamodb.batch_get_item(RequestItems={self.table_name: {'Keys': keys}})
+                for item in response['Responses'].get(self.table_name, []):
+                    if int(item['expires_at']['N']) > now:
+                        found[item['member']['S']] = item
+                keys = response.get('UnprocessedKeys', {}).get(self.table_name, {}).get('Keys', [])
+                if not keys:
+                    break
+        return found
+
+    def serve(self, archive_key, members, restore_bucket):
+        """Copy the cached members into the restore bucket; `members` is {member: [file names]}.
+
+        Returns the file names restored from the cache. A member evicted since it was looked
+        up is left to the regular restore.
+        """
+        served = []
+        for member, row in self.lookup(archive_key, members).items():
+            size = int(row['size']['N'])
+            try:
+                for name in members[member]:
+                    self._copy(self.bucket, cache_key(archive_key, member), restore_bucket, name, size)
+                self._touch(archive_key, member)
+            except ClientError as e:
+                print(f"{member} of {archive_key} could not be restored from the cache: {e}")
+                continue
+            served.extend(members[member])
+        return served
+
+    def _touch(self, archive_key, member):
+        now = int(time.time())
+        self.dynamodb.update_item(
+            TableName=self.table_name,
+            Key={'archive_key': {'S': archive_key}, 'member': {'S': member}},
+            UpdateExpression='SET last_access = :now, expires_at = :expires ADD hits :one',
+            ConditionExpression='attribute_exists(#m)',
+            ExpressionAttributeNames={'#m': 'member'},
+            ExpressionAttributeValues={':now': {'N': str(now)}, ':expires': {'N': str(now + self.ttl_seconds)},
+                                       ':one': {'N': '1'}}
+        )
+
+    def add(self, archive_key, member, source_bucket, source_key, size):
+        # Keep a restored member, larger members than the whole budget are not cached
+        if size > self.budget_bytes:
+            return False
+        self._copy(source_bucket, source_key, self.bucket, cache_key(archive_key, member), size,
+                   StorageClass=self.storage_class)
+        now = int(time.time())
+        self.dynamodb.put_item(TableName=self.table_name, Item={
+            'archive_key': {'S': archive_key},
+            'member': {'S': member},
+            'size': {'N': str(size)},
+            'last_access': {'N': str(now)},
+            'expires_at': {'N': str(now + self.ttl_seconds)},
+            'hits': {'N': '0'}
+        })
+        return True
+
+    def record_request(self, archive_key):
+        # Times the archive was requested lately, this request included
+        now = int(time.time())
+        response = self.dynamodb.update_item(
+            TableName=self.table_name,
+            Key={'archive_key': {'S': archive_key}, 'member': {'S': ACCESS_ROW}},
+            UpdateExpression='SET requests = list_append(if_not_exists(requests, :empty), :request), last_access = :now',
+            ExpressionAttributeValues={':empty': {'L': []}, ':request': {'L': [{'N': str(now)}]}, ':now': {'N': str(now)}},
+            ReturnValues='ALL_NEW'
+        )
+        requests = [int(value['N']) for value in response['Attributes']['requests']['L']]
+        if len(requests) > ACCESS_HISTORY:
+            requests = requests[-ACCESS_HISTORY:]
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={'archive_key': {'S': archive_key}, 'member': {'S': ACCESS_ROW}},
+                UpdateExpression='SET requests = :requests',
+                ExpressionAttributeValues={':requests': {'L': [{'N': str(t)} for t in requests]}}
+            )
+        return requests
+
+    def _rows(self):
+        # Every row of the table, which stays small: it holds at most budget_bytes of members
+        # and the archives requested within the access history
+        args = {'TableName': self.table_name, 'ProjectionExpression': 'archive_key, #m, #s, last_access, expires_at',
+                'ExpressionAttributeNames': ATTRIBUTE_NAMES}
+        while True:
+            response = self.dynamodb.scan(**args)
+            for item in response.get('Items', []):
+                yield item
+            if 'LastEvaluatedKey' not in response:
+                return
+            args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def _drop(self, archive_key, member, last_access):
+        # The row goes first, and only if nobody used the member since it was read
+        try:
+            self.dynamodb.delete_item(
+                TableName=self.table_name,
+                Key={'archive_key': {'S': archive_key}, 'member': {'S': member}},
+                ConditionExpression='last_access = :seen',
+                ExpressionAttributeValues={':seen': {'N': str(last_access)}}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        if member != ACCESS_ROW:
+            self.s3.delete_object(Bucket=self.bucket, Key=cache_key(archive_key, member))
+        return True
+
+    def evict(self, history_days=30):
+        """Drop expired members, then the least recently used ones down to the budget.
+
+        Access history of archives not requested for history_days goes as well. Returns the
+        number of members dropped and the bytes the cache still holds.
+        """
+        now = int(time.time())
+        entries = []
+        for item in self._rows():
+            archive_key, member = item['archive_key']['S'], item['member']['S']
+            last_access = int(item['last_access']['N'])
+            if member == ACCESS_ROW:
+                if now - last_access > history_days * 86400:
+                    self._drop(archive_key, member, last_access)
+                continue
+            entries.append((last_access, archive_key, member, int(item['size']['N']), int(item['expires_at']['N'])))
+        entries.sort()
+        total = sum(entry[3] for entry in entries)
+        dropped = 0
+        for last_access, archive_key, member, size, expires_at in entries:
+            if expires_at > now and total <= self.budget_bytes:
+                continue
+            if self._drop(archive_key, member, last_access):
+                total -= size
+                dropped += 1
+        return dropped, total
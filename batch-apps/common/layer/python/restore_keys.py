@@ -0,0 +1,23 @@
+import json
+
+# Keeps the KEYS list of a restorer job well inside the size limit of Batch container overrides
+KEYS_ENV_LIMIT = 6000
+
+
+def key_chunks(requested_filenames, members):
+    # Split the files of an archive so the JSON list of every job, with the members its copies
+    # point at, fits in its environment
+    chunk = []
+    size = 0
+    for requested_filename in requested_filenames:
+        needed = len(json.dumps(requested_filename)) + 2
+        if requested_filename in members:
+            needed += len(json.dumps({requested_filename: members[requested_filename]}))
+        if chunk and size + needed > KEYS_ENV_LIMIT:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(requested_filename)
+        size += needed
+    if chunk:
+        yield chunk
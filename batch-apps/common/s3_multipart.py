@@ -0,0 +1,143 @@
+import base64
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+MIN_PART_SIZE = 5 * 1024 * 1024   # S3 minimum for every part except the last one
+MAX_PARTS = 10000                 # S3 hard limit on parts per upload
+
+
+def part_size_for(expected_size, default_part_size):
+    # Grow the part size so that an archive of the expected size stays well under MAX_PARTS
+    needed = -(-expected_size // (MAX_PARTS - 1000))
+    return max(MIN_PART_SIZE, default_part_size, needed)
+
+
+class MultipartUploadWriter:
+    """Write-only file object that streams everything written to it into an S3 multipart upload.
+
+    Data is cut into `part_size` parts which are uploaded on a small thread pool as soon as they
+    fill. At most `max_inflight` parts are held in memory at once; `write` blocks when that many
+    are still uploading, so memory stays bounded at roughly part_size * (max_inflight + 1).
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size, max_inflight=4, **create_args):
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(MIN_PART_SIZE, part_size)
+        self.bytes_written = 0
+        # Time the writer was blocked on a free upload slot, i.e. held up by the network
+        self.wait_seconds = 0.0
+        self.closed = False
+        self._buffer = bytearray()
+        self._part_number = 0
+        self._part_digests = {}
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._executor = ThreadPoolExecutor(max_workers=max_inflight)
+        response = self.s3.create_multipart_upload(Bucket=bucket, Key=key, **create_args)
+        self.upload_id = response['UploadId']
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit(part)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _submit(self, part):
+        # Raise early if an earlier part already failed instead of uploading the rest of the archive
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        self._part_number += 1
+        if self._part_number > MAX_PARTS:
+            raise ValueError(f"{self.key} needs more than {MAX_PARTS} parts, increase the part size")
+        started = time.monotonic()
+        self._slots.acquire()
+        self.wait_seconds += time.monotonic() - started
+        self._futures.append(self._executor.submit(self._upload_part, self._part_number, part))
+
+    def _upload_part(self, part_number, part):
+        # Content-MD5 makes S3 reject a part corrupted in transit; the digests also give the
+        # ETag the completed object must have
+        try:
+            digest = hashlib.md5(part).digest()
+            self._part_digests[part_number] = digest
+            response = self.s3.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=part_number,
+                Body=part,
+                ContentMD5=base64.b64encode(digest).decode('ascii')
+            )
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self._slots.release()
+
+    def close(self):
+        # Upload the remaining buffer and complete the upload; S3 needs at least one part
+        if self.closed:
+            return
+        try:
+            if self._buffer or self._part_number == 0:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            parts = [future.result() for future in self._futures]
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            self.abort()
+            raise
+        self._executor.shutdown(wait=True)
+        self.closed = True
+
+    def expected_etag(self):
+        digests = b''.join(self._part_digests[n] for n in sorted(self._part_digests))
+        return f'"{hashlib.md5(digests).hexdigest()}-{len(self._part_digests)}"'
+
+    def verify(self):
+        # Check the completed object against what was written before anything relies on it.
+        # With SSE-KMS the ETag is not derived from the content, so only the size is compared.
+        head = self.s3.head_object(Bucket=self.bucket, Key=self.key)
+        if head['ContentLength'] != self.bytes_written:
+            raise ValueError(f"{self.key} has {head['ContentLength']} bytes, {self.bytes_written} were written")
+        if not head.get('ServerSideEncryption', '').startswith('aws:kms') and head['ETag'] != self.expected_etag():
+            raise ValueError(f"{self.key} has ETag {head['ETag']}, expected {self.expected_etag()}")
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._executor.shutdown(wait=True)
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except ClientError as e:
+            print(f"Error aborting multipart upload of {self.key}: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
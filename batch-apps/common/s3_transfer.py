@@ -0,0 +1,175 @@
+import threading
+import time
+from collections import OrderedDict
+
+import boto3.s3.inject
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from backoff import attempts
+
+# Error codes S3 answers with when a prefix gets more requests than it can take right now
+THROTTLE_ERRORS = ('SlowDown', '503', 'RequestLimitExceeded', 'Throttling', 'ThrottlingException',
+                   'TooManyRequestsException')
+# Calls that move data and are gated by the limiter; everything else goes straight to the client
+DATA_OPERATIONS = ('get_object', 'put_object', 'head_object', 'upload_part', 'create_multipart_upload',
+                   'complete_multipart_upload', 'abort_multipart_upload', 'delete_objects', 'copy_object',
+                   'upload_part_copy')
+
+
+def is_throttle(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLE_ERRORS
+
+
+def transfer_config(max_concurrency, extra_connections=8):
+    # A connection for every request the limiter can let through, plus streamed response bodies
+    # still being read after their request has returned
+    return Config(max_pool_connections=max_concurrency + extra_connections,
+                  retries={'mode': 'standard', 'max_attempts': 3})
+
+
+class AdaptiveLimiter:
+    """AIMD limit on the number of S3 requests in flight.
+
+    The limit starts at `initial` and doubles every round trip (slow start) until the first
+    sign of trouble, after which it grows by one request per round trip. A throttled request
+    halves it, at most once per `cooldown` seconds so one burst of SlowDown answers counts once.
+    Requests that take more than `latency_factor` times the typical latency stop the growth.
+    """
+
+    def __init__(self, initial=16, minimum=1, maximum=128, latency_factor=3.0, cooldown=1.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.peak = self.limit
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.slow_start = True
+        self._typical_latency = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            self.requests += 1
+            if throttled:
+                self._decrease()
+            elif latency is not None:
+                self._healthy(latency)
+            self._cond.notify_all()
+
+    def on_throttle(self):
+        # Throttles botocore retries internally never reach the caller, they are reported here
+        with self._cond:
+            self._decrease()
+
+    def _healthy(self, latency):
+        typical = self._typical_latency
+        self._typical_latency = latency if typical is None else 0.9 * typical + 0.1 * latency
+        if typical is not None and latency > self.latency_factor * typical:
+            # Latency is climbing, S3 or the network is saturating: hold the limit
+            self.slow_start = False
+            return
+        if self.in_flight + 1 < int(self.limit):
+            # Only grow when the current limit is actually used
+            return
+        self.limit = min(self.maximum, self.limit + (1 if self.slow_start else 1 / self.limit))
+        self.peak = max(self.peak, self.limit)
+
+    def _decrease(self):
+        self.throttled += 1
+        self.slow_start = False
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit / 2)
+
+    def report(self):
+        return (f"{self.requests} S3 requests, {self.throttled} throttled, concurrency limit "
+                f"{int(self.limit)} (peak {int(self.peak)}, range {self.minimum}-{self.maximum})")
+
+
+class AdaptiveS3Client:
+    """Wraps an S3 client so its data calls share one AdaptiveLimiter.
+
+    Calls in DATA_OPERATIONS wait for a slot, report their latency and are retried with backoff
+    when S3 still answers SlowDown after botocore's own retries. Every other attribute is the
+    wrapped client's, so the wrapper can be passed anywhere a client is expected.
+    """
+
+    def __init__(self, client, limiter, max_attempts=6, base_delay=0.2):
+        self.client = client
+        self.limiter = limiter
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        # Every throttled attempt lowers the limit, also the ones botocore retries by itself
+        client.meta.events.register('needs-retry.s3', self._on_retry)
+
+    def _on_retry(self, response=None, **kwargs):
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_ERRORS:
+            self.limiter.on_throttle()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name not in DATA_OPERATIONS:
+            return attribute
+
+        def call(**kwargs):
+            return self._call(attribute, kwargs)
+        return call
+
+    def copy(self, CopySource, Bucket, Key, ExtraArgs=None, Config=None):
+        # boto3's managed copy, run with this wrapper as its client so that every request it
+        # makes (UploadPartCopy above all) waits for a slot like the other data calls
+        return boto3.s3.inject.copy(self, CopySource, Bucket, Key, ExtraArgs=ExtraArgs, Config=Config)
+
+    def _call(self, operation, kwargs):
+        for attempt in attempts(self.max_attempts, self.base_delay, max_delay=10.0):
+            self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                response = operation(**kwargs)
+            except ClientError as e:
+                throttled = is_throttle(e)
+                self.limiter.release(throttled=throttled)
+                if throttled and attempt + 1 < self.max_attempts:
+                    continue
+                raise
+            except Exception:
+                self.limiter.release()
+                raise
+            self.limiter.release(latency=time.monotonic() - started)
+            return response
+
+
+def spread_by_prefix(objects, key=lambda obj: obj['Key']):
+    # Reorder objects so consecutive requests go round robin across their key prefixes (the
+    # "directory" of the key). S3 scales request rates per prefix, so a burst of requests
+    # spread this way reaches the combined rate of all prefixes instead of queueing on one.
+    by_prefix = OrderedDict()
+    for obj in objects:
+        by_prefix.setdefault(key(obj).rpartition('/')[0], []).append(obj)
+    if len(by_prefix) < 2:
+        return [obj for group in by_prefix.values() for obj in group]
+    groups = [iter(group) for group in by_prefix.values()]
+    spread = []
+    while groups:
+        remaining = []
+        for group in groups:
+            obj = next(group, None)
+            if obj is not None:
+                spread.append(obj)
+                remaining.append(group)
+        groups = remaining
+    return spread
@@ -2,73 +2,231 @@ import os
 import tarfile
 import json
 import boto3
-import shutil
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+from archive_index import HashingReader, load_index, open_member
+from backoff import attempts
+from compression import codec_for, decompressing_reader
+from metrics import FileLog, Metrics
+from restore_cache import RestoreCache, cache_table
+from s3_multipart import MultipartUploadWriter
+from s3_transfer import AdaptiveLimiter, AdaptiveS3Client, transfer_config
 
 PROJECT_NAME = os.environ['PROJECT_NAME']
 archive_key = os.environ['ARCHIVE_KEY']
 bucket_name = os.environ['SRC_BUCKET_NAME']
-requested_file = os.environ['KEY']
+# KEYS is a JSON list of the members to restore from the archive, KEY a single one
+requested_files = json.loads(os.environ['KEYS']) if os.environ.get('KEYS') else [os.environ['KEY']]
+# Files archived as a copy of content stored under another member name, {file: member}
+copy_of = json.loads(os.environ.get('MEMBERS') or '{}')
 sns_topic = os.environ['TOPIC_ARN']
 restore_bucket=os.environ['RESTORE_BUCKET_NAME']
-local_dir = 'app'
-download_dir = local_dir+'/s3-download'
-os.makedirs(download_dir, exist_ok=True)
 restore_table=os.environ['PROJECT_NAME']+'_restore_tracker'
-s3 = boto3.client('s3')
-localfile=(f"{download_dir}/{archive_key}")
-print(f"Start Collecting files from S3 into path {localfile}")
-s3.download_file(bucket_name, archive_key,localfile )
-os.chdir(download_dir)
+# Members are streamed from the archive into the restore bucket without touching local disk,
+# memory stays around MEMBER_THREADS * PART_SIZE_MB * (UPLOAD_INFLIGHT + 1)
+PART_SIZE_MB = int(os.environ.get('PART_SIZE_MB', '16'))
+UPLOAD_INFLIGHT = int(os.environ.get('UPLOAD_INFLIGHT', '2'))
+MEMBER_THREADS = int(os.environ.get('MEMBER_THREADS', '4'))
+COPY_BUFFER_SIZE = 1024 * 1024
+COPY_OBJECT_LIMIT = 5 * 1024 * 1024 * 1024   # S3 limit for a single CopyObject, larger copies go multipart
+# Restored members are also kept in the restore cache next to the archives, so later requests
+# for them skip the Glacier retrieval. RESTORE_CACHE_MB=0 turns the cache off.
+RESTORE_CACHE_MB = int(os.environ.get('RESTORE_CACHE_MB', '10240'))
+RESTORE_CACHE_TTL_HOURS = float(os.environ.get('RESTORE_CACHE_TTL_HOURS', '168'))
+RESTORE_CACHE_STORAGE_CLASS = os.environ.get('RESTORE_CACHE_STORAGE_CLASS', 'STANDARD')
+part_size = PART_SIZE_MB * 1024 * 1024
+# Ranged GETs and uploads share one limit on requests in flight that backs off on SlowDown
+max_concurrency = MEMBER_THREADS * (UPLOAD_INFLIGHT + 1)
+transfer_limiter = AdaptiveLimiter(initial=max_concurrency, maximum=max_concurrency)
+s3 = AdaptiveS3Client(boto3.client('s3', config=transfer_config(max_concurrency)), transfer_limiter)
+# Time, bytes and requests of every phase, emitted as CloudWatch Embedded Metric Format at the end.
+# Lines about single members are sampled, LOG_LEVEL=DEBUG prints all of them.
+metrics = Metrics('restore', ArchiveKey=archive_key)
+metrics.count_requests(s3.client, {
+    'GetObject': 'download', 'PutObject': 'upload', 'CreateMultipartUpload': 'upload', 'UploadPart': 'upload',
+    'CompleteMultipartUpload': 'upload', 'HeadObject': 'upload', 'CopyObject': 'upload', 'UploadPartCopy': 'upload'
+})
+extract_phase = metrics.phase('restore-extract')
+file_log = FileLog()
+cache = None
+if RESTORE_CACHE_MB:
+    cache_dynamodb = boto3.client('dynamodb')
+    # Copies into the restore cache take their slots from the same limit as the restore
+    cache_s3 = AdaptiveS3Client(boto3.client('s3', config=transfer_config(max_concurrency)), transfer_limiter)
+    metrics.count_requests(cache_dynamodb, {'PutItem': 'cache', 'Scan': 'cache', 'DeleteItem': 'cache'})
+    metrics.count_requests(cache_s3.client, {'CopyObject': 'cache', 'UploadPartCopy': 'cache', 'DeleteObject': 'cache'})
+    cache = RestoreCache(cache_dynamodb, cache_s3, cache_table(PROJECT_NAME), bucket_name,
+                         ttl_hours=RESTORE_CACHE_TTL_HOURS, budget_bytes=RESTORE_CACHE_MB * 1024 * 1024,
+                         storage_class=RESTORE_CACHE_STORAGE_CLASS)
 
-try:
-    with tarfile.open(archive_key, "r:gz") as tar_file:
-        tar_file.extract(requested_file, path=f'{download_dir}/app/s3-download')
-    # Check if abc.csv exists in the extracted files
-    os.chdir(f'{download_dir}/app/s3-download')
-    if os.path.exists(requested_file):
-        # Get a list of all extracted files
-        extracted_files = os.listdir(".")
-        # Remove all files except abc.csv
-        for file in extracted_files:
-            if file != requested_file:
-                os.remove(file)
+
+def upload_member(name, size, stream, sha256=None):
+    # Members that fit in one part go up with a single PUT, larger ones through a multipart upload
+    # fed straight from the member stream. The upload is aborted if the content doesn't match
+    # the checksum in the archive index.
+    reader = HashingReader(stream)
+    if size <= part_size:
+        data = reader.read()
+        if sha256 and reader.hexdigest() != sha256:
+            raise tarfile.ReadError(f"Checksum mismatch for {name} in {archive_key}")
+        s3.put_object(Bucket=restore_bucket, Key=name, Body=data)
+        return
+    with MultipartUploadWriter(s3, restore_bucket, name, part_size, max_inflight=UPLOAD_INFLIGHT) as uploader:
+        while True:
+            chunk = reader.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            uploader.write(chunk)
+        if sha256 and reader.hexdigest() != sha256:
+            raise tarfile.ReadError(f"Checksum mismatch for {name} in {archive_key}")
+    uploader.verify()
+
+
+def files_by_member():
+    # {member name: [requested files with its content]}, a member is read once for all of them
+    by_member = {}
+    for requested_file in requested_files:
+        by_member.setdefault(copy_of.get(requested_file, requested_file), []).append(requested_file)
+    return by_member
+
+
+def copy_restored(names, size):
+    # Further files with the content of a member are copied from the first one restored
+    for name in names[1:]:
+        if size > COPY_OBJECT_LIMIT:
+            s3.copy(CopySource={'Bucket': restore_bucket, 'Key': names[0]}, Bucket=restore_bucket, Key=name)
+        else:
+            s3.copy_object(CopySource={'Bucket': restore_bucket, 'Key': names[0]}, Bucket=restore_bucket, Key=name)
+
+
+def keep_in_cache(member_name, name, size):
+    # A member that can't be cached is still restored
+    if cache is None:
+        return
     try:
-        os.chdir(f'{download_dir}/app/s3-download')
-        # Upload the files to the S3 bucket
-        for file in os.listdir("."):
-            s3.put_object(Bucket=restore_bucket, Key=file, Body=open(file, 'rb'))
-        
-        print(f"Uploaded {requested_file} to {restore_bucket}")
+        if cache.add(archive_key, member_name, restore_bucket, name, size):
+            metrics.phase('cache').add(nbytes=size, items=1)
     except ClientError as e:
-        print(f"Error uploading {requested_file} to {restore_bucket}: {e}")
-    
+        print(f"Error keeping {member_name} in the restore cache: {e}")
+
+
+def restore_member(index, entry, names):
+    # Fetch only the blocks holding the member with a ranged GET and stream it into the bucket
+    file_log(f"Fetching {entry['name']} from bytes {entry['offset']}-{entry['offset'] + entry['length'] - 1} of {archive_key}")
+    with extract_phase.timed() as phase:
+        tarinfo, member = open_member(s3, bucket_name, archive_key, index, entry)
+        upload_member(names[0], tarinfo.size, member, entry['sha256'])
+        copy_restored(names, tarinfo.size)
+        phase.add(nbytes=tarinfo.size * len(names), items=len(names))
+    metrics.phase('download').add(nbytes=entry['length'])
+    keep_in_cache(entry['name'], names[0], tarinfo.size)
+
+
+def restore_with_index(index, restored, failed):
+    # Requested members are fetched and uploaded concurrently, MEMBER_THREADS at a time
+    entries = {member['name']: member for member in index['members']}
+    wanted = []
+    for member_name, names in files_by_member().items():
+        if member_name in entries:
+            wanted.append((entries[member_name], names))
+        else:
+            print(f"{member_name} is not in the index of {archive_key}")
+    with ThreadPoolExecutor(max_workers=MEMBER_THREADS) as executor:
+        futures = [(names, executor.submit(restore_member, index, entry, names)) for entry, names in wanted]
+        for names, future in futures:
+            try:
+                future.result()
+                file_log(f"Uploaded {', '.join(names)} to {restore_bucket}")
+                restored.extend(names)
+            except (ClientError, OSError, ValueError, tarfile.TarError) as e:
+                print(f"Error restoring {', '.join(names)}: {e}")
+                failed.extend(names)
+
+
+def restore_from_full_archive(restored, failed):
+    # Read the whole archive as one stream from S3, uploading requested members as they pass by
+    # and stopping as soon as every one of them is found
+    print(f"Streaming {archive_key} from {bucket_name}")
+    response = s3.get_object(Bucket=bucket_name, Key=archive_key)
+    body = response['Body']
+    remaining = files_by_member()
+    with tarfile.open(fileobj=decompressing_reader(codec_for(archive_key), body), mode='r|') as tar_file:
+        for member in tar_file:
+            if member.name not in remaining or not member.isfile():
+                continue
+            names = remaining.pop(member.name)
+            try:
+                with extract_phase.timed() as phase:
+                    upload_member(names[0], member.size, tar_file.extractfile(member))
+                    copy_restored(names, member.size)
+                    phase.add(nbytes=member.size * len(names), items=len(names))
+                keep_in_cache(member.name, names[0], member.size)
+                file_log(f"Uploaded {', '.join(names)} to {restore_bucket}")
+                restored.extend(names)
+            except (ClientError, ValueError) as e:
+                print(f"Error restoring {', '.join(names)}: {e}")
+                failed.extend(names)
+            if not remaining:
+                break
+    # Read up to the last requested member, or all of it
+    metrics.phase('download').add(nbytes=body.tell() if hasattr(body, 'tell') else response['ContentLength'])
+    body.close()
+
+
+try:
+    restored_files = []
+    failed_files = []
+    index = load_index(s3, bucket_name, archive_key)
+    if index is not None:
+        restore_with_index(index, restored_files, failed_files)
+    else:
+        print(f"No member index for {archive_key}, reading the whole archive")
+        restore_from_full_archive(restored_files, failed_files)
+    print(f"Transfers: {transfer_limiter.report()}")
+    if cache is not None:
+        try:
+            dropped, held = cache.evict()
+            print(f"Restore cache: {held / (1024 * 1024):.2f} MB of {RESTORE_CACHE_MB} MB held, {dropped} members dropped")
+        except ClientError as e:
+            print(f"Error evicting from the restore cache: {e}")
+    missing_files = [f for f in requested_files if f not in restored_files]
+    for requested_file in missing_files:
+        if requested_file not in failed_files:
+            print(f"{requested_file} not found in {archive_key}")
+
+    message = f"Files restored : {', '.join(restored_files)} from archive {archive_key} : Please Check S3 Bucket : {restore_bucket}"
+    if missing_files:
+        message += f"\nFiles not restored : {', '.join(missing_files)}"
     sns = boto3.client('sns')
+    metrics.count_requests(sns, {'Publish': 'notify'})
     sns_resp = sns.publish(
         TopicArn=sns_topic,
-        Message=f"File restored : {requested_file} from archive {archive_key} : Please Check S3 Bucket : {restore_bucket}",
-        Subject=f'{requested_file} - File restored for Access'
+        Message=message,
+        Subject=f'{len(restored_files)} files restored for Access from {archive_key}'[:100]
     )
     print(sns_resp)
 
     try:
         dynamodb = boto3.client('dynamodb')
-        del_resp = dynamodb.delete_item(
-            Key={
-                    'archive_key': {'S': archive_key},
-                    'key': {'S': requested_file}
-                },
-                TableName=restore_table
-            )
-        print(f"Delete Response => {del_resp}")
+        metrics.count_requests(dynamodb, {'BatchWriteItem': 'cleanup'})
+        for i in range(0, len(requested_files), 25):
+            deletes = [{'DeleteRequest': {'Key': {'archive_key': {'S': archive_key}, 'key': {'S': requested_file}}}}
+                       for requested_file in requested_files[i:i + 25]]
+            for attempt in attempts(8):
+                del_resp = dynamodb.batch_write_item(RequestItems={restore_table: deletes})
+                print(f"Delete Response => {del_resp}")
+                deletes = del_resp.get('UnprocessedItems', {}).get(restore_table, [])
+                if not deletes:
+                    break
+            if deletes:
+                # Left in the tracker, a repeated restore event extracts these files again
+                print(f"Could not remove {len(deletes)} restore requests of {archive_key} after retries: "
+                      f"{[d['DeleteRequest']['Key']['key']['S'] for d in deletes]}")
     except ClientError as e:
-                print(f"Error storing {file} in DynamoDB: {e}")
+        print(f"Error removing restore requests of {archive_key} from DynamoDB: {e}")
 
-except ClientError as e:
+except (ClientError, tarfile.TarError) as e:
     print(f"Error: {e}")
-
-#Clean up the temporary directory
-try:
-    shutil.rmtree(download_dir, ignore_errors=True)
-except OSError:
-    pass
\ No newline at end of file
+finally:
+    metrics.emit(extract_phase.bytes, extract_phase.items)
@@ -32,12 +32,14 @@ echo "Login to Repository"
 aws ecr get-login-password --region $awsRegion | docker login --username AWS --password-stdin $acctId.dkr.ecr.$awsRegion.amazonaws.com
 
 echo "Starting deployment of Archive Master"
-cd ../archive-master
+# Images are built from batch-apps so they can include the shared modules in common/
+cd ..
 pwd  # Check if we're in the right directory
 
 # Build using buildx with proper platform specification
 docker buildx build --platform=linux/amd64 \
   --load \
+  -f archive-master/Dockerfile \
   -t ${projectName}-archivemaster .
 
 # Tag and push if build successful
@@ -51,11 +53,11 @@ else
 fi
 
 echo "Starting deployment of Restorer"
-cd ../restorer
 
 # Build restorer using buildx
 docker buildx build --platform=linux/amd64 \
   --load \
+  -f restorer/Dockerfile \
   -t ${projectName}-restorer .
 
 # Tag and push if build successful